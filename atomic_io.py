@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Atomic File Writes
+Every pipeline artifact is written to a temporary file in the same
+directory and renamed into place, so a crashed or killed run never leaves a
+truncated file that a later run would mistake for a finished one.
+"""
+
+import contextlib
+import os
+import tempfile
+from pathlib import Path
+
+
+def _read_umask():
+    # The umask can only be read by setting it, so this is done once at import
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# mkstemp creates files readable by their owner only; replaced files get normal permissions instead
+NEW_FILE_MODE = 0o666 & ~_read_umask()
+
+
+def temp_path_for(path):
+    """Return a unique temporary path next to `path` (same filesystem, so rename is atomic)."""
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    os.close(fd)
+    return Path(tmp_name)
+
+
+def replace_with(tmp_path, path):
+    """Rename a finished temporary file over `path`, keeping the mode of the file it replaces."""
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = NEW_FILE_MODE
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Yield a temporary path to write to; it replaces `path` only if the block succeeds."""
+    tmp_path = temp_path_for(path)
+    try:
+        yield tmp_path
+        replace_with(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            tmp_path.unlink()
+        raise
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', encoding='utf-8'):
+    """Open a file for writing that only appears at `path` once closed successfully."""
+    with atomic_path(path) as tmp_path:
+        kwargs = {} if 'b' in mode else {'encoding': encoding}
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+
+
+def atomic_write_text(path, text, encoding='utf-8'):
+    """Atomically replace a text file."""
+    with atomic_open(path, 'w', encoding) as f:
+        f.write(text)
+
+
+def atomic_write_bytes(path, data):
+    """Atomically replace a binary file."""
+    with atomic_open(path, 'wb') as f:
+        f.write(data)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Batch Mode
+Translates many ebooks at once. Extraction and rendering share one CPU
+process pool; translation shares one thread pool with a global API rate
+limit and fair-share (round-robin) queueing across books. A failing book
+is reported and skipped without stopping the rest of the batch.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from pipeline import RunContext, run_steps, temp_dir_for
+from atomic_io import atomic_write_text
+from build_graph import BuildGraph
+from run_journal import RunJournal
+from scheduler import FairQueue, RateLimiter
+from step3_translate import (JOURNAL_STAGE, create_translator, output_path_for,
+                             translate_tracked, translation_params)
+
+SUPPORTED_EXTENSIONS = {'.pdf', '.epub', '.docx', '.md'}
+
+# Default global translation budget (requests per minute across all books)
+DEFAULT_RATE_LIMIT = 60
+
+# Attempts per page before it is marked failed
+DEFAULT_RETRIES = 3
+
+
+@dataclass
+class BookState:
+    """Progress of one book in the batch."""
+
+    input_file: Path
+    status: str = "queued"
+    pages: List[Path] = field(default_factory=list)
+    pages_done: int = 0
+    pages_failed: int = 0
+    output_lang: str = "zh"
+    error: Optional[str] = None
+    started: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+
+    @property
+    def name(self):
+        return self.input_file.name
+
+    @property
+    def temp_dir(self):
+        return temp_dir_for(self.input_file)
+
+
+def discover_books(source):
+    """Return ebook paths from a directory or a manifest file (one path per line)."""
+    source = Path(source)
+    if source.is_dir():
+        return sorted(p for p in source.iterdir()
+                      if p.is_file() and p.suffix.lower() in SUPPORTED_EXTENSIONS)
+
+    books = []
+    with open(source, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                path = Path(line)
+                books.append(path if path.is_absolute() else source.parent / path)
+    return books
+
+
+def run_book_stage(input_file, start_step, end_step, options):
+    """Run steps of one book in a worker process, logging to <book>_temp.log.
+
+    Returns (failed step or 0, page paths, output language).
+    """
+    input_file = Path(input_file)
+    log_file = temp_dir_for(input_file).with_suffix('.log')
+    with open(log_file, 'a', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        ctx = RunContext(temp_dir=temp_dir_for(input_file), input_file=input_file,
+                         reuse_existing=True, **options)
+        if start_step > 1:
+            ctx.reload_config()
+        failed_step = run_steps(ctx, start_step, end_step)
+        return failed_step, [str(p) for p in ctx.refresh_pages()], ctx.output_lang
+
+
+def run_batch(books, translator, options=None, cpu_workers=None, translate_workers=4,
+              rate_limit=DEFAULT_RATE_LIMIT, retries=DEFAULT_RETRIES, end_step=6):
+    """Translate all books; return their BookStates."""
+    options = options or {}
+    states = {str(book): BookState(Path(book)) for book in books}
+    events = queue.Queue()
+    work = FairQueue()
+    limiter = RateLimiter(rate_limit)
+    graphs = {}
+    journals = {}
+
+    def translate_worker():
+        while True:
+            task = work.get()
+            if task is None:
+                return
+            key, md_path = task
+            state = states[key]
+            output_path = output_path_for(md_path, state.temp_dir / "output")
+            params = translation_params(translator, state.output_lang)
+            try:
+                translate_tracked(md_path, output_path, state.output_lang, translator,
+                                  graphs[key], journals[key], params, retries, limiter.acquire)
+                events.put(("page", key, None))
+            except Exception as e:
+                events.put(("page", key, f"{Path(md_path).name}: {e}"))
+
+    def submit_stage(executor, key, start_step, stop_step, kind):
+        future = executor.submit(run_book_stage, str(states[key].input_file), start_step, stop_step, options)
+        future.add_done_callback(lambda f: events.put((kind, key, f)))
+
+    def finish(state, status, error=None):
+        state.status = status
+        state.error = error
+        state.finished = time.time()
+        print(f"[{state.name}] {status}" + (f": {error}" if error else ""))
+
+    threads = [threading.Thread(target=translate_worker, name=f"translate-{i}", daemon=True)
+               for i in range(translate_workers)]
+
+    # Books with the same name (book.pdf and book.epub) would share book_temp/
+    owners = {}
+    for state in states.values():
+        owner = owners.setdefault(state.temp_dir.resolve(), state)
+        if owner is not state:
+            finish(state, "failed", f"{owner.name} uses the same working directory {state.temp_dir}; "
+                                    "rename one of them")
+
+    with ProcessPoolExecutor(max_workers=cpu_workers or os.cpu_count() or 1) as executor:
+        for key, state in states.items():
+            if state.status == "queued":
+                state.status = "extracting"
+                submit_stage(executor, key, 1, 2, "extracted")
+
+        # Start translators only after the pool has forked its workers
+        for thread in threads:
+            thread.start()
+
+        remaining = len(owners)
+        while remaining:
+            kind, key, payload = events.get()
+            state = states[key]
+
+            if kind == "extracted":
+                try:
+                    failed_step, pages, output_lang = payload.result()
+                except Exception as e:
+                    failed_step, pages, output_lang = 2, [], state.output_lang
+                    state.error = str(e)
+                if failed_step or not pages:
+                    finish(state, "failed", state.error or f"step {failed_step or 2} failed, see {state.temp_dir}.log")
+                    remaining -= 1
+                    continue
+                state.pages = [Path(p) for p in pages]
+                state.output_lang = output_lang
+                state.status = "translating"
+                graphs[key] = BuildGraph(state.temp_dir)
+                journals[key] = RunJournal(state.temp_dir)
+                journals[key].forget(JOURNAL_STAGE, keep=[p.name for p in state.pages])
+                journals[key].register(JOURNAL_STAGE, [p.name for p in state.pages])
+                print(f"[{state.name}] extracted {len(pages)} pages")
+                for md_path in state.pages:
+                    work.put(key, md_path)
+
+            elif kind == "page":
+                if payload:
+                    state.pages_failed += 1
+                    print(f"[{state.name}] page failed: {payload}")
+                else:
+                    state.pages_done += 1
+                if state.pages_done + state.pages_failed == len(state.pages):
+                    graphs[key].save()
+                    journals.pop(key).close()
+                    if state.pages_failed:
+                        finish(state, "failed", f"{state.pages_failed} pages failed to translate")
+                        remaining -= 1
+                    elif end_step >= 4:
+                        state.status = "rendering"
+                        submit_stage(executor, key, 4, end_step, "rendered")
+                    else:
+                        finish(state, "done")
+                        remaining -= 1
+                elif state.pages_done % 10 == 0:
+                    print(f"[{state.name}] {state.pages_done}/{len(state.pages)} pages translated")
+
+            elif kind == "rendered":
+                try:
+                    failed_step = payload.result()[0]
+                except Exception as e:
+                    failed_step, state.error = 4, str(e)
+                if failed_step:
+                    finish(state, "failed", state.error or f"step {failed_step} failed, see {state.temp_dir}.log")
+                else:
+                    finish(state, "done")
+                remaining -= 1
+
+    work.close()
+    for thread in threads:
+        thread.join()
+    return list(states.values())
+
+
+def write_report(states, report_file):
+    """Write a JSON summary of the batch."""
+    report = [{
+        'input': str(state.input_file),
+        'status': state.status,
+        'pages': len(state.pages),
+        'pages_done': state.pages_done,
+        'pages_failed': state.pages_failed,
+        'error': state.error,
+        'seconds': round((state.finished or time.time()) - state.started, 2),
+    } for state in states]
+    atomic_write_text(report_file, json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate a batch of ebooks")
+    parser.add_argument("source", help="Directory of ebooks, or a manifest file with one path per line")
+    parser.add_argument("--api-key", help="SiliconFlow API密钥 (或设置SILICONFLOW_API_KEY环境变量)")
+    parser.add_argument("--olang", default="zh", help="Output language (default: zh)")
+    parser.add_argument("-l", "--lang", help="Input text language (auto-detect if not specified)")
+    parser.add_argument("--cpu-workers", type=int, help="Processes for extraction and rendering (default: CPU count)")
+    parser.add_argument("--translate-workers", type=int, default=4,
+                       help="Concurrent translation requests across all books (default: 4)")
+    parser.add_argument("--rate-limit", type=float, default=DEFAULT_RATE_LIMIT,
+                       help=f"Global translation requests per minute, 0 for unlimited (default: {DEFAULT_RATE_LIMIT})")
+    parser.add_argument("--report", help="Write a JSON batch report to this file")
+
+    args = parser.parse_args()
+
+    books = discover_books(args.source)
+    if not books:
+        print(f"Error: no ebooks found in {args.source}")
+        return 1
+
+    translator = create_translator(args.api_key)
+    if translator is None:
+        print("Error: batch mode needs a working SiliconFlow API key")
+        return 1
+
+    print(f"Batch: {len(books)} books")
+    options = {'output_lang': args.olang, 'input_lang': args.lang or "auto"}
+    states = run_batch(books, translator, options, args.cpu_workers, args.translate_workers, args.rate_limit)
+
+    if args.report:
+        write_report(states, args.report)
+
+    failed = [state for state in states if state.status != "done"]
+    print(f"\nBatch finished: {len(states) - len(failed)} done, {len(failed)} failed")
+    for state in failed:
+        print(f"  ✗ {state.name}: {state.error}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite
+Generates synthetic books (markdown, EPUB, PDF) at several sizes, runs the
+pipeline on each with an offline mock translator and records per-step wall
+time, peak RSS and output size. Results can be stored as a baseline and
+later runs compared against it with a regression threshold.
+
+Each case runs in its own subprocess so peak RSS is measured per case.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from atomic_io import atomic_write_text
+from synthetic_books import GENERATORS
+
+DEFAULT_SIZES = [10, 1000]
+DEFAULT_FORMATS = ['md', 'epub', 'pdf']
+
+# A metric regresses when it exceeds the baseline by more than this fraction
+DEFAULT_THRESHOLD = 0.25
+
+# Differences below these floors are treated as noise
+MIN_SECONDS_DELTA = 0.05
+MIN_RSS_DELTA_MB = 5.0
+
+
+class MockTranslator:
+    """Offline translator: returns the page unchanged after an optional simulated latency."""
+
+    model = "mock"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def translate_markdown(self, markdown_content, target_language="zh"):
+        if self.latency:
+            time.sleep(self.latency)
+        return markdown_content
+
+
+def case_name(fmt, pages):
+    return f"{fmt}-{pages}"
+
+
+def directory_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def missing_requirements(fmt, end_step, renderer="builtin"):
+    """Return why a case cannot run here, or None."""
+    import importlib.util
+    if fmt == 'pdf' and importlib.util.find_spec("fitz") is None:
+        return "PyMuPDF (fitz) not installed"
+    if renderer == 'pandoc' and end_step >= 5 and shutil.which("pandoc") is None:
+        return "pandoc not installed"
+    return None
+
+
+def run_case(fmt, pages, work_dir, end_step=6, latency=0.0, renderer="builtin"):
+    """Generate one book and run steps 1..end_step on it in this process; return its metrics."""
+    from pipeline import RunContext, run_steps, temp_dir_for
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    book = work_dir / f"bench_{pages}.{fmt}"
+    started = time.perf_counter()
+    GENERATORS[fmt](book, pages)
+    generate_seconds = time.perf_counter() - started
+
+    ctx = RunContext(temp_dir=temp_dir_for(book), input_file=book, translator=MockTranslator(latency),
+                     auto_overwrite=True, ocr=False, renderer=renderer)
+    started = time.perf_counter()
+    # Step output is per page and would dominate the timings
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        failed_step = run_steps(ctx, 1, end_step)
+    wall = time.perf_counter() - started
+
+    result = {
+        'format': fmt,
+        'pages': pages,
+        'failed_step': failed_step,
+        'generate_seconds': round(generate_seconds, 3),
+        'wall_seconds': round(wall, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'input_bytes': book.stat().st_size,
+        'output_bytes': directory_size(ctx.output_dir),
+        'page_files': len(ctx.refresh_pages()),
+    }
+    for key, value in ctx.metrics.items():
+        result[key] = round(value, 3)
+    return result
+
+
+def run_case_subprocess(fmt, pages, work_dir, end_step, latency, renderer="builtin"):
+    """Run one case in a fresh interpreter so its peak RSS is its own."""
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--run-case", fmt, str(pages),
+           "--work-dir", str(work_dir), "--end-step", str(end_step), "--latency", str(latency),
+           "--renderer", renderer]
+    completed = subprocess.run(cmd, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{case_name(fmt, pages)} failed: {completed.stderr.strip()[-500:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Return human-readable regressions of `results` against `baseline` (both keyed by case name)."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        checks = [(key, MIN_SECONDS_DELTA, "s") for key in result
+                  if key.endswith('_seconds') and key != 'generate_seconds']
+        checks += [('peak_rss_mb', MIN_RSS_DELTA_MB, " MB"), ('pandoc_peak_rss_mb', MIN_RSS_DELTA_MB, " MB"),
+                   ('output_bytes', 0, " B")]
+        for key, floor, unit in checks:
+            if key not in base or key not in result:
+                continue
+            old, new = base[key], result[key]
+            if new > old * (1 + threshold) and new - old > floor:
+                change = (new / old - 1) * 100 if old else float('inf')
+                regressions.append(f"{name} {key}: {old}{unit} -> {new}{unit} (+{change:.0f}%)")
+    return regressions
+
+
+def load_baseline(baseline_file):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        return json.load(f)['cases']
+
+
+def save_baseline(results, baseline_file):
+    document = {
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'cases': results,
+    }
+    atomic_write_text(baseline_file, json.dumps(document, indent=1, sort_keys=True))
+
+
+def print_table(results):
+    steps = sorted({key for result in results.values() for key in result
+                    if key.startswith('step') and key.endswith('_seconds')})
+    header = f"{'case':<12}{'wall s':>9}" + ''.join(f"{s.split('_')[0]:>9}" for s in steps) \
+        + f"{'RSS MB':>9}{'out MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        row = f"{name:<12}{result['wall_seconds']:>9.2f}"
+        row += ''.join(f"{result.get(s, 0):>9.2f}" for s in steps)
+        row += f"{result['peak_rss_mb']:>9.1f}{result['output_bytes'] / 1e6:>9.2f}"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic books")
+    parser.add_argument("--sizes", default=','.join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated page counts (default: 10,1000; add 10000 for the large tier)")
+    parser.add_argument("--formats", default=','.join(DEFAULT_FORMATS), help="Comma-separated formats: md,epub,pdf")
+    parser.add_argument("--end-step", type=int, default=6, choices=range(2, 7),
+                        help="Last step to run (default: 6)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per mock translation")
+    parser.add_argument("--renderer", choices=["builtin", "pandoc"], default="builtin",
+                        help="Step 5 renderer; pandoc also reports its parallelism and peak memory (default: builtin)")
+    parser.add_argument("--work-dir", help="Where books are generated (default: a temporary directory)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Store the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare against a stored baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Allowed slowdown/growth before flagging a regression (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--run-case", nargs=2, metavar=("FORMAT", "PAGES"), help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_case:
+        fmt, pages = args.run_case[0], int(args.run_case[1])
+        print(json.dumps(run_case(fmt, pages, args.work_dir, args.end_step, args.latency, args.renderer)))
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    formats = [fmt.strip() for fmt in args.formats.split(',')]
+    work_root = Path(args.work_dir or tempfile.mkdtemp(prefix="ebook_bench_"))
+
+    results = {}
+    try:
+        for fmt in formats:
+            for pages in sizes:
+                name = case_name(fmt, pages)
+                reason = missing_requirements(fmt, args.end_step, args.renderer)
+                if reason:
+                    print(f"Skipping {name}: {reason}")
+                    continue
+                print(f"Running {name}...")
+                result = run_case_subprocess(fmt, pages, work_root / name, args.end_step, args.latency,
+                                             args.renderer)
+                if result['failed_step']:
+                    print(f"  ✗ failed at step {result['failed_step']}")
+                results[name] = result
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    if not results:
+        print("No benchmark cases could run")
+        return 1
+
+    print()
+    print_table(results)
+
+    if args.output:
+        atomic_write_text(args.output, json.dumps(results, indent=1, sort_keys=True))
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    failed = any(result['failed_step'] for result in results.values())
+    if args.baseline:
+        regressions = compare(results, load_baseline(args.baseline), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  ✗ {regression}")
+            return 1
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Build Graph
+Records, for every pipeline artifact, the content hashes of its inputs and
+the parameters it was built with, so reruns only rebuild stale artifacts.
+"""
+
+import contextlib
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+from atomic_io import atomic_open
+
+STATE_FILENAME = "build_state.json"
+
+# Records are flushed to disk after this many updates (and on save())
+AUTOSAVE_EVERY = 50
+
+
+def path_key(path):
+    """Normalize a path for use as a record key."""
+    return str(Path(path).resolve())
+
+
+def file_digest(path):
+    """Return the sha256 of a file's contents, or None if it does not exist."""
+    path = Path(path)
+    if not path.is_file():
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildGraph:
+    """Make-like freshness records for artifacts in one working directory."""
+
+    def __init__(self, temp_dir, save_lock=None):
+        """save_lock, if given, returns a context manager held while the state file is rewritten
+        (e.g. a lease shared by processes on several hosts)."""
+        self.state_file = Path(temp_dir) / STATE_FILENAME
+        self._save_lock = save_lock
+        self.nodes = {}
+        self._digests = {}
+        self._dirty = set()
+        self._unsaved = 0
+        self._lock = threading.RLock()
+        # Outputs without a record (workspaces older than these records) may be adopted as built,
+        # except after reset(), which asks for everything to be rebuilt
+        self.adopt_unrecorded = True
+        self.nodes = self._load_nodes()
+
+    def digest(self, path):
+        """Hash a file, memoized by (size, mtime) for the lifetime of this graph."""
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key not in self._digests:
+                self._digests[key] = file_digest(path)
+            return self._digests[key]
+
+    def _input_digests(self, inputs):
+        return {path_key(path): self.digest(path) for path in inputs}
+
+    def recorded_output(self, name, path):
+        """Return the digest a node recorded for one of its outputs."""
+        with self._lock:
+            return self.nodes.get(name, {}).get('outputs', {}).get(path_key(path))
+
+    def _output_matches(self, name, path, current):
+        """Check an output against its record, accepting in-place rewrites by derived nodes."""
+        recorded = self.recorded_output(name, path)
+        if current is not None and current == recorded:
+            return True
+        # e.g. step 6 rewrites step 5's output.html in place
+        for derived in self.nodes.values():
+            if derived.get('derived_from') == name \
+                    and derived.get('params', {}).get('source') == recorded \
+                    and derived.get('outputs', {}).get(path_key(path)) == current:
+                return True
+        return False
+
+    def is_fresh(self, name, inputs=(), params=None, outputs=(), check_outputs=True):
+        """Return True if node `name` was built from these inputs and params.
+
+        Outputs must exist; with check_outputs they must also still hold the
+        recorded content (or a recorded in-place rewrite of it).
+        """
+        with self._lock:
+            node = self.nodes.get(name)
+            if node is None:
+                return False
+            if node.get('params', {}) != (params or {}):
+                return False
+            if node.get('inputs', {}) != self._input_digests(inputs):
+                return False
+            if outputs and set(node.get('outputs', {})) != {path_key(path) for path in outputs}:
+                return False
+            for path in outputs:
+                if not Path(path).exists():
+                    return False
+                if check_outputs and not self._output_matches(name, path, self.digest(path)):
+                    return False
+            return True
+
+    def record(self, name, inputs=(), params=None, outputs=(), derived_from=None):
+        """Record that node `name` was just built."""
+        with self._lock:
+            node = {
+                'inputs': self._input_digests(inputs),
+                'params': params or {},
+                'outputs': {path_key(path): self.digest(path) for path in outputs},
+            }
+            if derived_from:
+                node['derived_from'] = derived_from
+            self.nodes[name] = node
+            self._dirty.add(name)
+            self._unsaved += 1
+            if self._unsaved >= AUTOSAVE_EVERY:
+                self.save()
+
+    def invalidate(self, name):
+        """Forget a node so it is rebuilt next time."""
+        with self._lock:
+            self.nodes.pop(name, None)
+            self._dirty.add(name)
+            self._unsaved += 1
+
+    def _load_nodes(self):
+        if not self.state_file.exists():
+            return {}
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.adopt_unrecorded = state.get('adopt_unrecorded', True)
+            return state.get('nodes', {})
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable {self.state_file}")
+            return {}
+
+    def save(self):
+        """Atomically write the state file, merging in records saved by other graph instances."""
+        with self._lock, (self._save_lock() if self._save_lock else contextlib.nullcontext()):
+            nodes = self._load_nodes()
+            for name in self._dirty:
+                if name in self.nodes:
+                    nodes[name] = self.nodes[name]
+                else:
+                    nodes.pop(name, None)
+            self.nodes = nodes
+            self._dirty.clear()
+            self._write_state()
+            self._unsaved = 0
+
+    def _write_state(self):
+        state = {'nodes': self.nodes}
+        if not self.adopt_unrecorded:
+            state['adopt_unrecorded'] = False
+        with atomic_open(self.state_file) as f:
+            json.dump(state, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+    def reset(self):
+        """Drop all records (forces a full rebuild)."""
+        with self._lock:
+            self.nodes = {}
+            self.adopt_unrecorded = False
+            if self.state_file.parent.exists():
+                self._write_state()
+            self._dirty.clear()
+            self._unsaved = 0
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Chapter HTML Output
+Writes the book as a small static site instead of one output.html: a file
+per chapter, a shared stylesheet, images under content-hashed names loaded
+lazily, and an index page with the table of contents. A manifest records
+the hash of every file written, so a rebuild only rewrites the chapters and
+images whose content changed.
+"""
+
+import hashlib
+import html
+import json
+import re
+from pathlib import Path
+from urllib.parse import unquote
+
+from atomic_io import atomic_write_text
+from heading_index import nested_toc
+from image_assets import link_or_copy
+from markdown_renderer import HeadingIds, escape, fill_template, plain_text
+from merge_index import file_source
+
+SITE_DIRNAME = "html"
+INDEX_FILENAME = "index.html"
+MANIFEST_FILENAME = ".manifest.json"
+SHARED_CSS = "book.css"
+
+# A chapter starts at every page opening with a level-1 heading, or once it reaches this much HTML
+CHAPTER_MAX_BYTES = 256 * 1024
+
+# Headings deeper than this are left out of the index page
+TOC_DEPTH = 3
+
+NAV_CSS = """
+.chapter-nav {
+    display: flex;
+    justify-content: center;
+    gap: 1em;
+    margin: 1em 0;
+}
+"""
+
+HEADING = re.compile(r'<h([1-6]) id="([^"]*)">(.*?)</h\1>', re.S)
+IMAGE_SRC = re.compile(r'<img src="([^"]*)"')
+LOCAL_HREF = re.compile(r'href="#([^"]*)"')
+STYLE_BLOCK = re.compile(r'[ \t]*<style[^>]*>(.*?)</style>[ \t]*\n?', re.S)
+
+
+def chapter_filename(number):
+    return f"chapter{number:04d}.html"
+
+
+def shared_stylesheet(template):
+    """Move the template's inline <style> blocks to the shared stylesheet; return (template, css)."""
+    link = f'<link rel="stylesheet" href="{SHARED_CSS}" />\n'
+    styles = [block.strip('\n') for block in STYLE_BLOCK.findall(template)]
+    if not styles:
+        return template.replace('</head>', link + '</head>', 1), ''
+    links = iter([link])
+    return STYLE_BLOCK.sub(lambda match: next(links, ''), template), '\n'.join(styles)
+
+
+def plan_chapters(fragments):
+    """Assign pages to chapters; return (chapters, heading locations, TOC entries).
+
+    Each chapter is {'pages': [...], 'title': ...}; locations map a heading id
+    to its chapter number and the TOC holds (level, id, text, chapter number).
+    """
+    heading_ids = HeadingIds()
+    chapters = []
+    chapter_bytes = 0
+    locations = {}
+    toc = []
+    for page, fragment, ids in fragments:
+        body = heading_ids.fill(fragment, ids)
+        if not chapters or body.startswith('<h1') or chapter_bytes >= CHAPTER_MAX_BYTES:
+            chapters.append({'pages': [], 'title': None})
+            chapter_bytes = 0
+        chapter = chapters[-1]
+        chapter['pages'].append(page)
+        chapter_bytes += len(body)
+        for level, heading_id, content in HEADING.findall(body):
+            text = plain_text(content).strip()
+            locations[html.unescape(heading_id)] = len(chapters)
+            toc.append((int(level), heading_id, text, len(chapters)))
+            chapter['title'] = chapter['title'] or text
+    return chapters, locations, toc
+
+
+class ChapterSite:
+    """Write files into the site directory, skipping those whose content is unchanged."""
+
+    def __init__(self, site_dir):
+        self.site_dir = Path(site_dir)
+        self.site_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(self.site_dir / MANIFEST_FILENAME, 'r', encoding='utf-8') as f:
+                self.old = json.load(f)
+        except (OSError, ValueError):
+            self.old = {'files': {}, 'images': {}}
+        self.files = {}
+        self.images = {}
+        self.written = 0
+
+    def write(self, name, text):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        self.files[name] = digest
+        if self.old['files'].get(name) == digest and (self.site_dir / name).exists():
+            return
+        atomic_write_text(self.site_dir / name, text)
+        self.written += 1
+
+    def image(self, source):
+        """Return the content-hashed site path of an image file, copying it in if needed."""
+        key = str(source)
+        identity = file_source(source)
+        known = self.old['images'].get(key)
+        if known and known[0] == identity:
+            name = known[1]
+        else:
+            digest = hashlib.sha256(Path(source).read_bytes()).hexdigest()[:16]
+            name = f"images/{digest}{Path(source).suffix.lower()}"
+        self.images[key] = [identity, name]
+        if name not in self.files:
+            self.files[name] = name
+            target = self.site_dir / name
+            if not target.exists():
+                target.parent.mkdir(exist_ok=True)
+                # Hard links avoid a second copy of every image where the filesystem allows it
+                link_or_copy(source, target)
+                self.written += 1
+        return name
+
+    def finish(self):
+        """Remove files left over from the previous build and save the manifest."""
+        for name in set(self.old['files']) - set(self.files):
+            (self.site_dir / name).unlink(missing_ok=True)
+        atomic_write_text(self.site_dir / MANIFEST_FILENAME,
+                          json.dumps({'files': self.files, 'images': self.images}, ensure_ascii=False))
+
+
+def link_images(body, site, base_dir, lazy=True, assets=None):
+    """Point local images at their content-hashed copies and, if lazy, load them lazily.
+
+    assets maps resolved source images to processed ones (see image_assets.prepare_images).
+    """
+    def replace(match):
+        src = match.group(1)
+        source = Path(base_dir) / unquote(html.unescape(src))
+        if ':' not in src and source.is_file():
+            if assets:
+                source = assets.get(source.resolve(), source)
+            src = escape(site.image(source))
+        return f'<img loading="lazy" src="{src}"' if lazy else f'<img src="{src}"'
+    return IMAGE_SRC.sub(replace, body)
+
+
+def link_headings(body, locations, number, filename=chapter_filename):
+    """Point links to headings in other chapters at the chapter file that holds them."""
+    def replace(match):
+        target = locations.get(html.unescape(match.group(1)))
+        if target is None or target == number:
+            return match.group(0)
+        return f'href="{filename(target)}#{match.group(1)}"'
+    return LOCAL_HREF.sub(replace, body)
+
+
+def chapter_nav(number, count):
+    links = []
+    if number > 1:
+        links.append(f'<a href="{chapter_filename(number - 1)}" rel="prev">← Previous</a>')
+    links.append(f'<a href="{INDEX_FILENAME}">Contents</a>')
+    if number < count:
+        links.append(f'<a href="{chapter_filename(number + 1)}" rel="next">Next →</a>')
+    return f'<nav class="chapter-nav">{" · ".join(links)}</nav>'
+
+
+def index_body(toc):
+    headings = [{'level': level, 'id': html.unescape(heading_id), 'text': text, 'chapter': number}
+                for level, heading_id, text, number in toc if level <= TOC_DEPTH]
+    return nested_toc(headings, lambda heading: f"{chapter_filename(heading['chapter'])}#{heading['id']}")
+
+
+def write_chapter_site(fragments, output_dir, template, css, title, extra_css='', assets=None, search=None):
+    """Write the chapter site for the book into output_dir/html; return (files written, files total, chapters).
+
+    fragments() returns a fresh iterator of (page, fragment, heading ids) and
+    is read twice: once to plan chapters and collect heading locations, once
+    to write them. assets maps source images to processed ones; pages are
+    also added to the search index `search` (see search_index.SearchIndex) if given.
+    """
+    variables = {'search': "search/" if search else ''}
+    site = ChapterSite(Path(output_dir) / SITE_DIRNAME)
+    template, template_css = shared_stylesheet(template)
+    site.write(SHARED_CSS, '\n'.join(part for part in (template_css, NAV_CSS, extra_css) if part) + '\n')
+    for name in css:
+        site.write(name, Path(name).read_text(encoding='utf-8'))
+
+    chapters, locations, toc = plan_chapters(fragments())
+
+    heading_ids = HeadingIds()
+    pages = fragments()
+    for number, chapter in enumerate(chapters, 1):
+        parts = []
+        for page in chapter['pages']:
+            _, fragment, ids = next(pages)
+            if parts:
+                parts.append("\n<hr />\n")
+            parts.append(f"<!-- page: {page} -->\n")
+            parts.append(heading_ids.fill(fragment, ids))
+            if search:
+                search.add_page(page, parts[-1], chapter_filename(number), number)
+        body = link_headings(link_images(''.join(parts), site, output_dir, assets=assets), locations, number)
+        nav = chapter_nav(number, len(chapters))
+        chapter_title = chapter['title'] or f"{title} ({number})"
+        site.write(chapter_filename(number), fill_template(template, dict(
+            variables, title=chapter_title, css=css, body=f"{nav}\n{body}\n{nav}")))
+    # Let the fragment iterator finish so it can prune the render cache
+    for _ in pages:
+        pass
+
+    site.write(INDEX_FILENAME, fill_template(template, dict(variables, title=title, css=css, body=index_body(toc))))
+    site.finish()
+    return site.written, len(site.files), len(chapters)
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Distributed Workers
+Several worker processes, on one host or on hosts sharing a filesystem,
+cooperate on one book through a task queue in <temp_dir>/queue:
+
+    tasks/<id>.json    task description (kind, dependencies, arguments)
+    leases/<id>.lease  claim held by a worker until it expires
+    done/<id>.json     completion record (worker, seconds)
+    failed/<id>.json   failure count and last error
+
+A worker claims a task by creating its lease file exclusively and renews
+the lease while it works. A lease that is not renewed in time (the worker
+died) is stolen by the next worker that wants the task. Tasks are
+idempotent, so a task that runs twice still produces the same files.
+
+Task graph: extract -> (pdf-NNNNNN chunks) -> collect -> translate-<page>... -> render
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from atomic_io import atomic_write_text
+from build_graph import BuildGraph
+from pipeline import RunContext, run_steps, temp_dir_for
+
+QUEUE_DIRNAME = "queue"
+
+# A lease not renewed for this long is considered abandoned
+DEFAULT_LEASE_SECONDS = 60.0
+
+# Seconds between scans of the queue when nothing is runnable
+DEFAULT_POLL_SECONDS = 1.0
+
+# PDF pages per extraction task
+PDF_CHUNK_PAGES = 50
+
+# Attempts before a task is left failed
+MAX_ATTEMPTS = 3
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class LeaseQueue:
+    """File-based task queue with expiring leases, safe across processes and hosts."""
+
+    def __init__(self, temp_dir, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.root = Path(temp_dir) / QUEUE_DIRNAME
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.dirs = {name: self.root / name for name in ("tasks", "leases", "done", "failed")}
+        for path in self.dirs.values():
+            path.mkdir(parents=True, exist_ok=True)
+        self.held = set()
+        self._tasks = {}
+        self._done = set()
+        self._lock = threading.Lock()
+
+    # Tasks
+
+    def add(self, task_id, kind, deps=(), **args):
+        """Add a task unless it already exists."""
+        path = self.dirs["tasks"] / f"{task_id}.json"
+        if not path.exists():
+            atomic_write_text(path, json.dumps({'id': task_id, 'kind': kind, 'deps': list(deps), 'args': args}))
+
+    def tasks(self):
+        """Return all tasks by id (task files never change, so they are read once)."""
+        for path in self.dirs["tasks"].glob("*.json"):
+            task_id = path.stem
+            if task_id not in self._tasks:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._tasks[task_id] = json.load(f)
+        return self._tasks
+
+    def done_ids(self):
+        # Completion is permanent, so the local set only ever grows
+        self._done.update(path.stem for path in self.dirs["done"].glob("*.json"))
+        return self._done
+
+    def failure(self, task_id):
+        path = self.dirs["failed"] / f"{task_id}.json"
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def given_up_ids(self):
+        """Ids of tasks that failed MAX_ATTEMPTS times."""
+        failures = (self.failure(path.stem) for path in self.dirs["failed"].glob("*.json"))
+        return {failure['id'] for failure in failures if failure and failure['attempts'] >= MAX_ATTEMPTS}
+
+    # Leases
+
+    def _lease_path(self, task_id):
+        return self.dirs["leases"] / f"{task_id}.lease"
+
+    def read_lease(self, task_id):
+        """Return {'worker', 'expires'} of a lease, or None if there is none."""
+        path = self._lease_path(task_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # Created but not written yet; judge it by its age
+            try:
+                return {'worker': None, 'expires': path.stat().st_mtime + self.lease_seconds}
+            except FileNotFoundError:
+                return None
+
+    def _lease_body(self):
+        return json.dumps({'worker': self.worker_id, 'expires': time.time() + self.lease_seconds})
+
+    def claim(self, task_id):
+        """Try to take the lease of a task, stealing it if expired; return True on success."""
+        path = self._lease_path(task_id)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                lease = self.read_lease(task_id)
+                if lease is None:
+                    continue
+                if lease['expires'] > time.time():
+                    return False
+                if not self._steal(path, lease):
+                    return False
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self._lease_body())
+            with self._lock:
+                self.held.add(task_id)
+            return True
+        return False
+
+    def _steal(self, path, expired):
+        """Move an expired lease aside; only one of several competing workers succeeds."""
+        stale = path.with_name(f"{path.name}.{self.worker_id}.stale")
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+        try:
+            with open(stale, 'r', encoding='utf-8') as f:
+                moved = json.load(f)
+        except (OSError, ValueError):
+            moved = None
+        if moved is not None and moved != expired and moved['expires'] > time.time():
+            # Another worker re-leased the task between our read and rename: give it back
+            with contextlib.suppress(FileExistsError):
+                os.link(stale, path)
+            stale.unlink()
+            return False
+        print(f"[{self.worker_id}] stealing {path.stem} from {expired.get('worker')}")
+        stale.unlink()
+        return True
+
+    def renew(self):
+        """Extend every lease this worker holds (called from the heartbeat thread)."""
+        with self._lock:
+            held = list(self.held)
+        for task_id in held:
+            lease = self.read_lease(task_id)
+            if lease is None or lease['worker'] != self.worker_id:
+                # Lost to a thief; the task is idempotent, so finishing it anyway is harmless
+                continue
+            atomic_write_text(self._lease_path(task_id), self._lease_body())
+
+    def release(self, task_id):
+        with self._lock:
+            self.held.discard(task_id)
+        lease = self.read_lease(task_id)
+        if lease is not None and lease['worker'] == self.worker_id:
+            with contextlib.suppress(FileNotFoundError):
+                self._lease_path(task_id).unlink()
+
+    def complete(self, task_id, seconds):
+        atomic_write_text(self.dirs["done"] / f"{task_id}.json",
+                          json.dumps({'worker': self.worker_id, 'seconds': round(seconds, 3),
+                                      'finished': time.time()}))
+        self._done.add(task_id)
+        self.release(task_id)
+
+    def fail(self, task_id, error):
+        failure = self.failure(task_id) or {'id': task_id, 'attempts': 0}
+        failure.update(attempts=failure['attempts'] + 1, error=error, worker=self.worker_id)
+        atomic_write_text(self.dirs["failed"] / f"{task_id}.json", json.dumps(failure))
+        self.release(task_id)
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """Mutual exclusion across workers, using a lease that expires if its holder dies."""
+        lock_id = f"lock-{name}"
+        while not self.claim(lock_id):
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            self.release(lock_id)
+
+    def reset(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def blocked_ids(tasks, given_up):
+    """Ids of tasks that failed for good or depend, directly or not, on one that did."""
+    blocked = set(given_up)
+    changed = True
+    while changed:
+        changed = False
+        for task_id, task in tasks.items():
+            if task_id not in blocked and any(dep in blocked for dep in task['deps']):
+                blocked.add(task_id)
+                changed = True
+    return blocked
+
+
+def runnable_tasks(queue):
+    """Return (runnable tasks in claim order, whether any task is still unfinished)."""
+    tasks = queue.tasks()
+    done = queue.done_ids()
+    blocked = blocked_ids(tasks, queue.given_up_ids())
+    runnable = []
+    unfinished = False
+    for task_id, task in tasks.items():
+        if task_id in done or task_id in blocked:
+            continue
+        unfinished = True
+        if all(dep in done for dep in task['deps']):
+            runnable.append(task)
+    # Pages in order, the final render last
+    runnable.sort(key=lambda task: (task['kind'] == 'render', task['id']))
+    return runnable, unfinished
+
+
+class Worker:
+    """Claims and runs tasks of one book until none are left."""
+
+    def __init__(self, temp_dir, translator=None, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 poll_seconds=DEFAULT_POLL_SECONDS, end_step=6):
+        self.queue = LeaseQueue(temp_dir, worker_id, lease_seconds)
+        self.ctx = RunContext.from_temp_dir(temp_dir, translator=translator, reuse_existing=True)
+        self.poll_seconds = poll_seconds
+        self.end_step = end_step
+        self.graph = BuildGraph(temp_dir, save_lock=lambda: self.queue.lock("build_state"))
+        self.completed = 0
+        self._stop = threading.Event()
+
+    @property
+    def worker_id(self):
+        return self.queue.worker_id
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            self.queue.renew()
+
+    def run(self):
+        """Work until every task is done or has failed for good; return True if all succeeded."""
+        heartbeat = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                runnable, unfinished = runnable_tasks(self.queue)
+                if not unfinished:
+                    break
+                claimed = next((task for task in runnable if self.queue.claim(task['id'])), None)
+                if claimed is None:
+                    time.sleep(self.poll_seconds)
+                    continue
+                self._run_task(claimed)
+        finally:
+            self._stop.set()
+            heartbeat.join()
+            self.graph.save()
+        given_up = self.queue.given_up_ids()
+        failed = sorted(given_up)
+        for task_id in failed:
+            print(f"[{self.worker_id}] task {task_id} failed: {self.queue.failure(task_id)['error']}")
+        for task_id in sorted(blocked_ids(self.queue.tasks(), given_up) - given_up):
+            print(f"[{self.worker_id}] task {task_id} skipped: a task it depends on failed")
+        return not failed
+
+    def _run_task(self, task):
+        started = time.perf_counter()
+        try:
+            ok = getattr(self, f"task_{task['kind']}")(task)
+            error = None if ok else "task reported failure"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        if error:
+            print(f"[{self.worker_id}] {task['id']} failed: {error}")
+            self.queue.fail(task['id'], error)
+        else:
+            self.queue.complete(task['id'], time.perf_counter() - started)
+            self.completed += 1
+
+    # Task handlers
+
+    def task_extract(self, task):
+        """Split the book; PDFs are fanned out into page-chunk tasks."""
+        import step2_split_pdf
+        input_path = Path(self.ctx.config['INPUT_FILE'])
+        pages = self.ctx.refresh_pages()
+        fresh = pages and self.graph.is_fresh("split", [input_path], step2_split_pdf.split_params(self.ctx),
+                                              pages, check_outputs=False)
+        if fresh or input_path.suffix.lower() != '.pdf' or not step2_split_pdf.PYMUPDF_AVAILABLE:
+            ok = step2_split_pdf.run(self.ctx)
+            self.queue.add("collect", "collect", deps=["extract"])
+            return ok
+
+        total = step2_split_pdf.pdf_page_count(input_path)
+        for md_path in self.ctx.refresh_pages():
+            md_path.unlink()
+        chunks = []
+        for start in range(0, total, PDF_CHUNK_PAGES):
+            chunk_id = f"pdf-{start:06d}"
+            self.queue.add(chunk_id, "pdf_chunk", start=start, end=min(start + PDF_CHUNK_PAGES, total))
+            chunks.append(chunk_id)
+        self.queue.add("collect", "collect", deps=["extract"] + chunks, record_split=True)
+        return True
+
+    def task_pdf_chunk(self, task):
+        import step2_split_pdf
+        args = task['args']
+        return step2_split_pdf.split_pdf(self.ctx.config['INPUT_FILE'], self.ctx.temp_dir, self.ctx.ocr,
+                                         self.ctx.input_lang, workers=1, page_range=(args['start'], args['end']))
+
+    def task_collect(self, task):
+        """Queue one translation task per page and the final render behind them."""
+        pages = self.ctx.refresh_pages()
+        if not pages:
+            return False
+        if task['args'].get('record_split'):
+            import step2_split_pdf
+            self.graph.record("split", [self.ctx.config['INPUT_FILE']], step2_split_pdf.split_params(self.ctx), pages)
+        translate_ids = []
+        for md_path in pages:
+            task_id = f"translate-{md_path.stem}"
+            self.queue.add(task_id, "translate", deps=["collect"], page=md_path.name)
+            translate_ids.append(task_id)
+        self.queue.add("render", "render", deps=translate_ids)
+        return True
+
+    def task_translate(self, task):
+        from step3_translate import output_path_for, translate_tracked, translation_params
+        md_path = self.ctx.pages_dir / task['args']['page']
+        output_path = output_path_for(md_path, self.ctx.output_dir)
+        params = translation_params(self.ctx.translator, self.ctx.output_lang)
+        translate_tracked(md_path, output_path, self.ctx.output_lang, self.ctx.translator,
+                          self.graph, None, params)
+        return True
+
+    def task_render(self, task):
+        self.graph.save()
+        return run_steps(self.ctx, 4, self.end_step) == 0
+
+
+def submit(input_file, input_lang="auto", output_lang="zh"):
+    """Initialize a book's working directory and queue its extraction; return the temp dir."""
+    input_file = Path(input_file)
+    ctx = RunContext(temp_dir=temp_dir_for(input_file), input_file=input_file, input_lang=input_lang,
+                     output_lang=output_lang, reuse_existing=True)
+    if run_steps(ctx, 1, 1):
+        raise RuntimeError("initialization failed")
+    queue = LeaseQueue(ctx.temp_dir)
+    queue.reset()
+    queue = LeaseQueue(ctx.temp_dir)
+    queue.add("extract", "extract")
+    return ctx.temp_dir
+
+
+def queue_status(temp_dir):
+    """Aggregate progress of all workers: counts by state and kind, and per-worker throughput."""
+    queue = LeaseQueue(temp_dir, worker_id="status")
+    tasks = queue.tasks()
+    done = queue.done_ids()
+    given_up = blocked_ids(tasks, queue.given_up_ids())
+    now = time.time()
+    status = {'total': len(tasks), 'done': 0, 'running': 0, 'failed': 0, 'pending': 0,
+              'by_kind': {}, 'workers': {}}
+    for task_id, task in tasks.items():
+        lease = queue.read_lease(task_id)
+        if task_id in done:
+            state = 'done'
+            with open(queue.dirs["done"] / f"{task_id}.json", 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            worker = status['workers'].setdefault(record['worker'], {'done': 0, 'seconds': 0.0})
+            worker['done'] += 1
+            worker['seconds'] += record['seconds']
+        elif task_id in given_up:
+            state = 'failed'
+        elif lease is not None and lease['expires'] > now:
+            state = 'running'
+        else:
+            state = 'pending'
+        status[state] += 1
+        kind = status['by_kind'].setdefault(task['kind'], {'done': 0, 'running': 0, 'failed': 0, 'pending': 0})
+        kind[state] += 1
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed workers sharing a book's working directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Initialize a book and queue its tasks")
+    submit_parser.add_argument("-i", "--input", required=True, help="Input ebook file path")
+    submit_parser.add_argument("-l", "--lang", help="Input text language (auto-detect if not specified)")
+    submit_parser.add_argument("--olang", default="zh", help="Output language (default: zh)")
+
+    work_parser = subparsers.add_parser("work", help="Run a worker until the book is finished")
+    work_parser.add_argument("temp_dir", help="Book working directory (on a shared filesystem)")
+    work_parser.add_argument("--api-key", help="SiliconFlow API密钥 (或设置SILICONFLOW_API_KEY环境变量)")
+    work_parser.add_argument("--worker-id", help="Name of this worker (default: host-pid-random)")
+    work_parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS,
+                             help=f"Lease timeout before a task is stolen (default: {DEFAULT_LEASE_SECONDS})")
+    work_parser.add_argument("--end-step", type=int, default=6, choices=range(4, 7),
+                             help="Last step of the final render task (default: 6)")
+
+    status_parser = subparsers.add_parser("status", help="Show aggregated progress")
+    status_parser.add_argument("temp_dir", help="Book working directory")
+
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        temp_dir = submit(args.input, args.lang or "auto", args.olang)
+        print(f"Queued {args.input}; start workers with: python3 distributed.py work {temp_dir}")
+        return 0
+
+    if args.command == "status":
+        status = queue_status(args.temp_dir)
+        print(f"{status['done']}/{status['total']} tasks done, {status['running']} running, "
+              f"{status['pending']} pending, {status['failed']} failed")
+        for kind, counts in sorted(status['by_kind'].items()):
+            print(f"  {kind:<10} " + ", ".join(f"{state} {count}" for state, count in counts.items()))
+        for worker, stats in sorted(status['workers'].items()):
+            print(f"  {worker}: {stats['done']} tasks, {stats['seconds']:.1f}s")
+        return 0
+
+    from step3_translate import create_translator
+    translator = create_translator(args.api_key)
+    if translator is None:
+        print("Error: workers need a working SiliconFlow API key")
+        return 1
+    worker = Worker(args.temp_dir, translator, args.worker_id, args.lease_seconds, end_step=args.end_step)
+    ok = worker.run()
+    print(f"[{worker.worker_id}] finished {worker.completed} tasks")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Native EPUB/DOCX Reader
+Reads EPUB and DOCX packages straight from the zip archive and converts
+them to markdown chapter by chapter, without a whole-book pandoc pass.
+"""
+
+import hashlib
+import importlib.util
+import os
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from pathlib import Path
+from urllib.parse import unquote
+
+from atomic_io import atomic_write_bytes
+
+# Optional dependencies are only imported by the functions that need them
+PYPANDOC_AVAILABLE = importlib.util.find_spec("pypandoc") is not None
+
+
+CONTAINER_NS = {'c': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+OPF_NS = {'opf': 'http://www.idpf.org/2007/opf'}
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+R_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+XHTML_MEDIA_TYPES = {'application/xhtml+xml', 'text/html'}
+SRC_ATTR_PATTERN = re.compile(r'''((?:src|xlink:href)\s*=\s*)(["'])([^"']*)\2''', re.IGNORECASE)
+
+
+def save_archive_image(archive, member, images_dir):
+    """Write an image from the archive once, named by content hash; return its filename."""
+    data = archive.read(member)
+    ext = posixpath.splitext(member)[1].lower() or '.bin'
+    img_filename = f"img_{hashlib.sha256(data).hexdigest()[:16]}{ext}"
+    img_path = Path(images_dir) / img_filename
+    if not img_path.exists():
+        atomic_write_bytes(img_path, data)
+    return img_filename
+
+
+class HTMLToMarkdown(HTMLParser):
+    """Small native XHTML to markdown converter used when pandoc is not available."""
+
+    BLOCK_TAGS = {'p', 'div', 'section', 'article', 'header', 'footer', 'aside',
+                  'figure', 'figcaption', 'dl', 'dt', 'dd', 'body'}
+    SKIP_TAGS = {'head', 'script', 'style', 'title'}
+    INLINE_SPECIAL = re.compile(r'([\\`*_])')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self.current = []
+        self.list_stack = []
+        self.quote_depth = 0
+        self.pre_depth = 0
+        self.code_depth = 0
+        self.skip_depth = 0
+        self.link_stack = []
+        self.tables = []
+
+    def flush(self, prefix=''):
+        if self.tables:
+            # Blocks inside a table cell are run into the cell
+            self.current.append(' ')
+            return
+        text = ''.join(self.current)
+        self.current = []
+        if self.pre_depth:
+            return
+        text = re.sub(r'[ \t\r\n]+', ' ', text).strip()
+        if text:
+            # Text that would start a heading, quote or list item stays a paragraph
+            text = re.sub(r'^([#>+-])', r'\\\1', text)
+            text = re.sub(r'^(\d+)([.)])', r'\1\\\2', text)
+            self.emit(prefix + text)
+
+    def emit(self, block):
+        """Append a block, marked as the first block of a list item or indented under it."""
+        quote = '> ' * self.quote_depth
+        lines = block.split('\n')
+        first = quote + self.item_prefix() + lines[0]
+        indent = quote + ' ' * len(self.list_indent())
+        self.blocks.append('\n'.join([first] + [indent + line for line in lines[1:]]))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif self.skip_depth:
+            return
+        elif re.fullmatch(r'h[1-6]', tag):
+            self.flush()
+        elif tag in self.BLOCK_TAGS:
+            self.flush()
+        elif tag == 'br':
+            self.current.append('\n' if self.pre_depth else '  \n')
+        elif tag == 'hr':
+            self.flush()
+            self.blocks.append('---')
+        elif tag == 'blockquote':
+            self.flush()
+            self.quote_depth += 1
+        elif tag in ('ul', 'ol'):
+            # Text before a nested list belongs to the enclosing item
+            self.flush()
+            self.list_stack.append([tag, 0, False])
+        elif tag == 'li':
+            self.flush()
+            if self.list_stack:
+                self.list_stack[-1][1] += 1
+                self.list_stack[-1][2] = False
+        elif tag == 'table':
+            self.flush()
+            self.tables.append([])
+        elif tag == 'tr' and self.tables:
+            self.tables[-1].append([])
+            self.current = []
+        elif tag in ('td', 'th') and self.tables:
+            self.current = []
+        elif tag == 'pre':
+            self.flush()
+            self.pre_depth += 1
+        elif tag in ('em', 'i'):
+            self.current.append('*')
+        elif tag in ('strong', 'b'):
+            self.current.append('**')
+        elif tag == 'code' and not self.pre_depth:
+            self.code_depth += 1
+            self.current.append('`')
+        elif tag == 'a':
+            href = attrs.get('href')
+            self.link_stack.append(href)
+            if href:
+                self.current.append('[')
+        elif tag == 'img':
+            alt = attrs.get('alt') or ''
+            self.current.append(f"![{alt}]({attrs.get('src', '')})")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif self.skip_depth:
+            return
+        elif re.fullmatch(r'h[1-6]', tag):
+            self.flush('#' * int(tag[1]) + ' ')
+        elif tag in self.BLOCK_TAGS:
+            self.flush()
+        elif tag == 'blockquote':
+            self.flush()
+            self.quote_depth = max(0, self.quote_depth - 1)
+        elif tag in ('ul', 'ol'):
+            self.flush()
+            if self.list_stack:
+                self.list_stack.pop()
+        elif tag == 'li':
+            self.flush()
+        elif tag in ('td', 'th') and self.tables:
+            cell = re.sub(r'[ \t\r\n]+', ' ', ''.join(self.current)).strip()
+            self.current = []
+            if not self.tables[-1]:
+                self.tables[-1].append([])
+            self.tables[-1][-1].append(cell.replace('|', '\\|'))
+        elif tag == 'table' and self.tables:
+            self.end_table(self.tables.pop())
+        elif tag == 'pre':
+            code = ''.join(self.current).strip('\n')
+            self.current = []
+            self.pre_depth = max(0, self.pre_depth - 1)
+            self.blocks.append(f"```\n{code}\n```")
+        elif tag in ('em', 'i'):
+            self.current.append('*')
+        elif tag in ('strong', 'b'):
+            self.current.append('**')
+        elif tag == 'code' and not self.pre_depth:
+            self.code_depth = max(0, self.code_depth - 1)
+            self.current.append('`')
+        elif tag == 'a':
+            href = self.link_stack.pop() if self.link_stack else None
+            if href:
+                self.current.append(f']({href})')
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if not self.pre_depth and not self.code_depth:
+            data = self.INLINE_SPECIAL.sub(r'\\\1', data)
+        self.current.append(data)
+
+    def end_table(self, rows):
+        """Write a finished table as a pipe table (or into the enclosing cell)."""
+        rows = [row for row in rows if any(row)]
+        self.current = []
+        if not rows:
+            return
+        width = max(len(row) for row in rows)
+        rows = [row + [''] * (width - len(row)) for row in rows]
+        if self.tables:
+            # A nested table is flattened into its parent's cell
+            self.current.append(' '.join(cell for row in rows for cell in row if cell))
+            return
+        lines = ['| ' + ' | '.join(row) + ' |' for row in rows]
+        lines.insert(1, '|' + ' --- |' * width)
+        self.emit('\n'.join(lines))
+
+    def list_markers(self):
+        return [f"{count}. " if kind == 'ol' else "- " for kind, count, _ in self.list_stack]
+
+    def list_indent(self):
+        """Indentation of the blocks inside the current list item."""
+        return ' ' * sum(len(marker) for marker in self.list_markers())
+
+    def item_prefix(self):
+        """The item's marker for its first block, indentation for the blocks after it."""
+        if not self.list_stack:
+            return ''
+        markers = self.list_markers()
+        # Nested items are indented past their parent's marker
+        parent = ' ' * sum(len(marker) for marker in markers[:-1])
+        if self.list_stack[-1][1] and not self.list_stack[-1][2]:
+            self.list_stack[-1][2] = True
+            return parent + markers[-1]
+        return parent + ' ' * len(markers[-1])
+
+    def markdown(self):
+        self.flush()
+        return '\n\n'.join(self.blocks) + '\n' if self.blocks else ''
+
+
+def html_to_markdown(html_content):
+    """Convert an (X)HTML document to markdown with the native converter."""
+    converter = HTMLToMarkdown()
+    converter.feed(html_content)
+    converter.close()
+    return converter.markdown()
+
+
+def rewrite_image_sources(html_content, chapter_dir, image_map):
+    """Point image references at the extracted copies in ../images/."""
+    def replace(match):
+        target = posixpath.normpath(posixpath.join(chapter_dir, unquote(match.group(3).split('#')[0])))
+        if target in image_map:
+            return f"{match.group(1)}{match.group(2)}../images/{image_map[target]}{match.group(2)}"
+        return match.group(0)
+    return SRC_ATTR_PATTERN.sub(replace, html_content)
+
+
+def convert_epub_chapter(task):
+    """Convert one spine document to markdown (runs in a worker process)."""
+    epub_path, member, image_map, use_pandoc = task
+    with zipfile.ZipFile(epub_path) as archive:
+        html_content = archive.read(member).decode('utf-8', errors='replace')
+
+    html_content = rewrite_image_sources(html_content, posixpath.dirname(member), image_map)
+
+    if use_pandoc:
+        import pypandoc
+        return pypandoc.convert_text(html_content, 'md', format='html')
+    return html_to_markdown(html_content)
+
+
+def read_epub_spine(archive):
+    """Return (spine document paths, image paths) from the OPF package."""
+    container = ET.fromstring(archive.read('META-INF/container.xml'))
+    rootfile = container.find('.//c:rootfile', CONTAINER_NS)
+    if rootfile is None:
+        raise ValueError("EPUB container.xml has no rootfile")
+    opf_path = rootfile.get('full-path')
+    opf_dir = posixpath.dirname(opf_path)
+
+    opf = ET.fromstring(archive.read(opf_path))
+    manifest = {}
+    images = []
+    for item in opf.findall('.//opf:manifest/opf:item', OPF_NS):
+        href = posixpath.normpath(posixpath.join(opf_dir, unquote(item.get('href', ''))))
+        media_type = item.get('media-type', '')
+        manifest[item.get('id')] = (href, media_type)
+        if media_type.startswith('image/'):
+            images.append(href)
+
+    spine = []
+    for itemref in opf.findall('.//opf:spine/opf:itemref', OPF_NS):
+        href, media_type = manifest.get(itemref.get('idref'), (None, None))
+        if href and media_type in XHTML_MEDIA_TYPES:
+            spine.append(href)
+
+    return spine, images
+
+
+def read_epub_chapters(epub_path, images_dir, workers=None, use_pandoc=None):
+    """Yield the markdown of each EPUB spine document in reading order.
+
+    Images are extracted straight from the archive, and chapters are
+    converted in parallel worker processes.
+    """
+    if use_pandoc is None:
+        use_pandoc = PYPANDOC_AVAILABLE
+
+    with zipfile.ZipFile(epub_path) as archive:
+        spine, images = read_epub_spine(archive)
+        names = set(archive.namelist())
+        image_map = {}
+        for member in images:
+            if member in names:
+                image_map[member] = save_archive_image(archive, member, images_dir)
+
+    print(f"EPUB spine: {len(spine)} chapters, {len(image_map)} images")
+
+    tasks = [(str(epub_path), member, image_map, use_pandoc) for member in spine]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        yield from map(convert_epub_chapter, tasks)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(convert_epub_chapter, tasks)
+
+
+def read_docx_styles(archive):
+    """Map DOCX paragraph style ids to heading levels."""
+    levels = {}
+    if 'word/styles.xml' not in archive.namelist():
+        return levels
+
+    styles = ET.fromstring(archive.read('word/styles.xml'))
+    for style in styles.iter(f'{{{W_NS}}}style'):
+        style_id = style.get(f'{{{W_NS}}}styleId', '')
+        name_el = style.find(f'{{{W_NS}}}name')
+        name = (name_el.get(f'{{{W_NS}}}val', '') if name_el is not None else '').lower()
+        outline = style.find(f'.//{{{W_NS}}}outlineLvl')
+        match = re.fullmatch(r'heading (\d)', name)
+        if name == 'title':
+            levels[style_id] = 1
+        elif match:
+            levels[style_id] = int(match.group(1))
+        elif outline is not None:
+            levels[style_id] = int(outline.get(f'{{{W_NS}}}val', '0')) + 1
+    return levels
+
+
+def docx_paragraph_to_markdown(paragraph, heading_levels, relationships, archive, images_dir, names):
+    """Convert one w:p element to a markdown block; return (level, text)."""
+    style = paragraph.find(f'{{{W_NS}}}pPr/{{{W_NS}}}pStyle')
+    style_id = style.get(f'{{{W_NS}}}val', '') if style is not None else ''
+    level = heading_levels.get(style_id, 0)
+    if not level:
+        match = re.fullmatch(r'Heading(\d)', style_id)
+        level = int(match.group(1)) if match else 0
+
+    parts = []
+    for run in paragraph.iter(f'{{{W_NS}}}r'):
+        props = run.find(f'{{{W_NS}}}rPr')
+        bold = props is not None and props.find(f'{{{W_NS}}}b') is not None
+        italic = props is not None and props.find(f'{{{W_NS}}}i') is not None
+        text = ''
+        for child in run:
+            if child.tag == f'{{{W_NS}}}t':
+                text += child.text or ''
+            elif child.tag == f'{{{W_NS}}}tab':
+                text += '\t'
+            elif child.tag == f'{{{W_NS}}}br':
+                text += '  \n'
+        if text.strip() and not level:
+            if bold:
+                text = f"**{text}**"
+            if italic:
+                text = f"*{text}*"
+        parts.append(text)
+
+        for blip in run.iter(f'{{{A_NS}}}blip'):
+            target = relationships.get(blip.get(f'{{{R_NS}}}embed'))
+            if target and target in names:
+                img_filename = save_archive_image(archive, target, images_dir)
+                parts.append(f"![Image](../images/{img_filename})")
+
+    text = ''.join(parts).strip()
+    if not text:
+        return level, ''
+    if level:
+        return level, '#' * min(level, 6) + ' ' + text
+    if paragraph.find(f'{{{W_NS}}}pPr/{{{W_NS}}}numPr') is not None:
+        return 0, '- ' + text
+    return 0, text
+
+
+def read_docx_chapters(docx_path, images_dir, split_level=1):
+    """Yield markdown chapters of a DOCX, split at heading-styled paragraphs."""
+    with zipfile.ZipFile(docx_path) as archive:
+        names = set(archive.namelist())
+        heading_levels = read_docx_styles(archive)
+
+        relationships = {}
+        rels_path = 'word/_rels/document.xml.rels'
+        if rels_path in names:
+            rels = ET.fromstring(archive.read(rels_path))
+            for rel in rels.iter(f'{{{PKG_REL_NS}}}Relationship'):
+                target = rel.get('Target', '')
+                if rel.get('TargetMode') != 'External':
+                    relationships[rel.get('Id')] = posixpath.normpath(posixpath.join('word', target))
+
+        chapter = []
+        with archive.open('word/document.xml') as document:
+            for _, element in ET.iterparse(document, events=('end',)):
+                if element.tag != f'{{{W_NS}}}p':
+                    continue
+                level, block = docx_paragraph_to_markdown(
+                    element, heading_levels, relationships, archive, images_dir, names)
+                element.clear()
+                if not block:
+                    continue
+                if level and level <= split_level and chapter:
+                    yield '\n\n'.join(chapter) + '\n'
+                    chapter = []
+                chapter.append(block)
+
+        if chapter:
+            yield '\n\n'.join(chapter) + '\n'
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+EPUB Writer
+Packs the rendered pages into an EPUB3 file: one XHTML document per chapter,
+nav.xhtml and the OPF spine built from the heading structure, and images
+under content-hashed names. Chapters and images are streamed into the zip
+one at a time. A sidecar index (output.epub.index.json) records the hash of
+every entry, so a rebuild copies the compressed bytes of unchanged entries
+from the previous package instead of recompressing and rereading them.
+"""
+
+import hashlib
+import html
+import json
+import mimetypes
+import re
+import struct
+import time
+import uuid
+import zipfile
+import zlib
+from html.parser import HTMLParser
+from pathlib import Path
+
+from atomic_io import atomic_path, atomic_write_text
+from chapter_html import link_headings, link_images, plan_chapters
+from markdown_renderer import HeadingIds, escape
+from merge_index import copy_range, file_source
+
+EPUB_FILENAME = "output.epub"
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+# Entries get a fixed timestamp so identical content gives identical bytes
+DOS_DATE = (2000 - 1980) << 9 | 1 << 5 | 1
+DOS_TIME = 0
+UTF8_NAMES = 0x800
+ZIP_LIMIT = 0xFFFFFFFF
+
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+XML_NAME = re.compile(r'[A-Za-z_][\w.-]*\Z')
+# Prefixes bound in every chapter; other prefixed names would not parse
+BOUND_PREFIXES = ('xml', 'epub')
+
+CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+
+XHTML_PAGE = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{lang}" xml:lang="{lang}">
+<head>
+<meta charset="utf-8" />
+<title>{title}</title>
+{links}</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def chapter_filename(number):
+    return f"chapter{number:04d}.xhtml"
+
+
+def index_path_for(epub_file):
+    epub_file = Path(epub_file)
+    return epub_file.with_name(epub_file.name + INDEX_SUFFIX)
+
+
+class XhtmlSerializer(HTMLParser):
+    """Re-serializes an HTML fragment as well-formed XHTML.
+
+    Raw HTML passed through from the markdown may leave elements unclosed or
+    close ones that were never opened: end tags close every element opened
+    after their start tag, stray end tags are dropped and whatever is still
+    open at the end is closed. Entities are decoded and text re-escaped.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.open = []
+
+    def _start(self, tag, attrs, close):
+        if not XML_NAME.match(tag):
+            self.parts.append(escape(self.get_starttag_text()))
+            return
+        seen = set()
+        rendered = []
+        for name, value in attrs:
+            prefix, _, local = name.rpartition(':')
+            if XML_NAME.match(local) and prefix in ('', *BOUND_PREFIXES) and name not in seen:
+                seen.add(name)
+                rendered.append(f' {name}="{escape(name if value is None else value)}"')
+        if close or tag in VOID_ELEMENTS:
+            self.parts.append(f"<{tag}{''.join(rendered)} />")
+        else:
+            self.parts.append(f"<{tag}{''.join(rendered)}>")
+            self.open.append(tag)
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, close=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, close=True)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open:
+            return
+        while self.open:
+            opened = self.open.pop()
+            self.parts.append(f"</{opened}>")
+            if opened == tag:
+                break
+
+    def handle_data(self, data):
+        self.parts.append(html.escape(data, quote=False))
+
+    def handle_comment(self, data):
+        # XML comments cannot hold '--' or end with '-'
+        self.parts.append(f"<!--{re.sub(r'-(?=-)', '- ', data).strip('-')}-->")
+
+    def xhtml(self):
+        self.close()
+        self.parts.extend(f"</{tag}>" for tag in reversed(self.open))
+        self.open = []
+        return ''.join(self.parts)
+
+
+def xhtml_safe(body):
+    """Make rendered HTML, including raw HTML from the pages, well-formed XHTML."""
+    serializer = XhtmlSerializer()
+    serializer.feed(body)
+    return serializer.xhtml()
+
+
+class ZipWriter:
+    """Minimal zip writer that streams entries and can copy compressed entries from another zip."""
+
+    def __init__(self, out):
+        self.out = out
+        self.entries = []
+
+    def _header(self, name, method, crc, compressed, size):
+        return struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, UTF8_NAMES, method, DOS_TIME, DOS_DATE,
+                           crc, compressed, size, len(name), 0) + name
+
+    def _start(self, name, method, crc=0, compressed=0, size=0):
+        offset = self.out.tell()
+        if offset > ZIP_LIMIT:
+            raise ValueError("EPUB is larger than 4 GB, which needs ZIP64")
+        name = name.encode('utf-8')
+        self.out.write(self._header(name, method, crc, compressed, size))
+        return name, offset
+
+    def _finish(self, name, offset, method, crc, compressed, size, patch):
+        if patch:
+            end = self.out.tell()
+            self.out.seek(offset)
+            self.out.write(self._header(name, method, crc, compressed, size))
+            self.out.seek(end)
+        self.entries.append((name, offset, method, crc, compressed, size))
+
+    def write(self, name, data, compress=True):
+        """Add an entry from bytes or text."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        crc = zlib.crc32(data)
+        method = zipfile.ZIP_STORED
+        if compress:
+            deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+            data, size = deflate.compress(data) + deflate.flush(), len(data)
+            method = zipfile.ZIP_DEFLATED
+        else:
+            size = len(data)
+        name, offset = self._start(name, method, crc, len(data), size)
+        self.out.write(data)
+        self._finish(name, offset, method, crc, len(data), size, patch=False)
+
+    def write_file(self, name, path, chunk_size=1024 * 1024):
+        """Add an entry by streaming a file without compressing it (images already are)."""
+        name, offset = self._start(name, zipfile.ZIP_STORED)
+        crc = size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                self.out.write(chunk)
+        self._finish(name, offset, zipfile.ZIP_STORED, crc, size, size, patch=True)
+
+    def copy(self, info, src):
+        """Copy an entry of the zip open as src (described by its ZipInfo) without recompressing it."""
+        src.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<2H', src.read(4))
+        data_offset = info.header_offset + 30 + name_length + extra_length
+        name, offset = self._start(info.filename, info.compress_type, info.CRC, info.compress_size, info.file_size)
+        copy_range(src, self.out, data_offset, info.compress_size)
+        self._finish(name, offset, info.compress_type, info.CRC, info.compress_size, info.file_size, patch=False)
+
+    def close(self):
+        start = self.out.tell()
+        for name, offset, method, crc, compressed, size in self.entries:
+            self.out.write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 20, UTF8_NAMES, method, DOS_TIME, DOS_DATE,
+                                       crc, compressed, size, len(name), 0, 0, 0, 0, 0, offset) + name)
+        end = self.out.tell()
+        if end > ZIP_LIMIT:
+            raise ValueError("EPUB is larger than 4 GB, which needs ZIP64")
+        self.out.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(self.entries), len(self.entries),
+                                   end - start, start, 0))
+
+
+class EpubPackage:
+    """Entries of the EPUB being written, reusing unchanged entries of the previous package."""
+
+    def __init__(self, epub_file, out):
+        self.epub_file = Path(epub_file)
+        self.zip = ZipWriter(out)
+        self.hashes = {}
+        self.images = {}
+        self.manifest = []
+        self.reused = 0
+        self.old_zip = self.old_file = None
+        self.old = {'entries': {}, 'images': {}}
+        index = self._load_index()
+        if index:
+            self.old = index
+            self.old_file = open(self.epub_file, 'rb')
+            self.old_zip = zipfile.ZipFile(self.old_file)
+
+    def _load_index(self):
+        """Return the index of the previous package if it still describes the file."""
+        try:
+            with open(index_path_for(self.epub_file), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            stat = self.epub_file.stat()
+        except (OSError, ValueError):
+            return None
+        if index.get('version') != INDEX_VERSION or index['size'] != stat.st_size \
+                or index['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return index
+
+    def _reuse(self, entry, digest):
+        """Copy the entry from the previous package if it has the same content there."""
+        if self.old['entries'].get(entry) != digest:
+            return False
+        try:
+            info = self.old_zip.getinfo(entry)
+        except KeyError:
+            return False
+        self.zip.copy(info, self.old_file)
+        self.reused += 1
+        return True
+
+    def add(self, name, data, media_type=None, item_id=None, properties=None):
+        """Add a document under OEBPS/ and, given a media type, to the OPF manifest."""
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        entry = f"OEBPS/{name}"
+        digest = hashlib.sha256(data).hexdigest()
+        self.hashes[entry] = digest
+        if not self._reuse(entry, digest):
+            self.zip.write(entry, data)
+        if media_type:
+            self.manifest.append((item_id, name, media_type, properties))
+
+    def image(self, source):
+        """Add an image under its content-hashed name once; return its path relative to OEBPS/."""
+        key = str(source)
+        identity = file_source(source)
+        known = self.old['images'].get(key)
+        if known and known[0] == identity:
+            name, digest = known[1], known[2]
+        else:
+            digest = hashlib.sha256(Path(source).read_bytes()).hexdigest()
+            name = f"images/{digest[:16]}{Path(source).suffix.lower()}"
+        self.images[key] = [identity, name, digest]
+        entry = f"OEBPS/{name}"
+        if entry not in self.hashes:
+            self.hashes[entry] = digest
+            if not self._reuse(entry, digest):
+                self.zip.write_file(entry, source)
+            media_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            self.manifest.append((f"img-{digest[:16]}", name, media_type, None))
+        return name
+
+    def close(self):
+        self.zip.close()
+        if self.old_zip:
+            self.old_zip.close()
+            self.old_file.close()
+
+    def save_index(self):
+        stat = self.epub_file.stat()
+        atomic_write_text(index_path_for(self.epub_file), json.dumps(
+            {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'entries': self.hashes, 'images': self.images}, ensure_ascii=False))
+
+
+def nav_list(entries):
+    """Nested <ol> for nav.xhtml from (level, href, text) entries."""
+    lines = ['<ol>']
+    levels = []
+    for level, href, text in entries:
+        if levels and level > levels[-1]:
+            lines.append('<ol>')
+            levels.append(level)
+        elif levels:
+            lines.append('</li>')
+            while len(levels) > 1 and level < levels[-1]:
+                levels.pop()
+                lines.append('</ol>\n</li>')
+        else:
+            levels.append(level)
+        lines.append(f'<li><a href="{href}">{escape(text)}</a>')
+    if levels:
+        lines.append('</li>')
+    lines.extend(['</ol>\n</li>'] * (len(levels) - 1))
+    lines.append('</ol>')
+    return '\n'.join(lines)
+
+
+def package_document(package, title, lang, identifier, chapters):
+    items = '\n'.join(f'<item id="{item_id}" href="{escape(href)}" media-type="{media_type}"'
+                      + (f' properties="{properties}"' if properties else '') + '/>'
+                      for item_id, href, media_type, properties in package.manifest)
+    spine = '\n'.join(f'<itemref idref="chapter{number:04d}"/>' for number in range(1, chapters + 1))
+    modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="{lang}">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="book-id">urn:uuid:{identifier}</dc:identifier>
+<dc:title>{escape(title)}</dc:title>
+<dc:language>{lang}</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>
+{items}
+</manifest>
+<spine>
+{spine}
+</spine>
+</package>
+"""
+
+
+def write_epub(fragments, epub_file, base_dir, title, lang, book_id, css=None, assets=None):
+    """Write the book as an EPUB3 package; return (chapters, entries, entries reused).
+
+    fragments() returns a fresh iterator of (page, fragment, heading ids) and
+    is read twice, once to plan chapters and once to write them. Images are
+    resolved relative to base_dir and replaced by their processed versions
+    from assets if given; css is an optional stylesheet path.
+    """
+    epub_file = Path(epub_file)
+    chapters, locations, toc = plan_chapters(fragments())
+    identifier = uuid.uuid5(uuid.NAMESPACE_URL, str(book_id))
+    links = '<link rel="stylesheet" type="text/css" href="style.css" />\n' if css else ''
+
+    with atomic_path(epub_file) as tmp_epub, open(tmp_epub, 'wb') as out:
+        package = EpubPackage(epub_file, out)
+        try:
+            # The mimetype entry comes first and uncompressed so readers can identify the file
+            package.zip.write("mimetype", "application/epub+zip", compress=False)
+            package.zip.write("META-INF/container.xml", CONTAINER_XML)
+            if css:
+                package.add("style.css", Path(css).read_bytes(), "text/css", "css")
+
+            heading_ids = HeadingIds()
+            pages = fragments()
+            for number, chapter in enumerate(chapters, 1):
+                parts = []
+                for page in chapter['pages']:
+                    _, fragment, ids = next(pages)
+                    if parts:
+                        parts.append("\n<hr />\n")
+                    parts.append(f"<!-- page: {page} -->\n")
+                    parts.append(heading_ids.fill(fragment, ids))
+                body = link_headings(link_images(''.join(parts), package, base_dir, lazy=False, assets=assets), locations, number,
+                                     chapter_filename)
+                page_xhtml = XHTML_PAGE.format(lang=lang, title=escape(chapter['title'] or f"{title} ({number})"),
+                                               links=links, body=xhtml_safe(body))
+                package.add(chapter_filename(number), page_xhtml, "application/xhtml+xml", f"chapter{number:04d}")
+            # Let the fragment iterator finish so it can prune the render cache
+            for _ in pages:
+                pass
+
+            # Headings make the table of contents; books without any list their chapters
+            entries = [(level, f"{chapter_filename(number)}#{heading_id}", text)
+                       for level, heading_id, text, number in toc]
+            if not entries:
+                entries = [(1, chapter_filename(number), chapter['title'] or f"{title} ({number})")
+                           for number, chapter in enumerate(chapters, 1)]
+            nav = XHTML_PAGE.format(lang=lang, title=escape(title), links='', body=(
+                f'<nav epub:type="toc" id="toc">\n<h1>{escape(title)}</h1>\n{nav_list(entries)}\n</nav>'))
+            package.add("nav.xhtml", nav, "application/xhtml+xml", "nav", "nav")
+            package.add("content.opf", package_document(package, title, lang, identifier, len(chapters)))
+        finally:
+            package.close()
+    package.save_index()
+    return len(chapters), len(package.zip.entries), package.reused
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Heading Index
+Sidecar index of the headings in output.md (output.md.headings.json),
+written by step 4 right after the merge: level, plain text, final id,
+source page and byte offset of every heading. Headings are found with the
+builtin renderer's own block parser and ids assigned the way it assigns
+them, so step 5 can put the table of contents into output.html while
+rendering it and step 6 has nothing left to parse. Pages are keyed by their
+content hash, so only changed pages are parsed again.
+"""
+
+import json
+from pathlib import Path
+
+from atomic_io import atomic_write_text
+from markdown_renderer import RENDERER_VERSION, HeadingIds, escape, page_headings
+
+HEADINGS_SUFFIX = ".headings.json"
+HEADINGS_VERSION = 1
+
+# Larger tables of contents start with their sections collapsed
+COLLAPSE_THRESHOLD = 200
+
+
+def headings_path_for(output_file):
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.name + HEADINGS_SUFFIX)
+
+
+def _read_heading_file(output_file):
+    try:
+        with open(headings_path_for(output_file), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != HEADINGS_VERSION or data.get('renderer') != RENDERER_VERSION:
+        return None
+    return data
+
+
+def page_heading_entries(text):
+    """Return [level, text, base id, explicit, byte offset of its line] for the headings of one page."""
+    entries = []
+    position = 0
+    for level, content, base, explicit, source in page_headings(text):
+        # Headings are found in order, so each one's text is searched after the previous one
+        found = text.find(source, position) if source else -1
+        if found >= 0:
+            position = text.rfind('\n', 0, found) + 1
+        entries.append([level, content, base, explicit, len(text[:position].encode('utf-8'))])
+    return entries
+
+
+def build_heading_index(output_file, index):
+    """Write the heading index of output_file from its merge index; return the headings.
+
+    Pages whose content hash is unchanged reuse their entries from the
+    previous heading index instead of being parsed again.
+    """
+    output_file = Path(output_file)
+    old = _read_heading_file(output_file)
+    cached = {(page['page'], page['hash']): page['headings'] for page in old['pages']} if old else {}
+
+    pages = []
+    parsed = 0
+    with open(output_file, 'rb') as f:
+        for entry in index['pages']:
+            entries = cached.get((entry['page'], entry['hash']))
+            if entries is None:
+                f.seek(entry['offset'])
+                entries = page_heading_entries(f.read(entry['length']).decode('utf-8'))
+                parsed += 1
+            pages.append({'page': entry['page'], 'hash': entry['hash'], 'offset': entry['offset'],
+                          'headings': entries})
+
+    # Final ids are unique across the book, exactly as the renderer fills them in
+    heading_ids = HeadingIds()
+    headings = []
+    for page in pages:
+        for level, text, base, explicit, offset in page['headings']:
+            headings.append({'level': level, 'text': text, 'id': heading_ids.assign(base, explicit),
+                             'page': page['page'], 'offset': page['offset'] + offset})
+
+    stat = output_file.stat()
+    atomic_write_text(headings_path_for(output_file), json.dumps(
+        {'version': HEADINGS_VERSION, 'renderer': RENDERER_VERSION, 'size': stat.st_size,
+         'mtime_ns': stat.st_mtime_ns, 'pages': pages, 'headings': headings}, ensure_ascii=False))
+    print(f"Indexed {len(headings)} headings ({parsed} of {len(pages)} pages parsed)")
+    return headings
+
+
+def load_headings(output_file):
+    """Return the headings of output_file, or None if the index is missing or no longer describes the file."""
+    data = _read_heading_file(output_file)
+    try:
+        stat = Path(output_file).stat()
+    except OSError:
+        return None
+    if data is None or data['size'] != stat.st_size or data['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    return data['headings']
+
+
+def nested_toc(headings, href=lambda heading: f"#{heading['id']}"):
+    """Return the TOC as nested lists; entries with subsections fold with <details>.
+
+    The folded sections are not laid out until opened, so a book with
+    thousands of headings keeps a cheap page. Levels may skip (h1 -> h3).
+    """
+    opened = ' open' if len(headings) <= COLLAPSE_THRESHOLD else ''
+    lines = ['<div id="table-of-contents">', '<h2>Table of Contents</h2>', '<ul>']
+    # Levels of the entries whose lists of subsections are still open
+    stack = []
+    for number, heading in enumerate(headings):
+        while stack and stack[-1] >= heading['level']:
+            stack.pop()
+            lines.append(f'{"  " * len(stack)}</ul></details></li>')
+        indent = '  ' * len(stack)
+        link = f'<a href="{escape(href(heading))}">{escape(heading["text"])}</a>'
+        following = headings[number + 1] if number + 1 < len(headings) else None
+        if following and following['level'] > heading['level']:
+            lines.append(f'{indent}<li><details{opened}><summary>{link}</summary><ul>')
+            stack.append(heading['level'])
+        else:
+            lines.append(f'{indent}<li>{link}</li>')
+    while stack:
+        stack.pop()
+        lines.append(f'{"  " * len(stack)}</ul></details></li>')
+    lines += ['</ul>', '</div>']
+    return '\n'.join(lines) + '\n'
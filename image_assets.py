@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Image Assets
+Prepares the book's images for output: each image is downscaled to a
+maximum display width, stripped of metadata and re-encoded as WebP or JPEG
+when that is smaller, in a process pool. Results are cached in
+asset_cache/ under the hash of the source image and the processing
+settings, and linked into output/images under those content-addressed
+names, so unchanged images are neither processed nor copied again.
+
+Without Pillow images are passed through unchanged, still content-addressed.
+"""
+
+import base64
+import hashlib
+import importlib.util
+import io
+import json
+import mimetypes
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from atomic_io import atomic_write_bytes, atomic_write_text
+from merge_index import file_source
+
+# Optional dependencies are only imported by the functions that need them
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+ASSET_CACHE_DIRNAME = "asset_cache"
+SOURCES_FILENAME = "sources.json"
+FILTER_FILENAME = "images.lua"
+
+# Bump when processing changes so cached results are redone
+ASSET_VERSION = 2
+
+# Wider images are scaled down to this many pixels
+MAX_DISPLAY_WIDTH = 1600
+QUALITY = 82
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+
+# Image.info keys that carry metadata rather than pixels
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'icc_profile', 'comment', 'photoshop')
+
+
+def link_or_copy(source, target):
+    """Hard-link source to target, copying where the filesystem does not allow links."""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def asset_params(max_width=MAX_DISPLAY_WIDTH, quality=QUALITY):
+    """Settings that change processed output; part of every cache key."""
+    return {'version': ASSET_VERSION, 'max_width': max_width, 'quality': quality, 'pillow': PIL_AVAILABLE}
+
+
+def encode_candidates(data, max_width, quality):
+    """Return {extension: bytes} of the encodings worth considering for one image."""
+    from PIL import Image, ImageOps, features
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        original = (image.format or '').lower()
+        if getattr(image, 'is_animated', False):
+            # Re-encoding would keep only the first frame; the caller keeps the original
+            return {}
+        has_metadata = any(key in image.info for key in METADATA_KEYS)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        # Apply the EXIF orientation before the tag is dropped with the rest of the metadata
+        image = ImageOps.exif_transpose(image)
+        resized = image.width > max_width
+        if resized:
+            height = max(1, round(image.height * max_width / image.width))
+            image = image.resize((max_width, height), Image.LANCZOS)
+
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        candidates = {}
+        # The original bytes are only kept when they are full size and carry no metadata
+        if not resized and not has_metadata and original in ('png', 'jpeg', 'webp', 'gif'):
+            candidates['jpg' if original == 'jpeg' else original] = data
+        if features.check('webp'):
+            buffer = io.BytesIO()
+            image.save(buffer, 'WEBP', quality=quality, method=4)
+            candidates['webp'] = buffer.getvalue()
+        if not has_alpha:
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+            candidates['jpg'] = min(candidates.get('jpg', buffer.getvalue()), buffer.getvalue(), key=len)
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG', optimize=True)
+        candidates['png'] = min(candidates.get('png', buffer.getvalue()), buffer.getvalue(), key=len)
+    return candidates
+
+
+def process_image(task):
+    """Write the smallest encoding of one image to the cache; return its filename."""
+    source, cache_dir, key, max_width, quality = task
+    data = Path(source).read_bytes()
+    candidates = {}
+    if PIL_AVAILABLE:
+        try:
+            candidates = encode_candidates(data, max_width, quality)
+        except (OSError, ValueError) as e:
+            print(f"Keeping {Path(source).name} unprocessed: {e}")
+    if not candidates:
+        candidates = {Path(source).suffix.lower().lstrip('.') or 'bin': data}
+
+    extension = min(candidates, key=lambda ext: len(candidates[ext]))
+    name = f"{key}.{extension}"
+    atomic_write_bytes(Path(cache_dir) / name, candidates[extension])
+    return name
+
+
+def prepare_images(temp_dir, images_dir=None, workers=None, max_width=MAX_DISPLAY_WIDTH, quality=QUALITY):
+    """Process the images of a book, reusing cached results.
+
+    Returns {resolved source image path: processed image path in the cache}.
+    """
+    # Sources are resolved so pages can look them up from any relative reference
+    images_dir = Path(images_dir or Path(temp_dir) / "images").resolve()
+    cache_dir = Path(temp_dir) / ASSET_CACHE_DIRNAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    sources = sorted(p for p in images_dir.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES) \
+        if images_dir.exists() else []
+
+    # Source hashes are remembered by file identity so unchanged images are not reread
+    sources_file = cache_dir / SOURCES_FILENAME
+    try:
+        known = json.loads(sources_file.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        known = {}
+    params = json.dumps(asset_params(max_width, quality), sort_keys=True)
+    params_digest = hashlib.sha256(params.encode('utf-8')).hexdigest()[:8]
+
+    hashes = {}
+    keys = {}
+    for source in sources:
+        identity = file_source(source)
+        entry = known.get(source.name)
+        if entry and entry[0] == identity:
+            hashes[source.name] = entry
+        else:
+            hashes[source.name] = [identity, hashlib.sha256(source.read_bytes()).hexdigest()]
+        keys[source] = f"{hashes[source.name][1][:32]}-{params_digest}"
+
+    cached = {path.stem: path for path in cache_dir.iterdir() if path.name not in (SOURCES_FILENAME, FILTER_FILENAME)}
+    assets = {}
+    pending = {}
+    for source, key in keys.items():
+        if key in cached:
+            assets[source] = cached[key]
+        else:
+            pending.setdefault(key, []).append(source)
+
+    if pending:
+        workers = workers or os.cpu_count() or 1
+        print(f"Processing {len(pending)} images with {workers} workers...")
+        tasks = [(str(sources_for_key[0]), str(cache_dir), key, max_width, quality)
+                 for key, sources_for_key in pending.items()]
+        if workers == 1 or len(tasks) == 1:
+            names = [process_image(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+                names = list(executor.map(process_image, tasks))
+        for sources_for_key, name in zip(pending.values(), names):
+            for source in sources_for_key:
+                assets[source] = cache_dir / name
+
+    # Results for images no longer in the book are dropped
+    used = {path.name for path in assets.values()}
+    for path in cached.values():
+        if path.name not in used:
+            path.unlink(missing_ok=True)
+    atomic_write_text(sources_file, json.dumps(hashes))
+
+    original_bytes = sum(identity[0] for identity, _ in hashes.values())
+    processed_bytes = sum(path.stat().st_size for path in set(assets.values()))
+    if sources:
+        print(f"Prepared {len(sources)} images ({len(sources) - sum(map(len, pending.values()))} cached): "
+              f"{original_bytes / 1e6:.1f} MB -> {processed_bytes / 1e6:.1f} MB")
+    return assets
+
+
+def sync_images(assets, dest_dir):
+    """Link processed images into dest_dir, touching only new files and removing stale ones.
+
+    Returns the number of files linked or copied.
+    """
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    wanted = {path.name: path for path in assets.values()}
+    changed = 0
+    for name, path in wanted.items():
+        # Names are content-addressed, so an existing file already has the right content
+        if not (dest_dir / name).exists():
+            link_or_copy(path, dest_dir / name)
+            changed += 1
+    for path in dest_dir.iterdir():
+        if path.name not in wanted:
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+    return changed
+
+
+class EmbeddedImages:
+    """Maps images to data: URIs, for a single output.html that needs no other files (like pandoc --self-contained)."""
+
+    def __init__(self):
+        self.uris = {}
+
+    def image(self, source):
+        source = Path(source)
+        if source not in self.uris:
+            mime = mimetypes.guess_type(source.name)[0] or "application/octet-stream"
+            data = base64.b64encode(source.read_bytes()).decode('ascii')
+            self.uris[source] = f"data:{mime};base64,{data}"
+        return self.uris[source]
+
+
+def pandoc_image_filter(assets, temp_dir, output_dir):
+    """Write a pandoc Lua filter pointing the book's image references at the processed images."""
+    filter_file = Path(temp_dir) / ASSET_CACHE_DIRNAME / FILTER_FILENAME
+    lines = ["local assets = {"]
+    for source, path in sorted(assets.items()):
+        target = json.dumps(str((Path(output_dir) / "images" / path.name).resolve()), ensure_ascii=False)
+        # Pages refer to images as ../images/<name> relative to pages/ and output/
+        for reference in (f"../images/{source.name}", f"images/{source.name}"):
+            lines.append(f"  [{json.dumps(reference, ensure_ascii=False)}] = {target},")
+    lines += ["}", "", "function Image(image)", "  local target = assets[image.src]",
+              "  if target then", "    image.src = target", "  end", "  return image", "end", ""]
+    atomic_write_text(filter_file, '\n'.join(lines))
+    return filter_file
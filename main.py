@@ -4,29 +4,35 @@ Main pipeline script to run all steps sequentially.
 """
 
 import argparse
-import subprocess
 import sys
 from pathlib import Path
 
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
 
-def run_step(script_name, args_list, description):
-    """Run a pipeline step and check for success."""
-    print(f"\n{'='*60}")
-    print(f"Running {description}")
-    print(f"{'='*60}")
-    
-    cmd = [sys.executable, script_name] + args_list
-    
-    try:
-        result = subprocess.run(cmd, check=True)
-        print(f"✓ {description} completed successfully")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"✗ {description} failed with exit code {e.returncode}")
-        return False
-    except FileNotFoundError:
-        print(f"✗ Script {script_name} not found")
-        return False
+from pipeline import RunContext, run_steps, temp_dir_for
+from build_graph import BuildGraph
+from markdown_splitter import DEFAULT_MAX_PAGE_CHARS
+from merge_index import index_path_for
+from progress import start_progress, stop_progress
+from step5_convert_html import RenderMemo
+from streaming import DEFAULT_TRANSLATE_WORKERS, run_streaming
+from tracing import add_trace_arguments, span, start_tracing, stop_tracing, trace_file_for
+from watcher import watch
+
+
+def run_selected_steps(ctx, args):
+    """Run the requested steps (streaming 2-4 if asked); return the failed step or 0."""
+    if args.stream and args.start_step <= 2:
+        failed_step = run_steps(ctx, args.start_step, 1)
+        if not failed_step:
+            with span("Streaming steps 2-4", "step"):
+                if not run_streaming(ctx, args.translate_workers):
+                    failed_step = 2
+        if not failed_step:
+            failed_step = run_steps(ctx, 5)
+        return failed_step
+    return run_steps(ctx, args.start_step)
 
 
 def main():
@@ -38,6 +44,39 @@ def main():
     parser.add_argument("--api-key", help="SiliconFlow API密钥 (或设置SILICONFLOW_API_KEY环境变量)")
     parser.add_argument("--start-step", type=int, default=1, choices=range(1, 7), 
                        help="Start from specific step (1-6)")
+    parser.add_argument("--split-level", type=int, default=1, choices=range(1, 7),
+                       help="Split markdown/DOCX/EPUB at headings up to this level (default: 1)")
+    parser.add_argument("--max-page-chars", type=int, default=DEFAULT_MAX_PAGE_CHARS,
+                       help="Sub-split pages larger than this many characters (0 disables)")
+    parser.add_argument("--reader", choices=["native", "pandoc"], default="native",
+                       help="DOCX/EPUB reader (default: native)")
+    parser.add_argument("--workers", type=int, help="Worker processes for EPUB chapters, OCR and images, and parallel pandoc renders")
+    parser.add_argument("--no-ocr", action="store_true", help="Do not OCR PDF pages without a text layer")
+    parser.add_argument("--renderer", choices=["auto", "builtin", "pandoc"], default="auto",
+                       help="Step 5 renderer: in-process with a per-page cache, pandoc for its exact output, or auto "
+                            "(builtin unless the book uses pandoc-only syntax such as ::: divs or footnotes; default: auto)")
+    parser.add_argument("--html-layout", choices=["single", "chapters", "epub"], default="single",
+                       help="single: one output.html; chapters: a file per chapter plus index.html in output/html; "
+                            "epub: output.epub (default: single)")
+    parser.add_argument("--stream", action="store_true",
+                       help="Overlap steps 2-4: translate pages while extracting, merge as they finish (needs --api)")
+    parser.add_argument("--translate-workers", type=int, default=DEFAULT_TRANSLATE_WORKERS,
+                       help=f"Concurrent translation requests in --stream mode (default: {DEFAULT_TRANSLATE_WORKERS})")
+    parser.add_argument("--force", action="store_true",
+                       help="Ignore recorded build state and rebuild every artifact")
+    add_trace_arguments(parser)
+    parser.add_argument("--resume", action="store_true",
+                       help="Continue an interrupted run: retranslate only failed and in-flight pages, then steps 4-6")
+    parser.add_argument("--packed", action="store_true",
+                       help="Keep pages, translations and images in one workspace.sqlite file instead of many small files")
+    parser.add_argument("--progress", action="store_true",
+                       help="Show a live status line: pages done, pages/s, tokens/s, requests in flight and ETA")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                       help="Keep Prometheus text-format metrics of the run in FILE (for node_exporter's textfile collector)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                       help="Serve Prometheus metrics of the run on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--watch", action="store_true",
+                       help="After the run, rebuild steps 4-6 whenever files in pages/ or output/ change (Ctrl+C stops)")
     
     args = parser.parse_args()
     
@@ -46,48 +85,90 @@ def main():
     if not input_path.exists():
         print(f"Error: Input file {args.input} does not exist.")
         return 1
+    if args.html_layout != "single" and args.renderer == "pandoc":
+        print(f"Error: --html-layout {args.html_layout} is only written by the builtin renderer")
+        return 1
+    if args.packed and args.stream:
+        print("Error: --stream works on page files and cannot be combined with --packed")
+        return 1
+    if args.packed and args.watch:
+        print("Error: --watch works on page files and cannot be combined with --packed")
+        return 1
     
-    # Determine temp directory
-    temp_dir = input_path.parent / f"{input_path.stem}_temp"
+    ctx = RunContext(
+        temp_dir=temp_dir_for(input_path),
+        input_file=input_path,
+        input_lang=args.lang or "auto",
+        output_lang=args.olang,
+        use_api=args.api,
+        api_key=args.api_key,
+        split_level=args.split_level,
+        max_page_chars=args.max_page_chars,
+        reader=args.reader,
+        workers=args.workers,
+        ocr=not args.no_ocr,
+        renderer=args.renderer,
+        html_layout=args.html_layout,
+        resume=args.resume,
+        packed=args.packed,
+        profile=args.profile,
+    )
+    if args.resume:
+        if (ctx.temp_dir / "config.txt").exists():
+            # Pages are already extracted; the run journal says what is left to translate
+            args.start_step = max(args.start_step, 3)
+        else:
+            print(f"Nothing to resume in {ctx.temp_dir}, starting a full run")
+    if args.start_step > 1:
+        ctx.reload_config()
+        if args.watch and ctx.packed:
+            print("Error: --watch works on page files, but this workspace is packed")
+            return 1
+    if args.watch:
+        # Step 5 keeps its work in memory so the first edit is rebuilt as fast as the rest
+        ctx.render_memo = RenderMemo()
+    if args.force and ctx.temp_dir.exists():
+        BuildGraph(ctx.temp_dir).reset()
+        index_path_for(ctx.output_dir / "output.md").unlink(missing_ok=True)
     
-    # Build step1 arguments
-    step1_args = ["-i", args.input, "--olang", args.olang]
-    if args.lang:
-        step1_args.extend(["-l", args.lang])
+    trace_file = trace_file_for(args.trace, ctx.temp_dir)
+    if trace_file:
+        start_tracing()
+    track_progress = args.progress or args.metrics_file or args.metrics_port is not None
+    if track_progress:
+        start_progress({'book': input_path.name}, args.metrics_file, args.metrics_port, args.progress)
     
-    steps = [
-        ("step1_init.py", step1_args, 
-         "Step 1: Environment Initialization"),
-        ("step2_split_pdf.py", [str(temp_dir)], 
-         "Step 2: Split/Convert Ebook"),
-        ("step3_translate.py", [str(temp_dir)] + (["--api"] if args.api else []) + 
-         (["--api-key", args.api_key] if args.api_key else []), 
-         "Step 3: Translate Markdown"),
-        ("step4_merge_md.py", [str(temp_dir)], 
-         "Step 4: Merge Markdown Files"),
-        ("step5_convert_html.py", [str(temp_dir)], 
-         "Step 5: Convert to HTML"),
-        ("step6_generate_toc.py", [str(temp_dir)], 
-         "Step 6: Generate Table of Contents")
-    ]
+    # Run steps starting from specified step, all in this process
+    try:
+        failed_step = run_selected_steps(ctx, args)
+    finally:
+        if track_progress:
+            stop_progress()
+        if trace_file:
+            stop_tracing(trace_file)
+        if args.profile:
+            for name, value in sorted(ctx.metrics.items()):
+                print(f"  {name}: {value:.2f}")
     
-    # Run steps starting from specified step
-    for i, (script, script_args, description) in enumerate(steps[args.start_step-1:], args.start_step):
-        # Clean up script_args - remove empty strings
-        script_args = [arg for arg in script_args if arg]
-        
-        if not run_step(script, script_args, description):
-            print(f"\nPipeline failed at step {i}")
-            return 1
+    if failed_step:
+        print(f"\nPipeline failed at step {failed_step}")
+        return 1
     
     print(f"\n{'='*60}")
     print("🎉 EBOOK TRANSLATION PIPELINE COMPLETED SUCCESSFULLY! 🎉")
     print(f"{'='*60}")
-    print(f"Output files are in: {temp_dir / 'output'}")
-    print(f"Final HTML file: {temp_dir / 'output' / 'output.html'}")
+    print(f"Output files are in: {ctx.output_dir}")
+    if args.html_layout == "chapters":
+        print(f"Chapter index: {ctx.output_dir / 'html' / 'index.html'}")
+    elif args.html_layout == "epub":
+        print(f"EPUB file: {ctx.output_dir / 'output.epub'}")
+    else:
+        print(f"Final HTML file: {ctx.output_dir / 'output.html'}")
     
+    if args.watch:
+        return watch(ctx)
     return 0
 
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())
@@ -0,0 +1,821 @@
+#!/usr/bin/env python3
+"""
+Markdown Renderer
+In-process CommonMark renderer used by step 5 instead of pandoc. It covers
+the constructs ebooks produce (ATX/setext headings, paragraphs, emphasis,
+code spans and blocks, links, images, lists, block quotes, raw HTML, pipe
+tables, thematic breaks) and follows pandoc's HTML conventions where
+step 6 and template.html depend on them:
+
+- heading ids use pandoc's auto_identifiers rules (`# Hello, World!` ->
+  `hello-world`, CJK kept, `section` when empty, `-1`, `-2` for
+  duplicates) and `{#id}` attributes are honoured
+- a paragraph holding only an image becomes a <figure> with a caption
+- fenced code is rendered like `pandoc --no-highlight`
+
+Pandoc's own extensions are not implemented: fenced divs (`:::`),
+attributes on images, links and spans (`{width="50%"}`) and footnotes
+(`[^1]`). find_pandoc_syntax() detects them so step 5 can use pandoc.
+
+Rendering a page returns an HTML fragment whose heading ids are
+placeholders, so fragments can be cached per page and ids made unique
+across the whole book when the document is assembled.
+"""
+
+import html
+import re
+import unicodedata
+
+# Bump when the rendered HTML changes so cached fragments are discarded
+RENDERER_VERSION = 2
+
+# Stands in for a heading id inside a cached fragment (NUL never survives rendering)
+ID_PLACEHOLDER = "\x00id\x00"
+
+ESCAPABLE = set('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~')
+
+ATX_HEADING = re.compile(r'^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+SETEXT_UNDERLINE = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+THEMATIC_BREAK = re.compile(r'^ {0,3}(?:(?:\*[ \t]*){3,}|(?:-[ \t]*){3,}|(?:_[ \t]*){3,})$')
+FENCE_OPEN = re.compile(r'^( {0,3})(`{3,}|~{3,})[ \t]*([^`]*?)[ \t]*$')
+BLOCKQUOTE = re.compile(r'^ {0,3}> ?')
+LIST_ITEM = re.compile(r'^( {0,3})([*+-]|\d{1,9}[.)])([ \t]+|$)')
+LINK_DEFINITION = re.compile(r'^ {0,3}\[(?!\^)([^\]]+)\]:[ \t]*<?([^\s>]*)>?(?:[ \t]+("[^"]*"|\'[^\']*\'|\([^)]*\)))?[ \t]*$')
+TABLE_DELIMITER = re.compile(r'^ {0,3}\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$')
+HEADING_ATTRIBUTES = re.compile(r'[ \t]*\{#([\w:.\-]+)[^}]*\}[ \t]*$')
+
+# Pandoc extensions this renderer leaves as text, with how they are recognized
+PANDOC_ONLY_SYNTAX = [
+    ("fenced divs (:::)", re.compile(r'^ {0,3}:::')),
+    ("attributes on images, links or spans ({...})", re.compile(r'\]\([^()\s]*(?:[ \t]+"[^"]*")?\)\{|\]\{')),
+    ("footnotes ([^...])", re.compile(r'\[\^[^\]\s]+\]')),
+]
+
+BLOCK_TAGS = ("address|article|aside|base|basefont|blockquote|body|caption|center|col|colgroup|dd|details|"
+              "dialog|dir|div|dl|dt|fieldset|figcaption|figure|footer|form|frame|frameset|h[1-6]|head|"
+              "header|hr|html|iframe|legend|li|link|main|menu|menuitem|nav|noframes|ol|optgroup|option|p|"
+              "param|search|section|summary|table|tbody|td|tfoot|th|thead|title|tr|track|ul")
+
+# (start, end) of the raw HTML block kinds; end None means the block ends at a blank line
+HTML_BLOCKS = [
+    (re.compile(r'^ {0,3}<(?:script|pre|style|textarea)(?:\s|>|$)', re.I),
+     re.compile(r'</(?:script|pre|style|textarea)>', re.I)),
+    (re.compile(r'^ {0,3}<!--'), re.compile(r'-->')),
+    (re.compile(r'^ {0,3}<\?'), re.compile(r'\?>')),
+    (re.compile(r'^ {0,3}<![A-Za-z]'), re.compile(r'>')),
+    (re.compile(r'^ {0,3}<!\[CDATA\['), re.compile(r'\]\]>')),
+    (re.compile(rf'^ {{0,3}}</?(?:{BLOCK_TAGS})(?:\s|/?>|$)', re.I), None),
+]
+# Any other complete tag on its own line starts a block, but cannot interrupt a paragraph
+HTML_BLOCK_OTHER = re.compile(r'^ {0,3}(?:<[A-Za-z][A-Za-z0-9-]*(?:\s+[^<>]*)?/?>|</[A-Za-z][A-Za-z0-9-]*\s*>)[ \t]*$')
+
+AUTOLINK = re.compile(r'<([A-Za-z][A-Za-z0-9+.\-]{1,31}:[^\s<>]*)>')
+EMAIL_AUTOLINK = re.compile(r'<([A-Za-z0-9.!#$%&\'*+/=?^_`{|}~\-]+@[A-Za-z0-9](?:[A-Za-z0-9\-]*[A-Za-z0-9])?'
+                            r'(?:\.[A-Za-z0-9](?:[A-Za-z0-9\-]*[A-Za-z0-9])?)*)>')
+INLINE_HTML = re.compile(r'<(?:[A-Za-z][A-Za-z0-9-]*(?:\s+[A-Za-z_:][\w.:\-]*(?:\s*=\s*(?:[^\s"\'=<>`]+|\'[^\']*\'|"[^"]*"))?)*\s*/?>'
+                         r'|/[A-Za-z][A-Za-z0-9-]*\s*>|!--[\s\S]*?-->|\?[\s\S]*?\?>|![A-Za-z][^>]*>|!\[CDATA\[[\s\S]*?\]\]>)')
+ENTITY = re.compile(r'&(?:#[xX][0-9a-fA-F]{1,6}|#[0-9]{1,7}|[A-Za-z][A-Za-z0-9]{1,31});')
+INLINE_LINK = re.compile(r'\(\s*(<[^<>\n]*>|(?:[^\s()\\]|\\.|\([^\s()]*\))*)'
+                         r'(?:\s+("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|\((?:[^()\\]|\\.)*\)))?\s*\)')
+REFERENCE_LABEL = re.compile(r'\[((?:[^\[\]\\]|\\.){0,999})\]')
+TAG = re.compile(r'<[^>]*>')
+
+
+def escape(text):
+    return html.escape(text, quote=True).replace('&#x27;', "'")
+
+
+def unescape_backslashes(text):
+    return re.sub(r'\\([!-/:-@\[-`{-~])', r'\1', text)
+
+
+def normalize_label(label):
+    return ' '.join(label.split()).casefold()
+
+
+def is_punctuation(char):
+    return char in ESCAPABLE or unicodedata.category(char)[0] in 'PS'
+
+
+def expand_tabs(line):
+    return line.expandtabs(4) if '\t' in line else line
+
+
+def indentation(line):
+    return len(line) - len(line.lstrip(' '))
+
+
+def pandoc_identifier(text):
+    """Heading id by pandoc's auto_identifiers rules, from the heading's plain text."""
+    text = ' '.join(text.split())
+    kept = ''.join(c for c in text if c.isalnum() or c in '_-. ')
+    kept = kept.replace(' ', '-').lower()
+    while kept and not kept[0].isalpha():
+        kept = kept[1:]
+    return kept or "section"
+
+
+def plain_text(fragment):
+    """Text content of rendered inline HTML."""
+    return html.unescape(TAG.sub('', fragment))
+
+
+class _Delimiter:
+    """A run of * or _ that may open or close emphasis."""
+
+    def __init__(self, char, count, can_open, can_close):
+        self.char = char
+        self.count = self.original = count
+        self.can_open = can_open
+        self.can_close = can_close
+
+    def text(self):
+        return self.char * self.count
+
+
+class _Bracket:
+    """An unmatched [ or ![ that may start a link or image."""
+
+    def __init__(self, image, position):
+        self.image = image
+        self.position = position
+        self.active = True
+
+    def text(self):
+        return '![' if self.image else '['
+
+
+class Renderer:
+    """Render one page of markdown to an HTML fragment with placeholder heading ids."""
+
+    def __init__(self):
+        self.definitions = {}
+        self.heading_ids = []
+
+    # Block structure
+
+    def parse_blocks(self, lines):
+        """Parse lines into a list of block nodes (tuples whose first item is the kind)."""
+        blocks = []
+        i = 0
+        paragraph = []
+
+        def close_paragraph():
+            if paragraph:
+                self._add_paragraph(blocks, paragraph[:])
+                paragraph.clear()
+
+        while i < len(lines):
+            line = lines[i]
+            if not line.strip():
+                close_paragraph()
+                i += 1
+                continue
+
+            if paragraph:
+                underline = SETEXT_UNDERLINE.match(line)
+                if underline and not self._only_definitions(paragraph):
+                    level = 1 if underline.group(1)[0] == '=' else 2
+                    self._add_paragraph(blocks, paragraph[:], heading_level=level)
+                    paragraph.clear()
+                    i += 1
+                    continue
+                if not self.interrupts_paragraph(line):
+                    paragraph.append(line)
+                    i += 1
+                    continue
+                close_paragraph()
+
+            if indentation(line) >= 4:
+                code = []
+                while i < len(lines) and (not lines[i].strip() or indentation(lines[i]) >= 4):
+                    code.append(lines[i][4:])
+                    i += 1
+                while code and not code[-1].strip():
+                    code.pop()
+                blocks.append(('code', '', '\n'.join(code)))
+                continue
+
+            fence = FENCE_OPEN.match(line)
+            if fence and not (fence.group(2)[0] == '`' and '`' in fence.group(3)):
+                i = self._parse_fence(lines, i, fence, blocks)
+                continue
+
+            heading = ATX_HEADING.match(line)
+            if heading:
+                blocks.append(('heading', len(heading.group(1)), heading.group(2) or ''))
+                i += 1
+                continue
+
+            if THEMATIC_BREAK.match(line):
+                blocks.append(('hr',))
+                i += 1
+                continue
+
+            if BLOCKQUOTE.match(line):
+                quoted = []
+                while i < len(lines):
+                    if BLOCKQUOTE.match(lines[i]):
+                        quoted.append(BLOCKQUOTE.sub('', lines[i], count=1))
+                    elif lines[i].strip() and quoted and quoted[-1].strip() \
+                            and not self.interrupts_paragraph(lines[i]):
+                        quoted.append(lines[i])
+                    else:
+                        break
+                    i += 1
+                blocks.append(('blockquote', self.parse_blocks(quoted)))
+                continue
+
+            if LIST_ITEM.match(line):
+                i = self._parse_list(lines, i, blocks)
+                continue
+
+            html_end = self._html_block_end(line, interrupting=False)
+            if html_end is not False:
+                raw = []
+                while i < len(lines):
+                    if html_end is None and not lines[i].strip():
+                        break
+                    raw.append(lines[i])
+                    i += 1
+                    if html_end is not None and html_end.search(raw[-1]):
+                        break
+                blocks.append(('html', '\n'.join(raw)))
+                continue
+
+            if '|' in line and i + 1 < len(lines) and TABLE_DELIMITER.match(lines[i + 1]) \
+                    and '-' in lines[i + 1]:
+                i = self._parse_table(lines, i, blocks)
+                continue
+
+            paragraph.append(line)
+            i += 1
+
+        close_paragraph()
+        return blocks
+
+    def interrupts_paragraph(self, line):
+        if ATX_HEADING.match(line) or THEMATIC_BREAK.match(line) or BLOCKQUOTE.match(line):
+            return True
+        fence = FENCE_OPEN.match(line)
+        if fence and not (fence.group(2)[0] == '`' and '`' in fence.group(3)):
+            return True
+        item = LIST_ITEM.match(line)
+        if item and line[item.end():].strip():
+            marker = item.group(2)
+            if not marker[0].isdigit() or int(marker[:-1]) == 1:
+                return True
+        return self._html_block_end(line, interrupting=True) is not False
+
+    def _html_block_end(self, line, interrupting):
+        """Return the end pattern of the raw HTML block `line` starts (None: blank line), or False."""
+        for start, end in HTML_BLOCKS:
+            if start.match(line):
+                return end
+        if not interrupting and HTML_BLOCK_OTHER.match(line):
+            return None
+        return False
+
+    def _only_definitions(self, paragraph):
+        return all(LINK_DEFINITION.match(line) for line in paragraph)
+
+    def _add_paragraph(self, blocks, lines, heading_level=None):
+        # Link reference definitions at the start of a paragraph are not content
+        while lines:
+            definition = LINK_DEFINITION.match(lines[0])
+            if not definition:
+                break
+            label = normalize_label(definition.group(1))
+            title = definition.group(3)[1:-1] if definition.group(3) else None
+            self.definitions.setdefault(label, (unescape_backslashes(definition.group(2)), title))
+            lines = lines[1:]
+        if not lines:
+            return
+        text = '\n'.join(line.strip() if n == len(lines) - 1 else line.lstrip() for n, line in enumerate(lines))
+        if heading_level:
+            blocks.append(('heading', heading_level, text))
+        else:
+            blocks.append(('paragraph', text))
+
+    def _parse_fence(self, lines, i, fence, blocks):
+        indent = len(fence.group(1))
+        marker = fence.group(2)
+        info = unescape_backslashes(fence.group(3).split()[0]) if fence.group(3).strip() else ''
+        code = []
+        i += 1
+        while i < len(lines):
+            closing = re.match(rf'^ {{0,3}}{re.escape(marker[0])}{{{len(marker)},}}[ \t]*$', lines[i])
+            if closing:
+                i += 1
+                break
+            line = lines[i]
+            code.append(line[min(indent, indentation(line)):])
+            i += 1
+        blocks.append(('code', info, '\n'.join(code)))
+        return i
+
+    def _parse_list(self, lines, i, blocks):
+        first = LIST_ITEM.match(lines[i])
+        ordered = first.group(2)[0].isdigit()
+        delimiter = first.group(2)[-1]
+        start = int(first.group(2)[:-1]) if ordered else 1
+        items = []
+        loose = False
+
+        def next_item(line):
+            item = LIST_ITEM.match(line)
+            if not item or item.group(2)[0].isdigit() != ordered or item.group(2)[-1] != delimiter:
+                return None
+            return None if THEMATIC_BREAK.match(line) else item
+
+        while i < len(lines):
+            item = next_item(lines[i])
+            if not item:
+                break
+            rest = lines[i][item.end():]
+            spacing = len(item.group(3))
+            marker_width = len(item.group(1)) + len(item.group(2))
+            if not rest.strip():
+                content_indent = marker_width + 1
+                item_lines = []
+            elif spacing > 4:
+                content_indent = marker_width + 1
+                item_lines = [' ' * (spacing - 1) + rest]
+            else:
+                content_indent = marker_width + spacing
+                item_lines = [rest]
+            i += 1
+
+            while i < len(lines):
+                line = lines[i]
+                if not line.strip():
+                    # A blank first line must be followed by indented content
+                    if not item_lines:
+                        break
+                    item_lines.append('')
+                elif indentation(line) >= content_indent:
+                    item_lines.append(line[content_indent:])
+                elif LIST_ITEM.match(line):
+                    break
+                elif item_lines and item_lines[-1].strip() and not self.interrupts_paragraph(line):
+                    item_lines.append(line)
+                else:
+                    break
+                i += 1
+
+            trailing_blank = bool(item_lines) and not item_lines[-1].strip()
+            while item_lines and not item_lines[-1].strip():
+                item_lines.pop()
+            children = self.parse_blocks(item_lines)
+            if len(children) > 1 and '' in item_lines:
+                loose = True
+            items.append(children)
+            if trailing_blank and i < len(lines) and next_item(lines[i]):
+                loose = True
+
+        blocks.append(('list', ordered, start, not loose, items))
+        return i
+
+    def _parse_table(self, lines, i, blocks):
+        header = self._table_cells(lines[i])
+        aligns = []
+        for cell in self._table_cells(lines[i + 1]):
+            cell = cell.strip()
+            if cell.startswith(':') and cell.endswith(':'):
+                aligns.append('center')
+            elif cell.endswith(':'):
+                aligns.append('right')
+            elif cell.startswith(':'):
+                aligns.append('left')
+            else:
+                aligns.append(None)
+        i += 2
+        rows = []
+        while i < len(lines) and lines[i].strip() and '|' in lines[i]:
+            rows.append(self._table_cells(lines[i]))
+            i += 1
+        blocks.append(('table', header, aligns, rows))
+        return i
+
+    @staticmethod
+    def _table_cells(line):
+        line = line.strip()
+        if line.startswith('|'):
+            line = line[1:]
+        if line.endswith('|') and not line.endswith('\\|'):
+            line = line[:-1]
+        return [cell.strip().replace('\\|', '|') for cell in re.split(r'(?<!\\)\|', line)]
+
+    # Inline content
+
+    def inline(self, text):
+        """Render inline markdown to HTML."""
+        nodes = []
+        buffer = []
+        i = 0
+        n = len(text)
+
+        def flush():
+            if buffer:
+                nodes.append(escape(''.join(buffer)))
+                buffer.clear()
+
+        while i < n:
+            char = text[i]
+            if char == '\\':
+                if i + 1 < n and text[i + 1] in ESCAPABLE:
+                    buffer.append(text[i + 1])
+                    i += 2
+                    continue
+                if i + 1 < n and text[i + 1] == '\n':
+                    flush()
+                    nodes.append('<br />\n')
+                    i += 2
+                    while i < n and text[i] == ' ':
+                        i += 1
+                    continue
+                buffer.append(char)
+                i += 1
+                continue
+
+            if char == '`':
+                run = 0
+                while i + run < n and text[i + run] == '`':
+                    run += 1
+                closing = re.compile(rf'(?<!`)`{{{run}}}(?!`)').search(text, i + run)
+                if closing:
+                    code = text[i + run:closing.start()].replace('\n', ' ')
+                    if code.startswith(' ') and code.endswith(' ') and code.strip():
+                        code = code[1:-1]
+                    flush()
+                    nodes.append(f'<code>{escape(code)}</code>')
+                    i = closing.end()
+                else:
+                    buffer.append('`' * run)
+                    i += run
+                continue
+
+            if char == '<':
+                match = AUTOLINK.match(text, i)
+                if match:
+                    flush()
+                    nodes.append(f'<a href="{escape(match.group(1))}">{escape(match.group(1))}</a>')
+                    i = match.end()
+                    continue
+                match = EMAIL_AUTOLINK.match(text, i)
+                if match:
+                    flush()
+                    nodes.append(f'<a href="mailto:{escape(match.group(1))}">{escape(match.group(1))}</a>')
+                    i = match.end()
+                    continue
+                match = INLINE_HTML.match(text, i)
+                if match:
+                    flush()
+                    nodes.append(match.group(0))
+                    i = match.end()
+                    continue
+
+            if char == '&':
+                match = ENTITY.match(text, i)
+                if match:
+                    flush()
+                    nodes.append(match.group(0))
+                    i = match.end()
+                    continue
+
+            if char == '!' and i + 1 < n and text[i + 1] == '[':
+                flush()
+                nodes.append(_Bracket(True, i))
+                i += 2
+                continue
+
+            if char == '[':
+                flush()
+                nodes.append(_Bracket(False, i))
+                i += 1
+                continue
+
+            if char == ']':
+                flush()
+                i = self._close_bracket(text, i, nodes)
+                continue
+
+            if char in '*_':
+                run = 1
+                while i + run < n and text[i + run] == char:
+                    run += 1
+                before = text[i - 1] if i > 0 else ' '
+                after = text[i + run] if i + run < n else ' '
+                left = not after.isspace() and (not is_punctuation(after) or before.isspace() or is_punctuation(before))
+                right = not before.isspace() and (not is_punctuation(before) or after.isspace() or is_punctuation(after))
+                if char == '*':
+                    can_open, can_close = left, right
+                else:
+                    can_open = left and (not right or is_punctuation(before))
+                    can_close = right and (not left or is_punctuation(after))
+                flush()
+                nodes.append(_Delimiter(char, run, can_open, can_close))
+                i += run
+                continue
+
+            if char == '\n':
+                # Two or more trailing spaces make a hard line break
+                pending = ''.join(buffer)
+                buffer[:] = [pending.rstrip(' ')]
+                flush()
+                nodes.append('<br />\n' if len(pending) - len(pending.rstrip(' ')) >= 2 else '\n')
+                i += 1
+                while i < n and text[i] == ' ':
+                    i += 1
+                continue
+
+            if char == '\x00':
+                char = '\ufffd'
+            buffer.append(char)
+            i += 1
+
+        flush()
+        self._process_emphasis(nodes, 0)
+        return self._join(nodes)
+
+    @staticmethod
+    def _join(nodes):
+        return ''.join(node if isinstance(node, str) else escape(node.text()) for node in nodes)
+
+    def _close_bracket(self, text, i, nodes):
+        """Handle ] at text[i]: turn the matching bracket into a link or image; return the next index."""
+        opener_index = next((k for k in range(len(nodes) - 1, -1, -1) if isinstance(nodes[k], _Bracket)), None)
+        if opener_index is None:
+            nodes.append(']')
+            return i + 1
+        opener = nodes[opener_index]
+        if not opener.active:
+            nodes[opener_index] = escape(opener.text())
+            nodes.append(']')
+            return i + 1
+
+        target = None
+        end = i + 1
+        inline = INLINE_LINK.match(text, i + 1)
+        if inline:
+            destination = inline.group(1)
+            if destination.startswith('<'):
+                destination = destination[1:-1]
+            title = inline.group(2)[1:-1] if inline.group(2) else None
+            target = (unescape_backslashes(destination), title and unescape_backslashes(title))
+            end = inline.end()
+        else:
+            label_start = opener.position + (2 if opener.image else 1)
+            reference = REFERENCE_LABEL.match(text, i + 1)
+            if reference and reference.group(1).strip():
+                target = self.definitions.get(normalize_label(reference.group(1)))
+                end = reference.end()
+            else:
+                target = self.definitions.get(normalize_label(text[label_start:i]))
+                if reference:
+                    end = reference.end()
+
+        if target is None:
+            nodes[opener_index] = escape(opener.text())
+            nodes.append(']')
+            return i + 1
+
+        self._process_emphasis(nodes, opener_index + 1)
+        content = self._join(nodes[opener_index + 1:])
+        destination, title = target
+        title_attribute = f' title="{escape(title)}"' if title else ''
+        destination = escape(destination.replace(' ', '%20'))
+        if opener.image:
+            rendered = f'<img src="{destination}"{title_attribute} alt="{escape(plain_text(content))}" />'
+        else:
+            rendered = f'<a href="{destination}"{title_attribute}>{content}</a>'
+            # Links may not contain other links
+            for node in nodes[:opener_index]:
+                if isinstance(node, _Bracket) and not node.image:
+                    node.active = False
+        del nodes[opener_index:]
+        nodes.append(rendered)
+        return end
+
+    def _process_emphasis(self, nodes, bottom):
+        """Match * and _ delimiter runs above `bottom` into <em>/<strong>, as in the CommonMark spec."""
+        index = bottom
+        while index < len(nodes):
+            closer = nodes[index]
+            if not (isinstance(closer, _Delimiter) and closer.can_close and closer.count):
+                index += 1
+                continue
+            opener_index = None
+            for k in range(index - 1, bottom - 1, -1):
+                opener = nodes[k]
+                if isinstance(opener, _Delimiter) and opener.char == closer.char and opener.can_open and opener.count:
+                    # The "rule of 3" for runs that can both open and close
+                    if (opener.can_close or closer.can_open) and (opener.original + closer.original) % 3 == 0 \
+                            and not (opener.original % 3 == 0 and closer.original % 3 == 0):
+                        continue
+                    opener_index = k
+                    break
+            if opener_index is None:
+                index += 1
+                continue
+
+            opener = nodes[opener_index]
+            used = 2 if opener.count >= 2 and closer.count >= 2 else 1
+            tag = 'strong' if used == 2 else 'em'
+            opener.count -= used
+            closer.count -= used
+            inner = [escape(node.text()) if isinstance(node, _Delimiter) else node
+                     for node in nodes[opener_index + 1:index]]
+            nodes[opener_index + 1:index] = [f'<{tag}>'] + inner + [f'</{tag}>']
+            index = opener_index + len(inner) + 3
+            if not opener.count:
+                del nodes[opener_index]
+                index -= 1
+            if not closer.count:
+                del nodes[index]
+
+    # HTML output
+
+    def render_blocks(self, blocks, tight=False):
+        parts = []
+        for block in blocks:
+            kind = block[0]
+            if kind == 'paragraph':
+                parts.append(self._render_paragraph(block[1], tight))
+            elif kind == 'heading':
+                parts.append(self._render_heading(block[1], block[2]))
+            elif kind == 'code':
+                classes = f' class="{escape(block[1])}"' if block[1] else ''
+                parts.append(f'<pre{classes}><code>{escape(block[2])}</code></pre>')
+            elif kind == 'hr':
+                parts.append('<hr />')
+            elif kind == 'blockquote':
+                parts.append(f'<blockquote>\n{self.render_blocks(block[1])}\n</blockquote>')
+            elif kind == 'list':
+                parts.append(self._render_list(*block[1:]))
+            elif kind == 'html':
+                parts.append(block[1])
+            elif kind == 'table':
+                parts.append(self._render_table(*block[1:]))
+        return '\n'.join(parts)
+
+    def _render_paragraph(self, text, tight):
+        content = self.inline(text)
+        # pandoc's implicit_figures: an image alone in a paragraph becomes a captioned figure
+        figure = re.fullmatch(r'<img src="[^"]*"(?: title="[^"]*")? alt="([^"]+)" />', content)
+        if figure:
+            return f'<figure>\n{content}\n<figcaption aria-hidden="true">{figure.group(1)}</figcaption>\n</figure>'
+        return content if tight else f'<p>{content}</p>'
+
+    def _heading(self, text):
+        """Return (inline HTML, base id, explicit) of a heading's text."""
+        attributes = HEADING_ATTRIBUTES.search(text)
+        explicit = None
+        if attributes:
+            explicit = attributes.group(1)
+            text = text[:attributes.start()]
+        content = self.inline(text.strip())
+        return content, explicit or pandoc_identifier(plain_text(content)), explicit is not None
+
+    def _render_heading(self, level, text):
+        content, base, explicit = self._heading(text)
+        self.heading_ids.append((base, explicit))
+        return f'<h{level} id="{ID_PLACEHOLDER}">{content}</h{level}>'
+
+    def headings(self, blocks):
+        """Yield (level, plain text, base id, explicit, source line) for headings in render order."""
+        for block in blocks:
+            kind = block[0]
+            if kind == 'heading':
+                content, base, explicit = self._heading(block[2])
+                source = block[2].strip().split('\n')[0]
+                yield block[1], plain_text(content).strip(), base, explicit, source
+            elif kind == 'blockquote':
+                yield from self.headings(block[1])
+            elif kind == 'list':
+                for children in block[4]:
+                    yield from self.headings(children)
+
+    def _render_list(self, ordered, start, tight, items):
+        rendered = []
+        for children in items:
+            body = self.render_blocks(children, tight)
+            if body and not (tight and children and children[0][0] == 'paragraph' and len(children) == 1):
+                body = ('' if tight and children[0][0] == 'paragraph' else '\n') + body + '\n'
+            rendered.append(f'<li>{body}</li>')
+        if ordered:
+            opening = f'<ol start="{start}">' if start != 1 else '<ol>'
+            return opening + '\n' + '\n'.join(rendered) + '\n</ol>'
+        return '<ul>\n' + '\n'.join(rendered) + '\n</ul>'
+
+    def _render_table(self, header, aligns, rows):
+        def cells(tag, values):
+            out = []
+            for column, value in enumerate(values[:len(aligns)] + [''] * (len(aligns) - len(values))):
+                align = aligns[column]
+                style = f' style="text-align: {align};"' if align else ''
+                out.append(f'<{tag}{style}>{self.inline(value)}</{tag}>')
+            return '\n'.join(out)
+
+        lines = ['<table>', '<thead>', '<tr class="header">', cells('th', header), '</tr>', '</thead>', '<tbody>']
+        for number, row in enumerate(rows, 1):
+            lines += [f'<tr class="{"odd" if number % 2 else "even"}">', cells('td', row), '</tr>']
+        lines += ['</tbody>', '</table>']
+        return '\n'.join(lines)
+
+
+def find_pandoc_syntax(lines):
+    """Return a description of the first pandoc-only construct in the lines, or None."""
+    for line in lines:
+        for description, pattern in PANDOC_ONLY_SYNTAX:
+            if pattern.search(line):
+                return description
+    return None
+
+
+def render_fragment(markdown):
+    """Render one page; return (html with ID_PLACEHOLDER ids, [(base id, explicit)] in order)."""
+    renderer = Renderer()
+    lines = [expand_tabs(line) for line in markdown.replace('\r\n', '\n').replace('\r', '\n').split('\n')]
+    blocks = renderer.parse_blocks(lines)
+    # Render after parsing so link definitions anywhere on the page resolve
+    return renderer.render_blocks(blocks), renderer.heading_ids
+
+
+def page_headings(markdown):
+    """Return the headings of one page as Renderer.headings yields them, without rendering the page."""
+    renderer = Renderer()
+    lines = [expand_tabs(line) for line in markdown.replace('\r\n', '\n').replace('\r', '\n').split('\n')]
+    return list(renderer.headings(renderer.parse_blocks(lines)))
+
+
+class HeadingIds:
+    """Assign document-wide unique heading ids the way pandoc does (foo, foo-1, foo-2, ...)."""
+
+    def __init__(self):
+        self.used = set()
+
+    def assign(self, base, explicit=False):
+        candidate = base
+        number = 0
+        while candidate in self.used and not explicit:
+            number += 1
+            candidate = f"{base}-{number}"
+        self.used.add(candidate)
+        return candidate
+
+    def fill(self, fragment, ids):
+        """Replace a fragment's id placeholders with unique ids."""
+        parts = fragment.split(ID_PLACEHOLDER)
+        out = [parts[0]]
+        for (base, explicit), part in zip(ids, parts[1:]):
+            out.append(escape(self.assign(base, explicit)))
+            out.append(part)
+        return ''.join(out)
+
+
+def render_markdown(markdown):
+    """Render a whole markdown document to an HTML body fragment with final heading ids."""
+    fragment, ids = render_fragment(markdown)
+    return HeadingIds().fill(fragment, ids)
+
+
+def fill_template(template, variables):
+    """Fill a pandoc-style template ($var$, $if(var)$...$else$...$endif$, $for(var)$...$endfor$)."""
+    # re.split with a capturing group alternates text (even indices) and directives (odd indices)
+    tokens = re.split(r'(\$\$|\$(?:if|for)\([\w.\-]+\)\$|\$(?:else|endif|endfor)\$|\$[A-Za-z][\w.\-]*\$)', template)
+    return _fill(tokens, 0, variables, ())[0]
+
+
+def _fill(tokens, position, variables, until):
+    """Fill tokens from `position` until a directive in `until`; return (text, index of that directive)."""
+    out = []
+    while position < len(tokens):
+        token = tokens[position]
+        if position % 2 == 0:
+            out.append(token)
+        elif token in until:
+            return ''.join(out), position
+        elif token == '$$':
+            out.append('$')
+        elif token.startswith('$if('):
+            name = token[4:-2]
+            then_part, position = _fill(tokens, position + 1, variables, ('$else$', '$endif$'))
+            else_part = ''
+            if position < len(tokens) and tokens[position] == '$else$':
+                else_part, position = _fill(tokens, position + 1, variables, ('$endif$',))
+            out.append(then_part if variables.get(name) else else_part)
+        elif token.startswith('$for('):
+            name = token[5:-2]
+            values = variables.get(name) or []
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            _, end = _fill(tokens, position + 1, variables, ('$endfor$',))
+            for value in values:
+                out.append(_fill(tokens, position + 1, dict(variables, **{name: value}), ('$endfor$',))[0])
+            position = end
+        elif token not in ('$else$', '$endif$', '$endfor$'):
+            value = variables.get(token[1:-1], '')
+            out.append(value if isinstance(value, str) else ''.join(map(str, value)))
+        position += 1
+    return ''.join(out), position
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Markdown Splitter
+Streams a markdown document line by line and splits it into pages at
+headings, without splitting inside fenced code blocks.
+"""
+
+import mmap
+import re
+from pathlib import Path
+
+# Default page budget in characters; keeps each page comfortably inside the
+# translator's max_tokens limit.
+DEFAULT_MAX_PAGE_CHARS = 12000
+
+# Files above this size are read through mmap instead of buffered text I/O
+MMAP_THRESHOLD_BYTES = 64 * 1024 * 1024
+
+HEADING_PATTERN = re.compile(r'^ {0,3}(#{1,6})(?:[ \t]|$)')
+FENCE_PATTERN = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+
+
+def iter_file_lines(path, use_mmap=None):
+    """Yield lines (with line endings) from a UTF-8 file, optionally via mmap.
+
+    Both ways translate \r\n and \r to \n, as universal newlines do.
+    """
+    path = Path(path)
+    if use_mmap is None:
+        use_mmap = path.stat().st_size >= MMAP_THRESHOLD_BYTES
+
+    if not use_mmap or path.stat().st_size == 0:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from f
+        return
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for raw_line in iter(mm.readline, b''):
+                line = raw_line.decode('utf-8')
+                if '\r' in line:
+                    # Only \n ends a line, as in text mode; splitlines would also split at \f, \x1c, \u2028...
+                    parts = line.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+                    yield from (part + '\n' for part in parts[:-1])
+                    if parts[-1]:
+                        yield parts[-1]
+                else:
+                    yield line
+
+
+class FenceTracker:
+    """Track whether the current line is inside a fenced code block."""
+
+    def __init__(self):
+        self.fence = None
+
+    @property
+    def inside(self):
+        return self.fence is not None
+
+    def feed(self, line):
+        """Update fence state with one line; return True if the line is fenced content or a fence."""
+        match = FENCE_PATTERN.match(line)
+        if self.fence is None:
+            if match:
+                self.fence = match.group(1)
+                return True
+            return False
+
+        if match and match.group(1)[0] == self.fence[0] and len(match.group(1)) >= len(self.fence) \
+                and not line.strip()[len(match.group(1)):].strip():
+            self.fence = None
+        return True
+
+
+def heading_level(line):
+    """Return the ATX heading level of a line, or 0 if it is not a heading."""
+    match = HEADING_PATTERN.match(line)
+    return len(match.group(1)) if match else 0
+
+
+def iter_markdown_sections(lines, split_level=1, max_chars=DEFAULT_MAX_PAGE_CHARS):
+    """Split a stream of markdown lines into page-sized sections.
+
+    A new section starts at every heading of level <= split_level that is not
+    inside a fenced code block. Sections larger than max_chars are further
+    split at paragraph boundaries (blank lines outside code fences); a single
+    paragraph or code block is never cut. Whitespace-only sections are dropped.
+    """
+    fences = FenceTracker()
+    section = []
+    section_size = 0
+    block = []
+    block_size = 0
+
+    def flush_section():
+        nonlocal section, section_size
+        text = ''.join(section)
+        section = []
+        section_size = 0
+        return text if text.strip() else None
+
+    def close_block():
+        # Move the current paragraph block into the section, flushing the
+        # section first if the block would push it over the page budget.
+        nonlocal block, block_size, section_size
+        flushed = None
+        if max_chars and section and section_size + block_size > max_chars:
+            flushed = flush_section()
+        section.extend(block)
+        section_size += block_size
+        block = []
+        block_size = 0
+        return flushed
+
+    for line in lines:
+        if not fences.inside:
+            level = heading_level(line)
+            if level and level <= split_level:
+                flushed = close_block()
+                if flushed is not None:
+                    yield flushed
+                flushed = flush_section()
+                if flushed is not None:
+                    yield flushed
+
+        in_code = fences.feed(line)
+        block.append(line)
+        block_size += len(line)
+
+        if not in_code and not line.strip():
+            flushed = close_block()
+            if flushed is not None:
+                yield flushed
+
+    flushed = close_block()
+    if flushed is not None:
+        yield flushed
+    flushed = flush_section()
+    if flushed is not None:
+        yield flushed
+
+
+def split_markdown_file(path, split_level=1, max_chars=DEFAULT_MAX_PAGE_CHARS, use_mmap=None):
+    """Stream-split a markdown file; yields section strings."""
+    return iter_markdown_sections(iter_file_lines(path, use_mmap), split_level, max_chars)
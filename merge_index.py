@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Merge Index
+Sidecar index of output.md (output.md.index.json) recording, for every
+merged page, its byte offset, length, first line, content hash and the
+identity of the source it was copied from. Step 4 uses it to patch or
+rebuild output.md from unchanged spans instead of re-reading every page,
+and later steps use it to map a position in output.md back to its page.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+from atomic_io import atomic_open, atomic_write_text
+
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+# Sources modified this close to the index write may have changed without a
+# visible (size, mtime) change on coarse-timestamp filesystems; they are rehashed
+RACY_WINDOW_NS = 2_000_000_000
+
+COPY_CHUNK = 1024 * 1024
+
+
+def index_path_for(output_file):
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.name + INDEX_SUFFIX)
+
+
+def file_source(path):
+    """Identity of a page file that is cheap to check: [size, mtime_ns]."""
+    stat = Path(path).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_file_chunks(path, chunk_size=64 * 1024):
+    """Yield the text of a file in chunks."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            yield chunk
+
+
+def stripped(chunks):
+    """Yield text chunks with leading and trailing whitespace removed, like str.strip() on their join."""
+    started = False
+    pending = ''
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+        body = chunk.rstrip()
+        if body:
+            yield pending + body
+            pending = chunk[len(body):]
+        else:
+            pending += chunk
+
+
+def text_digest(chunks):
+    digest = hashlib.sha256()
+    for chunk in stripped(chunks):
+        digest.update(chunk.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def copy_range(src, dst, offset, length):
+    """Copy `length` bytes at `offset` of src to the current position of dst."""
+    src.seek(offset)
+    while length > 0:
+        data = src.read(min(COPY_CHUNK, length))
+        if not data:
+            raise ValueError("merged file is shorter than its index")
+        dst.write(data)
+        length -= len(data)
+
+
+class MergeWriter:
+    """Write pages to a binary file with a separator between them, recording an index entry per page."""
+
+    def __init__(self, out, separator, entries=()):
+        self.out = out
+        self.separator = separator.encode('utf-8')
+        self._separator_lines = separator.count('\n')
+        self.entries = list(entries)
+
+    def _start_page(self):
+        if self.entries:
+            self.out.write(self.separator)
+            last = self.entries[-1]
+            return self.out.tell(), last['line'] + last['lines'] + self._separator_lines
+        return self.out.tell(), 1
+
+    def write_page(self, page, source, chunks):
+        """Stream one page's text (stripped) into the file."""
+        offset, line = self._start_page()
+        digest = hashlib.sha256()
+        length = lines = 0
+        for chunk in stripped(chunks):
+            data = chunk.encode('utf-8')
+            self.out.write(data)
+            digest.update(data)
+            length += len(data)
+            lines += chunk.count('\n')
+        self.entries.append({'page': page, 'source': source, 'offset': offset, 'length': length,
+                             'hash': digest.hexdigest(), 'line': line, 'lines': lines})
+
+    def copy_page(self, entry, src, source=None):
+        """Copy an unchanged page from a previous merged file using its old index entry."""
+        offset, line = self._start_page()
+        copy_range(src, self.out, entry['offset'], entry['length'])
+        self.entries.append(dict(entry, offset=offset, line=line,
+                                 source=source if source is not None else entry['source']))
+
+
+def save_index(output_file, entries, separator):
+    """Write the index for a freshly written output file."""
+    stat = Path(output_file).stat()
+    index = {'version': INDEX_VERSION, 'separator': separator, 'size': stat.st_size,
+             'mtime_ns': stat.st_mtime_ns, 'written_ns': time.time_ns(), 'pages': entries}
+    atomic_write_text(index_path_for(output_file), json.dumps(index, ensure_ascii=False))
+
+
+def load_index(output_file, separator=None):
+    """Return the index of output_file, or None if it is missing or no longer describes the file."""
+    index_file = index_path_for(output_file)
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        stat = Path(output_file).stat()
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or index['size'] != stat.st_size \
+            or index['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    if separator is not None and index['separator'] != separator:
+        return None
+    return index
+
+
+def page_at(index, offset):
+    """Return the index entry of the page containing byte `offset` (a separator belongs to the page after it)."""
+    entries = index['pages']
+    position = bisect.bisect_right([entry['offset'] for entry in entries], offset) - 1
+    return entries[max(position, 0)] if entries else None
+
+
+def page_at_line(index, line):
+    """Return the index entry of the page containing 1-based `line`."""
+    entries = index['pages']
+    position = bisect.bisect_right([entry['line'] for entry in entries], line) - 1
+    return entries[max(position, 0)] if entries else None
+
+
+def _is_racy(source, index):
+    """File stats are trusted only outside the racy window; content hashes are exact."""
+    return isinstance(source, list) and source[1] >= index['written_ns'] - RACY_WINDOW_NS
+
+
+def _unchanged(entry, source, read, index):
+    """Return True if a page still has the content recorded in its old index entry."""
+    if entry['source'] == source and not _is_racy(source, index):
+        return True
+    if isinstance(source, list):
+        return text_digest(read()) == entry['hash']
+    return False
+
+
+def merge_pages(output_file, sources, separator):
+    """Merge pages into output_file, reusing unchanged spans of the previous merge.
+
+    sources is a list of (page, source, read): source identifies the page
+    content ([size, mtime_ns] of a file, or a content hash) and read()
+    returns an iterable of its text chunks. Returns 'fresh' if nothing
+    changed, 'patched' if only a tail was rewritten in place, or 'rebuilt'.
+    """
+    output_file = Path(output_file)
+    index = load_index(output_file, separator)
+    old_entries = {entry['page']: entry for entry in index['pages']} if index else {}
+    old_order = [entry['page'] for entry in index['pages']] if index else []
+
+    unchanged = []
+    for page, source, read in sources:
+        entry = old_entries.get(page)
+        unchanged.append(entry is not None and _unchanged(entry, source, read, index))
+
+    prefix = 0
+    while prefix < len(sources) and prefix < len(old_order) \
+            and sources[prefix][0] == old_order[prefix] and unchanged[prefix]:
+        prefix += 1
+
+    if index and prefix == len(sources) == len(old_order):
+        # Record the current file stats so later runs need not rehash these pages again
+        entries = [dict(old_entries[page], source=source) for page, source, _ in sources]
+        if entries != index['pages'] or any(_is_racy(source, index) for _, source, _ in sources):
+            save_index(output_file, entries, separator)
+        return 'fresh'
+
+    if prefix:
+        # The first pages are unchanged: truncate after them and append the rest in place.
+        # The index is removed first so an interrupted patch forces a full rebuild next time.
+        index_path_for(output_file).unlink()
+        kept = [dict(old_entries[page], source=source) for page, source, _ in sources[:prefix]]
+        with open(output_file, 'r+b') as out:
+            out.truncate(kept[-1]['offset'] + kept[-1]['length'])
+            out.seek(0, os.SEEK_END)
+            writer = MergeWriter(out, separator, kept)
+            for page, source, read in sources[prefix:]:
+                writer.write_page(page, source, read())
+        save_index(output_file, writer.entries, separator)
+        return 'patched'
+
+    old_file = open(output_file, 'rb') if index else None
+    try:
+        with atomic_open(output_file, 'wb') as out:
+            writer = MergeWriter(out, separator)
+            for (page, source, read), same in zip(sources, unchanged):
+                if same:
+                    writer.copy_page(old_entries[page], old_file, source)
+                else:
+                    writer.write_page(page, source, read())
+    finally:
+        if old_file:
+            old_file.close()
+    save_index(output_file, writer.entries, separator)
+    return 'rebuilt'
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Chunked Pandoc Rendering
+Renders a large output.md with several pandoc processes, one per run of
+consecutive pages, and stitches their HTML into template.html as a single
+document. Heading ids are made unique across chunks exactly as one pandoc
+run would number them, footnotes are renumbered into one list at the end,
+and link and footnote definitions are given to every chunk so references
+across pages still resolve.
+"""
+
+import html
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from atomic_io import atomic_open
+from markdown_renderer import HeadingIds, escape, pandoc_identifier, plain_text
+from merge_index import copy_range
+from tracing import span
+
+# Chunks are about a worker's share of the book, within these bounds
+MIN_CHUNK_BYTES = 256 * 1024
+MAX_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Chunks are rendered with this template so only their body is produced
+BODY_TEMPLATE = "$body$\n"
+
+# Paragraphs rendered with the real template to find where the body goes
+START_MARK = "PANDOCCHUNKBODYSTART"
+END_MARK = "PANDOCCHUNKBODYEND"
+
+DEFINITION = re.compile(r' {0,3}\[(\^?)[^\]]+\]:')
+FENCE = re.compile(r' {0,3}(`{3,}|~{3,})')
+HEADING = re.compile(r'<h([1-6])\b([^>]*)>(.*?)</h\1>', re.S)
+HEADING_ID = re.compile(r'\bid="([^"]*)"')
+NOTE_ID = re.compile(r'((?:id="|href="#)fn(?:ref)?)(\d+)"')
+NOTE_MARK = re.compile(r'(class="footnote-ref"[^>]*><sup>)(\d+)(</sup>)')
+FOOTNOTES = re.compile(r'\n?<(section|div)\b([^>]*class="footnotes[^"]*"[^>]*)>\s*<hr\s*/?>\s*<ol>\n?(.*?)\n?</ol>\s*</\1>',
+                       re.S)
+
+
+def plan_chunks(pages, workers):
+    """Group consecutive pages into chunks; return (offset, length, page count) for each.
+
+    pages are (page, hash, offset, length) entries of the merge index, so a
+    chunk is one contiguous byte range of output.md including its separators.
+    """
+    total = sum(page[3] for page in pages)
+    target = max(MIN_CHUNK_BYTES, min(MAX_CHUNK_BYTES, -(-total // max(workers, 1))))
+    chunks = []
+    start = end = count = 0
+    for _, _, offset, length in pages:
+        if count and offset + length - start > target:
+            chunks.append((start, end - start, count))
+            count = 0
+        if not count:
+            start = offset
+        end = offset + length
+        count += 1
+    if count:
+        chunks.append((start, end - start, count))
+    return chunks
+
+
+def collect_definitions(md_file):
+    """Return the link reference and footnote definitions in output.md as markdown."""
+    found = []
+    fence = None
+    in_note = False
+    with open(md_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if fence:
+                if line.lstrip(' ').startswith(fence):
+                    fence = None
+                continue
+            match = FENCE.match(line)
+            if match:
+                fence = match.group(1)
+                in_note = False
+                continue
+            # A footnote continues on blank and indented lines
+            if in_note and (not line.strip() or line.startswith(('    ', '\t'))):
+                found.append(line)
+                continue
+            match = DEFINITION.match(line)
+            in_note = bool(match and match.group(1))
+            if match:
+                found.append(line if line.endswith('\n') else line + '\n')
+    return ''.join(found)
+
+
+def run_pandoc(cmd):
+    """Run one pandoc command; return (seconds, peak RSS in MB).
+
+    Raises subprocess.CalledProcessError with pandoc's stderr if it fails.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    with process.stderr:
+        stderr = process.stderr.read()
+    peak = 0.0
+    if hasattr(os, "wait4"):
+        # wait4 reports the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak = usage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+    else:
+        process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+    return time.perf_counter() - started, peak
+
+
+def heading_base(produced, text):
+    """Return (base id, explicit) for a heading id pandoc produced within one chunk."""
+    base = pandoc_identifier(text)
+    if produced == base or re.fullmatch(re.escape(base) + r'-\d+', produced):
+        return base, False
+    return produced, True
+
+
+class ChunkStitcher:
+    """Rewrite the ids of separately rendered chunks to those of a single pandoc run."""
+
+    def __init__(self):
+        self.heading_ids = HeadingIds()
+        self.notes = []
+        self.note_count = 0
+        self.notes_tag = None
+
+    def stitch(self, chunk_html):
+        """Return a chunk's HTML with unique heading ids and its footnotes moved to the shared list."""
+        if self.note_count:
+            offset = self.note_count
+            chunk_html = NOTE_MARK.sub(lambda m: f"{m.group(1)}{int(m.group(2)) + offset}{m.group(3)}", chunk_html)
+            chunk_html = NOTE_ID.sub(lambda m: f'{m.group(1)}{int(m.group(2)) + offset}"', chunk_html)
+        chunk_html = FOOTNOTES.sub(self._take_notes, chunk_html)
+        return HEADING.sub(self._rename_heading, chunk_html)
+
+    def footnotes(self):
+        """The footnotes section that ends the document, or '' without footnotes."""
+        if not self.notes:
+            return ''
+        tag, attrs = self.notes_tag
+        return f"<{tag}{attrs}>\n<hr />\n<ol>\n" + '\n'.join(self.notes) + f"\n</ol>\n</{tag}>"
+
+    def _take_notes(self, match):
+        self.notes_tag = self.notes_tag or (match.group(1), match.group(2))
+        self.notes.append(match.group(3))
+        self.note_count += match.group(3).count('<li id="fn')
+        return ''
+
+    def _rename_heading(self, match):
+        level, attrs, inner = match.groups()
+        found = HEADING_ID.search(attrs)
+        if not found:
+            return match.group(0)
+        base, explicit = heading_base(html.unescape(found.group(1)), plain_text(inner))
+        heading_id = escape(self.heading_ids.assign(base, explicit))
+        return f"<h{level}{attrs[:found.start(1)]}{heading_id}{attrs[found.end(1):]}>{inner}</h{level}>"
+
+
+def render_chunk(cmd, chunk_file, html_file):
+    """Render one chunk file; return (seconds, peak MB, whether it has highlighted code)."""
+    with span("pandoc chunk", "render", bytes=chunk_file.stat().st_size):
+        seconds, peak = run_pandoc(cmd + [str(chunk_file), "-o", str(html_file)])
+    return seconds, peak, 'class="sourceCode' in html_file.read_text(encoding='utf-8')
+
+
+def render_shell(cmd, scratch, highlighted):
+    """Render the real template around marker paragraphs; return the HTML before and after the body."""
+    # A highlighted block makes pandoc add its highlighting CSS, as the whole book would
+    code = "```python\npass\n```\n\n" if highlighted else ""
+    marker_file = scratch / "shell.md"
+    marker_file.write_text(f"{START_MARK}\n\n{code}{END_MARK}\n", encoding='utf-8')
+    shell_file = scratch / "shell.html"
+    run_pandoc(cmd + [str(marker_file), "-o", str(shell_file)])
+    shell = shell_file.read_text(encoding='utf-8')
+    start = shell.index(f"<p>{START_MARK}</p>")
+    end = shell.index(f"<p>{END_MARK}</p>") + len(f"<p>{END_MARK}</p>")
+    return shell[:start], shell[end:]
+
+
+def render_chunked(md_file, html_file, chunks, workers, pandoc_cmd, shell_args):
+    """Render output.md chunk by chunk with parallel pandoc processes into html_file.
+
+    pandoc_cmd is the command shared by every pandoc run (without input or
+    output), shell_args the template and CSS options for the document shell.
+    Returns statistics of the render.
+    """
+    definitions = collect_definitions(md_file).encode('utf-8')
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="pandoc_chunks_", dir=Path(html_file).parent) as scratch:
+        scratch = Path(scratch)
+        body_template = scratch / "body.html"
+        body_template.write_text(BODY_TEMPLATE, encoding='utf-8')
+        chunk_cmd = pandoc_cmd + ["--template", str(body_template)]
+
+        # Each chunk gets every definition so references to other pages resolve
+        jobs = []
+        with open(md_file, 'rb') as src:
+            for number, (offset, length, _) in enumerate(chunks):
+                chunk_file = scratch / f"chunk{number:04d}.md"
+                with open(chunk_file, 'wb') as out:
+                    copy_range(src, out, offset, length)
+                    if definitions:
+                        out.write(b"\n\n" + definitions)
+                jobs.append((chunk_file, scratch / f"chunk{number:04d}.html"))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda job: render_chunk(chunk_cmd, *job), jobs))
+        head, tail = render_shell(pandoc_cmd + shell_args, scratch, any(result[2] for result in results))
+
+        stitcher = ChunkStitcher()
+        with atomic_open(html_file) as out:
+            out.write(head)
+            for number, (_, chunk_html) in enumerate(jobs):
+                # Pages within a chunk are separated by --- and so are chunks
+                if number:
+                    out.write("\n<hr />\n")
+                out.write(stitcher.stitch(chunk_html.read_text(encoding='utf-8').rstrip('\n')))
+            notes = stitcher.footnotes()
+            if notes:
+                out.write("\n" + notes)
+            out.write(tail)
+
+    wall = time.perf_counter() - started
+    pandoc_seconds = sum(result[0] for result in results)
+    return {
+        'chunks': len(chunks),
+        'workers': workers,
+        'seconds': wall,
+        'pandoc_seconds': pandoc_seconds,
+        # Average pandoc processes busy at once; a single pass is not run to compare against
+        'parallelism': pandoc_seconds / wall if wall else 1.0,
+        'peak_rss_mb': max(result[1] for result in results),
+    }
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+PDF OCR Fallback
+Rasterizes PDF pages that have no usable text layer and runs them through
+tesseract in a process pool, caching results by page content hash.
+"""
+
+import hashlib
+import importlib.util
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from atomic_io import atomic_write_text
+
+# Optional dependencies are only imported by the functions that need them
+PYMUPDF_AVAILABLE = importlib.util.find_spec("fitz") is not None
+PDF2IMAGE_AVAILABLE = importlib.util.find_spec("pdf2image") is not None
+
+
+# Pages with fewer non-whitespace characters than this are treated as scanned
+MIN_TEXT_CHARS = 20
+
+# Rasterize so the long side of the page is about this many pixels (A4 at ~280 dpi)
+TARGET_LONG_SIDE_PX = 3300
+MIN_OCR_DPI = 150
+MAX_OCR_DPI = 400
+
+# Pipeline language codes -> tesseract traineddata names
+TESSERACT_LANGS = {
+    "auto": "eng",
+    "en": "eng",
+    "zh": "chi_sim",
+    "ja": "jpn",
+    "ko": "kor",
+    "fr": "fra",
+    "de": "deu",
+    "es": "spa",
+    "ru": "rus",
+}
+
+
+def check_tesseract():
+    """Check if the tesseract binary is available."""
+    return shutil.which("tesseract") is not None
+
+
+def needs_ocr(text, min_chars=MIN_TEXT_CHARS):
+    """Return True if an extracted text layer is empty or negligible."""
+    return len(''.join(text.split())) < min_chars
+
+
+def choose_ocr_dpi(width_pt, height_pt):
+    """Pick a rasterization DPI from the page size in points."""
+    long_side_inches = max(width_pt, height_pt, 1) / 72
+    dpi = int(TARGET_LONG_SIDE_PX / long_side_inches)
+    return max(MIN_OCR_DPI, min(MAX_OCR_DPI, dpi))
+
+
+def page_content_key(pdf_document, page, dpi, lang):
+    """Hash a page's content streams and images together with the OCR settings."""
+    digest = hashlib.sha256(f"ocr|{dpi}|{lang}|".encode())
+    digest.update(page.read_contents() or b'')
+    for img in page.get_images(full=True):
+        digest.update(pdf_document.xref_stream_raw(img[0]) or b'')
+    return digest.hexdigest()
+
+
+def rasterize_page(pdf_path, page_index, dpi, png_path):
+    """Render one page to PNG with pdf2image when available, else PyMuPDF."""
+    if PDF2IMAGE_AVAILABLE:
+        from pdf2image import convert_from_path
+        from pdf2image.exceptions import PDFInfoNotInstalledError
+        try:
+            images = convert_from_path(pdf_path, dpi=dpi, first_page=page_index + 1,
+                                       last_page=page_index + 1, grayscale=True)
+            images[0].save(png_path)
+            return
+        except (PDFInfoNotInstalledError, OSError) as e:
+            # pdf2image is only a wrapper around poppler, which may not be installed
+            if not PYMUPDF_AVAILABLE:
+                raise
+            print(f"pdf2image failed ({e}), rasterizing page {page_index+1} with PyMuPDF")
+
+    import fitz
+
+    with fitz.open(pdf_path) as pdf_document:
+        pix = pdf_document.load_page(page_index).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        pix.save(png_path)
+
+
+def ocr_page(task):
+    """Rasterize and OCR one page (runs in a worker process)."""
+    pdf_path, page_index, dpi, lang = task
+    with tempfile.TemporaryDirectory() as work_dir:
+        png_path = os.path.join(work_dir, "page.png")
+        rasterize_page(pdf_path, page_index, dpi, png_path)
+
+        # One tesseract thread per worker; the process pool provides parallelism
+        env = dict(os.environ, OMP_THREAD_LIMIT="1")
+        result = subprocess.run(["tesseract", png_path, "stdout", "-l", lang],
+                                capture_output=True, text=True, check=True, env=env)
+    return result.stdout
+
+
+def run_ocr(tasks, cache_dir, workers=None):
+    """OCR pages in parallel, reusing cached results.
+
+    tasks is a list of (page_index, cache_key, (pdf_path, page_index, dpi, lang)).
+    Returns a dict of page_index -> recognized text.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    pending = []
+    for page_index, cache_key, task in tasks:
+        cache_file = cache_dir / f"{cache_key}.txt"
+        if cache_file.exists():
+            results[page_index] = cache_file.read_text(encoding='utf-8')
+        else:
+            pending.append((page_index, cache_key, task))
+
+    if results:
+        print(f"OCR cache hits: {len(results)} pages")
+    if not pending:
+        return results
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Running OCR on {len(pending)} pages with {workers} workers...")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(page_index, cache_key, executor.submit(ocr_page, task))
+                   for page_index, cache_key, task in pending]
+        for page_index, cache_key, future in futures:
+            try:
+                text = future.result()
+            except Exception as e:
+                print(f"OCR failed for page {page_index+1}: {e}")
+                continue
+
+            atomic_write_text(cache_dir / f"{cache_key}.txt", text)
+            results[page_index] = text
+            print(f"OCR completed: page {page_index+1}")
+
+    return results
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Pipeline API
+Runs the pipeline steps in one process around a shared RunContext.
+
+Step modules are imported only when their step runs, and each step module
+imports its heavy dependencies (fitz, pypandoc, requests) only inside
+the functions that need them, so embedding the pipeline stays cheap.
+"""
+
+import contextlib
+import importlib
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from markdown_splitter import DEFAULT_MAX_PAGE_CHARS
+from progress import set_step
+from tracing import profiled, span
+
+
+# (step number, module name, description)
+STEPS = [
+    (1, "step1_init", "Step 1: Environment Initialization"),
+    (2, "step2_split_pdf", "Step 2: Split/Convert Ebook"),
+    (3, "step3_translate", "Step 3: Translate Markdown"),
+    (4, "step4_merge_md", "Step 4: Merge Markdown Files"),
+    (5, "step5_convert_html", "Step 5: Convert to HTML"),
+    (6, "step6_generate_toc", "Step 6: Generate Table of Contents"),
+]
+
+
+def load_config(temp_dir):
+    """Load configuration from config.txt file, ignoring blank and malformed lines."""
+    config_file = Path(temp_dir) / "config.txt"
+    config = {}
+
+    with open(config_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.strip().split('=', 1)
+                config[key] = value
+
+    return config
+
+
+def temp_dir_for(input_file):
+    """Return the working directory used for an input ebook."""
+    input_path = Path(input_file)
+    return input_path.parent / f"{input_path.stem}_temp"
+
+
+@dataclass
+class RunContext:
+    """State shared by all steps of one pipeline run."""
+
+    temp_dir: Path
+    input_file: Optional[Path] = None
+    input_lang: str = "auto"
+    output_lang: str = "zh"
+    config: Dict[str, str] = field(default_factory=dict)
+    pages: List[Path] = field(default_factory=list)
+    translator: Optional[Any] = None
+    use_api: bool = False
+    api_key: Optional[str] = None
+    split_level: int = 1
+    max_page_chars: int = DEFAULT_MAX_PAGE_CHARS
+    reader: str = "native"
+    workers: Optional[int] = None
+    ocr: bool = True
+    renderer: str = "auto"
+    html_layout: str = "single"
+    auto_overwrite: bool = False
+    reuse_existing: bool = False
+    resume: bool = False
+    packed: bool = False
+    profile: bool = False
+    on_page: Optional[Callable[[Path], None]] = None
+    render_memo: Optional[Any] = None
+    metrics: Dict[str, float] = field(default_factory=dict)
+
+    @classmethod
+    def from_temp_dir(cls, temp_dir, **options):
+        """Build a context for an existing working directory from its config.txt."""
+        ctx = cls(temp_dir=Path(temp_dir), **options)
+        ctx.reload_config()
+        return ctx
+
+    @property
+    def pages_dir(self):
+        return self.temp_dir / "pages"
+
+    @property
+    def images_dir(self):
+        return self.temp_dir / "images"
+
+    @property
+    def output_dir(self):
+        return self.temp_dir / "output"
+
+    def reload_config(self):
+        """Refresh config and the derived fields from config.txt."""
+        if not (self.temp_dir / "config.txt").exists():
+            return
+        self.config = load_config(self.temp_dir)
+        if self.input_file is None and 'INPUT_FILE' in self.config:
+            self.input_file = Path(self.config['INPUT_FILE'])
+        self.input_lang = self.config.get('INPUT_LANG', self.input_lang)
+        self.output_lang = self.config.get('OUTPUT_LANG', self.output_lang)
+        self.packed = self.config.get('WORKSPACE') == 'packed'
+
+    def refresh_pages(self):
+        """Rescan the page markdown files produced by step 2."""
+        self.pages = sorted(self.pages_dir.glob("page*.md"))
+        return self.pages
+
+
+def run_steps(ctx, start_step=1, end_step=6):
+    """Run steps start_step..end_step in-process; return the failed step number or 0."""
+    for number, module_name, description in STEPS:
+        if number < start_step or number > end_step:
+            continue
+
+        print(f"\n{'='*60}")
+        print(f"Running {description}")
+        print(f"{'='*60}")
+
+        step_module = importlib.import_module(module_name)
+        set_step(number, description)
+        started = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                if ctx.profile:
+                    stack.enter_context(profiled(f"step{number}", ctx.temp_dir / "profile", ctx.metrics))
+                step_span = stack.enter_context(span(description, "step", step=number))
+                ok = step_module.run(ctx)
+                step_span.set(ok=bool(ok))
+        except Exception as e:
+            print(f"✗ {description} raised {type(e).__name__}: {e}")
+            ok = False
+        ctx.metrics[f"step{number}_seconds"] = time.perf_counter() - started
+
+        if not ok:
+            print(f"✗ {description} failed")
+            return number
+        print(f"✓ {description} completed successfully")
+
+    return 0
+
+
+def run_pipeline(input_file, start_step=1, end_step=6, **options):
+    """Translate one ebook end to end; return the finished RunContext.
+
+    Raises RuntimeError naming the failing step if any step fails.
+    """
+    input_file = Path(input_file)
+    ctx = RunContext(temp_dir=temp_dir_for(input_file), input_file=input_file, **options)
+    if start_step > 1:
+        ctx.reload_config()
+
+    failed_step = run_steps(ctx, start_step, end_step)
+    if failed_step:
+        raise RuntimeError(f"Pipeline failed at step {failed_step}")
+    return ctx
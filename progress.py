@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Progress and Metrics
+Process-wide progress of a run, shared by all steps: pages done of the
+total per stage (extract, translate, render), skipped and failed pages,
+retries, API requests in flight and tokens used. Rates and ETAs are
+computed over a moving window of recent completions.
+
+Everything can be exposed in the Prometheus text format, as a file for
+node_exporter's textfile collector or on a local /metrics endpoint, and
+shown as a compact status line kept at the bottom of the terminal.
+
+Like tracing, progress is off by default; the recording functions cost
+almost nothing until start_progress() is called.
+"""
+
+import collections
+import shutil
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from atomic_io import atomic_write_text
+
+_progress = None
+
+# Rates (and so ETAs) are computed over completions in this many seconds
+WINDOW_SECONDS = 60.0
+
+# Seconds between refreshes of the status line and the metrics file
+REFRESH_SECONDS = 1.0
+
+# Without a terminal the status is printed as a line this often
+LOG_SECONDS = 30.0
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def window_rate(samples, now, since):
+    """Per-second rate of (time, amount) samples within WINDOW_SECONDS, or over the time since `since` if shorter."""
+    while samples and samples[0][0] < now - WINDOW_SECONDS:
+        samples.popleft()
+    span = min(WINDOW_SECONDS, now - since)
+    return sum(amount for _, amount in samples) / span if span > 0 else 0.0
+
+
+class Stage:
+    """Counters of one stage; completions are sampled for its rate."""
+
+    def __init__(self, now):
+        self.started = now
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.retries = 0
+        self.samples = collections.deque()
+
+
+class Request:
+    """An API request in flight; set() records the tokens it used."""
+
+    def __init__(self, progress):
+        self.progress = progress
+
+    def set(self, prompt_tokens=None, completion_tokens=None):
+        self.progress.add_tokens(prompt_tokens or 0, completion_tokens or 0)
+
+    def __enter__(self):
+        self.progress.request_started()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.progress.request_finished(failed=exc_type is not None)
+        return False
+
+
+class _NullRequest:
+    """Stand-in returned by track_request() while progress is off."""
+
+    def set(self, prompt_tokens=None, completion_tokens=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_REQUEST = _NullRequest()
+
+
+class Progress:
+    """Thread-safe progress counters of one run."""
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.started = time.perf_counter()
+        self.step = 0
+        self.step_name = ''
+        self.stages = {}
+        self.in_flight = 0
+        self.requests = 0
+        self.request_errors = 0
+        self.tokens = {'prompt': 0, 'completion': 0}
+        self.token_samples = collections.deque()
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(time.perf_counter())
+        return self.stages[name]
+
+    def set_step(self, number, name):
+        with self._lock:
+            self.step = number
+            self.step_name = name
+
+    def add_total(self, stage, count):
+        with self._lock:
+            self._stage(stage).total += count
+
+    def item_done(self, stage, skipped=False):
+        with self._lock:
+            counters = self._stage(stage)
+            counters.done += 1
+            if skipped:
+                # Skipped items finish instantly and would make the ETA optimistic
+                counters.skipped += 1
+            else:
+                counters.samples.append((time.perf_counter(), 1))
+
+    def item_failed(self, stage):
+        with self._lock:
+            self._stage(stage).failed += 1
+
+    def item_retried(self, stage):
+        with self._lock:
+            self._stage(stage).retries += 1
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+
+    def request_finished(self, failed=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.request_errors += failed
+
+    def add_tokens(self, prompt, completion):
+        with self._lock:
+            self.tokens['prompt'] += prompt
+            self.tokens['completion'] += completion
+            self.token_samples.append((time.perf_counter(), prompt + completion))
+
+    def snapshot(self):
+        """Return the current counters, rates and ETAs as a dict."""
+        now = time.perf_counter()
+        with self._lock:
+            stages = {}
+            for name, counters in self.stages.items():
+                rate = window_rate(counters.samples, now, counters.started)
+                remaining = counters.total - counters.done - counters.failed
+                stages[name] = {
+                    'total': counters.total, 'done': counters.done, 'skipped': counters.skipped,
+                    'failed': counters.failed, 'retries': counters.retries, 'per_second': rate,
+                    'eta_seconds': remaining / rate if rate > 0 and remaining > 0 else None,
+                }
+            return {
+                'step': self.step, 'step_name': self.step_name, 'elapsed_seconds': now - self.started,
+                'stages': stages, 'in_flight': self.in_flight, 'requests': self.requests,
+                'request_errors': self.request_errors, 'tokens': dict(self.tokens),
+                'tokens_per_second': window_rate(self.token_samples, now, self.started),
+            }
+
+    def prometheus_text(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        state = self.snapshot()
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP ebook_pipeline_{name} {help_text}")
+            lines.append(f"# TYPE ebook_pipeline_{name} {kind}")
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                text = ','.join(f'{key}="{escape_label(str(val))}"' for key, val in labels.items())
+                value = value if isinstance(value, int) else f"{value:.3f}"
+                lines.append(f"ebook_pipeline_{name}{{{text}}} {value}" if text else f"ebook_pipeline_{name} {value}")
+
+        stages = state['stages']
+
+        def per_stage(key):
+            return [({'stage': name}, counters[key]) for name, counters in stages.items()]
+
+        family("step", "gauge", "Number of the pipeline step running now.", [({}, state['step'])])
+        family("elapsed_seconds", "gauge", "Seconds since the run started.", [({}, state['elapsed_seconds'])])
+        family("items", "gauge", "Items (pages) to process per stage.", per_stage('total'))
+        family("items_done_total", "counter", "Items finished per stage, including skipped ones.",
+               per_stage('done'))
+        family("items_skipped_total", "counter", "Items already up to date per stage.", per_stage('skipped'))
+        family("items_failed_total", "counter", "Items that failed per stage.", per_stage('failed'))
+        family("retries_total", "counter", "Retried attempts per stage.", per_stage('retries'))
+        family("items_per_second", "gauge", f"Items finished per second over the last {WINDOW_SECONDS:g}s.",
+               per_stage('per_second'))
+        family("eta_seconds", "gauge", "Estimated seconds until the stage finishes.",
+               [({'stage': name}, counters['eta_seconds']) for name, counters in stages.items()
+                if counters['eta_seconds'] is not None])
+        family("requests_in_flight", "gauge", "API requests in progress.", [({}, state['in_flight'])])
+        family("requests_total", "counter", "API requests started.", [({}, state['requests'])])
+        family("request_errors_total", "counter", "API requests that failed.", [({}, state['request_errors'])])
+        family("tokens_total", "counter", "Tokens reported by the API.",
+               [({'kind': kind}, count) for kind, count in state['tokens'].items()])
+        family("tokens_per_second", "gauge", f"Tokens per second over the last {WINDOW_SECONDS:g}s.",
+               [({}, state['tokens_per_second'])])
+        return '\n'.join(lines) + '\n'
+
+    def status_line(self):
+        """Return a one-line summary for the terminal."""
+        state = self.snapshot()
+        parts = [f"step {state['step']}" if state['step'] else "starting"]
+        # Stages appear in the order they started
+        for name, counters in state['stages'].items():
+            text = f"{name} {counters['done']}"
+            if counters['total']:
+                text += f"/{counters['total']} ({counters['done'] / counters['total']:.0%})"
+            if counters['per_second']:
+                text += f" {counters['per_second']:.1f}/s"
+            if counters['eta_seconds'] is not None:
+                text += f" ETA {format_duration(counters['eta_seconds'])}"
+            if counters['failed'] or counters['retries']:
+                text += f", {counters['failed']} failed, {counters['retries']} retried"
+            parts.append(text)
+        if state['requests']:
+            parts.append(f"{state['in_flight']} in flight, {state['tokens_per_second']:.0f} tok/s")
+        parts.append(f"{format_duration(state['elapsed_seconds'])} elapsed")
+        return ' | '.join(parts)
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class LiveView:
+    """Wraps a terminal stream so a status line stays below everything else written to it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.line = ''
+        self._shown = False
+        self._line_start = True
+        self._lock = threading.RLock()
+
+    def write(self, text):
+        with self._lock:
+            self._clear()
+            written = self.stream.write(text)
+            if text:
+                self._line_start = text.endswith('\n')
+            self._draw()
+            return written
+
+    def show(self, line):
+        with self._lock:
+            # The terminal would wrap a longer line, and \r only returns to the start of the last row
+            self.line = line[:shutil.get_terminal_size().columns - 1]
+            self._clear()
+            self._draw()
+            self.stream.flush()
+
+    def close(self):
+        with self._lock:
+            self._clear()
+            self.line = ''
+            self.stream.flush()
+
+    def _clear(self):
+        if self._shown:
+            self.stream.write('\r\x1b[K')
+            self._shown = False
+
+    def _draw(self):
+        # Drawn only below complete lines, so output written in parts is not split
+        if self.line and self._line_start:
+            self.stream.write(self.line)
+            self._shown = True
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics of the current run on GET /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics' or _progress is None:
+            self.send_error(404)
+            return
+        body = _progress.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Reporter:
+    """Background thread refreshing the status line and the metrics file."""
+
+    def __init__(self, progress, metrics_file=None, live=False):
+        self.progress = progress
+        self.metrics_file = metrics_file
+        self.view = None
+        self.log_lines = False
+        if live and sys.stdout.isatty():
+            self.view = sys.stdout = LiveView(sys.stdout)
+        elif live:
+            self.log_lines = True
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_log = time.perf_counter()
+        while not self._stop.wait(REFRESH_SECONDS):
+            self.refresh()
+            if self.log_lines and time.perf_counter() - last_log >= LOG_SECONDS:
+                print(f"Progress: {self.progress.status_line()}")
+                last_log = time.perf_counter()
+
+    def refresh(self):
+        if self.metrics_file:
+            atomic_write_text(self.metrics_file, self.progress.prometheus_text())
+        if self.view:
+            self.view.show(self.progress.status_line())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self.metrics_file:
+            atomic_write_text(self.metrics_file, self.progress.prometheus_text())
+        if self.view:
+            self.view.close()
+            sys.stdout = self.view.stream
+
+
+_reporter = None
+_server = None
+
+
+def start_progress(labels=None, metrics_file=None, metrics_port=None, live=False):
+    """Start recording progress in this process; return the Progress.
+
+    labels are added to every metric (e.g. {'book': 'novel.pdf'}). The
+    metrics are written to metrics_file every REFRESH_SECONDS and served
+    on http://127.0.0.1:<metrics_port>/metrics if those are given, and live
+    shows a status line (or, without a terminal, prints one every LOG_SECONDS).
+    """
+    global _progress, _reporter, _server
+    _progress = Progress(labels)
+    if metrics_port is not None:
+        _server = ThreadingHTTPServer(('127.0.0.1', metrics_port), MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        print(f"Metrics on {metrics_url()}")
+    if metrics_file or live:
+        _reporter = Reporter(_progress, metrics_file, live)
+    return _progress
+
+
+def stop_progress():
+    """Stop recording, write the final metrics and print a summary; return the Progress."""
+    global _progress, _reporter, _server
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    progress, _progress = _progress, None
+    if progress is not None and progress.stages:
+        print(f"Progress: {progress.status_line()}")
+    return progress
+
+
+def metrics_url():
+    """Return the URL of the /metrics endpoint, or None if it is not served."""
+    if _server is None:
+        return None
+    return f"http://127.0.0.1:{_server.server_address[1]}/metrics"
+
+
+def progress_enabled():
+    return _progress is not None
+
+
+def set_step(number, name):
+    if _progress is not None:
+        _progress.set_step(number, name)
+
+
+def add_total(stage, count):
+    """Add `count` items to the total of a stage (e.g. as pages are found)."""
+    if _progress is not None:
+        _progress.add_total(stage, count)
+
+
+def item_done(stage, skipped=False):
+    """Count one finished item; skipped items were already up to date."""
+    if _progress is not None:
+        _progress.item_done(stage, skipped)
+
+
+def item_failed(stage):
+    if _progress is not None:
+        _progress.item_failed(stage)
+
+
+def item_retried(stage):
+    if _progress is not None:
+        _progress.item_retried(stage)
+
+
+def track_request():
+    """Context manager counting an API request as in flight, e.g. `with track_request() as request: request.set(prompt_tokens=...)`."""
+    if _progress is None:
+        return _NULL_REQUEST
+    return Request(_progress)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Run Journal
+A crash-safe SQLite record of each page's state (pending, in-flight, done,
+failed with reason) so an interrupted run can be resumed by rescheduling
+only the pages that did not finish.
+"""
+
+import argparse
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+JOURNAL_FILENAME = "journal.sqlite"
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+# States that a resumed run has to reschedule
+UNFINISHED_STATES = (PENDING, IN_FLIGHT, FAILED)
+
+
+class RunJournal:
+    """Per-item states of a working directory, safe to update from several threads."""
+
+    def __init__(self, temp_dir):
+        self.path = Path(temp_dir) / JOURNAL_FILENAME
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            # WAL keeps every committed state change across crashes without an fsync per page
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    stage TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    reason TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (stage, item)
+                )""")
+
+    def register(self, stage, items):
+        """Add items as pending; items already in the journal keep their state."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO items (stage, item, state, updated) VALUES (?, ?, ?, ?)",
+                [(stage, item, PENDING, now) for item in items])
+
+    def mark(self, stage, item, state, reason=None):
+        """Record a state change; moving to in-flight counts as an attempt."""
+        attempt = 1 if state == IN_FLIGHT else 0
+        with self._lock, self._db:
+            self._db.execute("""
+                INSERT INTO items (stage, item, state, reason, attempts, updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (stage, item) DO UPDATE SET
+                    state = excluded.state, reason = excluded.reason,
+                    attempts = attempts + excluded.attempts, updated = excluded.updated""",
+                (stage, item, state, reason, attempt, time.time()))
+
+    def state(self, stage, item):
+        """Return (state, reason) of an item, or None if it was never registered."""
+        with self._lock:
+            return self._db.execute("SELECT state, reason FROM items WHERE stage = ? AND item = ?",
+                                    (stage, item)).fetchone()
+
+    def items(self, stage, states=None):
+        """Return item names of a stage, optionally only those in the given states."""
+        query = "SELECT item FROM items WHERE stage = ?"
+        args = [stage]
+        if states:
+            query += f" AND state IN ({', '.join('?' * len(states))})"
+            args += list(states)
+        with self._lock:
+            return [row[0] for row in self._db.execute(query + " ORDER BY item", args)]
+
+    def unfinished(self, stage):
+        """Items a resumed run must reschedule: pending, in-flight or failed."""
+        return self.items(stage, UNFINISHED_STATES)
+
+    def failures(self, stage):
+        """Return (item, reason) pairs of failed items."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT item, reason FROM items WHERE stage = ? AND state = ? ORDER BY item",
+                (stage, FAILED)).fetchall()
+
+    def summary(self, stage):
+        """Return a {state: count} mapping for a stage."""
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT state, COUNT(*) FROM items WHERE stage = ? GROUP BY state", (stage,)))
+
+    def forget(self, stage, keep=()):
+        """Drop a stage's items, except those named in `keep` (e.g. after a re-split)."""
+        keep = set(keep)
+        with self._lock, self._db:
+            for item in [row[0] for row in self._db.execute(
+                    "SELECT item FROM items WHERE stage = ?", (stage,))]:
+                if item not in keep:
+                    self._db.execute("DELETE FROM items WHERE stage = ? AND item = ?", (stage, item))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the run journal of a working directory")
+    parser.add_argument("temp_dir", help="Working directory (<book>_temp)")
+    parser.add_argument("--stage", default="translate", help="Stage to report (default: translate)")
+
+    args = parser.parse_args()
+
+    if not (Path(args.temp_dir) / JOURNAL_FILENAME).exists():
+        print(f"Error: no journal in {args.temp_dir}")
+        return 1
+
+    journal = RunJournal(args.temp_dir)
+    summary = journal.summary(args.stage)
+    for state in (PENDING, IN_FLIGHT, DONE, FAILED):
+        print(f"{state:>10}: {summary.get(state, 0)}")
+    for item, reason in journal.failures(args.stage):
+        print(f"  ✗ {item}: {reason}")
+    journal.close()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Scheduling Primitives
+A global token-bucket rate limiter for translation requests, a
+fair-share queue that round-robins work across books and a priority queue
+that lets urgent work jump ahead.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class RateLimiter:
+    """Thread-safe token bucket: at most `rate` acquisitions per `per` seconds."""
+
+    def __init__(self, rate, per=60.0, burst=None):
+        self.rate = float(rate)
+        self.per = float(per)
+        self.capacity = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * self.per / self.rate
+            time.sleep(wait)
+
+
+class FairQueue:
+    """Blocking queue that hands out items round-robin across keys (e.g. books)."""
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, key, item):
+        with self._cond:
+            self._queues.setdefault(key, deque()).append(item)
+            self._cond.notify()
+
+    def get(self):
+        """Return (key, item) from the next key in turn, or None once closed and drained."""
+        with self._cond:
+            while not self._queues and not self._closed:
+                self._cond.wait()
+            if not self._queues:
+                return None
+            key, items = next(iter(self._queues.items()))
+            item = items.popleft()
+            # Move this key to the back so other books get the next turns
+            del self._queues[key]
+            if items:
+                self._queues[key] = items
+            return key, item
+
+    def drop(self, key):
+        """Discard everything still queued for a key."""
+        with self._cond:
+            self._queues.pop(key, None)
+
+    def pending(self, key=None):
+        with self._cond:
+            if key is None:
+                return sum(len(items) for items in self._queues.values())
+            return len(self._queues.get(key, ()))
+
+    def close(self):
+        """Wake all waiting consumers; get() returns None once the queue is empty."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class PriorityWorkQueue:
+    """Blocking priority queue (lower value first, FIFO within a priority) with per-key control."""
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, key, item, priority):
+        with self._cond:
+            heapq.heappush(self._heap, (priority, next(self._seq), key, item))
+            self._cond.notify()
+
+    def get(self):
+        """Return (key, item) with the best priority, or None once closed and drained."""
+        with self._cond:
+            while not self._heap and not self._closed:
+                self._cond.wait()
+            if not self._heap:
+                return None
+            _, _, key, item = heapq.heappop(self._heap)
+            return key, item
+
+    def reprioritize(self, key, priority, keep=()):
+        """Move every queued item of a key to a new priority, keeping their order.
+
+        Items queued at a priority in `keep` stay where they are.
+        """
+        with self._cond:
+            self._heap = [(priority if k == key and p not in keep else p, seq, k, item)
+                          for p, seq, k, item in self._heap]
+            heapq.heapify(self._heap)
+
+    def drop(self, key):
+        """Discard everything still queued for a key."""
+        with self._cond:
+            self._heap = [entry for entry in self._heap if entry[2] != key]
+            heapq.heapify(self._heap)
+
+    def pending(self, key=None):
+        with self._cond:
+            return sum(1 for entry in self._heap if key is None or entry[2] == key)
+
+    def close(self):
+        """Wake all waiting consumers; get() returns None once the queue is empty."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Search Index
+Builds a compact full-text index of the rendered book for the search
+widget in template.html. Text is tokenized into words, and runs of CJK
+characters into overlapping bigrams, so Chinese and Japanese text is
+searchable without a dictionary. Each page is one document. Terms are
+stored sorted and front-coded, and their postings as base-36 deltas of
+document numbers.
+
+The index is sharded per chapter into small scripts (search/shardNNNN.js)
+so it also works from file:// pages. search/index.js only holds a Bloom
+filter of each shard's terms, and the widget loads it on first use and
+then only the shards that may hold every query term. When the index grows
+past SIZE_BUDGET of the book's text, terms found in most pages are
+dropped (the widget ignores them in queries) and an index still over
+budget is reported.
+"""
+
+import base64
+import html
+import json
+import re
+import time
+from pathlib import Path
+
+from atomic_io import atomic_write_text
+from chapter_html import CHAPTER_MAX_BYTES, HEADING
+from markdown_renderer import plain_text
+
+SEARCH_DIRNAME = "search"
+MANIFEST_SCRIPT = "index.js"
+
+# Largest index (all files) wanted, relative to the UTF-8 size of the book's text;
+# small books always get MIN_BUDGET_BYTES
+SIZE_BUDGET = 1.0
+MIN_BUDGET_BYTES = 64 * 1024
+
+# Over budget, terms found in at least this share of the pages are dropped, most common first
+COMMON_SHARE = 0.5
+
+# Bloom filters use this many bits per term and hash functions per lookup
+BLOOM_BITS_PER_TERM = 10
+BLOOM_HASHES = 5
+
+# Kana, CJK ideographs and Hangul are indexed as bigrams; the widget uses the same ranges
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN = re.compile(f'([{CJK}]+)|([^\\W_{CJK}]+)')
+
+
+def tokenize(text):
+    """Yield the index terms of text: lowercased words and CJK bigrams (a lone CJK character stays whole)."""
+    for cjk, word in TOKEN.findall(text.lower()):
+        if word:
+            yield word
+        elif len(cjk) == 1:
+            yield cjk
+        else:
+            for position in range(len(cjk) - 1):
+                yield cjk[position:position + 2]
+
+
+def fnv1a(term):
+    """32-bit FNV-1a hash of the UTF-8 bytes of term."""
+    value = 0x811c9dc5
+    for byte in term.encode('utf-8'):
+        value = ((value ^ byte) * 0x01000193) & 0xffffffff
+    return value
+
+
+def bloom_positions(term, bits):
+    first = fnv1a(term)
+    # Double hashing: the second hash is derived from the first and kept odd
+    second = ((first >> 16) | (first << 16)) & 0xffffffff | 1
+    return [(first + i * second) % bits for i in range(BLOOM_HASHES)]
+
+
+def bloom_filter(terms):
+    """Return (bit count, base64 bit array) of a Bloom filter holding terms."""
+    bits = max(64, -(-len(terms) * BLOOM_BITS_PER_TERM // 8) * 8)
+    array = bytearray(bits // 8)
+    for term in terms:
+        for position in bloom_positions(term, bits):
+            array[position >> 3] |= 1 << (position & 7)
+    return bits, base64.b64encode(bytes(array)).decode('ascii')
+
+
+def base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    text = ''
+    while True:
+        number, digit = divmod(number, 36)
+        text = digits[digit] + text
+        if not number:
+            return text
+
+
+def front_coded(terms):
+    """Join sorted terms with spaces, each as its shared prefix length with the previous term (0-9) and the rest."""
+    lines = []
+    previous = ''
+    for term in terms:
+        shared = 0
+        limit = min(len(term), len(previous), 9)
+        while shared < limit and term[shared] == previous[shared]:
+            shared += 1
+        lines.append(f"{shared}{term[shared:]}")
+        previous = term
+    return ' '.join(lines)
+
+
+def compact_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class SearchIndex:
+    """Collect rendered pages and write them out as a sharded search index.
+
+    cache, a dict kept by a long-running caller (watch mode), remembers the
+    terms of page bodies and the Bloom filters of shards between builds, so
+    only changed pages are tokenized again.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.used = {}
+        self.shards = []
+        self.title = ''
+        self.href = ''
+        self.shard_bytes = 0
+        self.text_bytes = 0
+        self.seconds = 0.0
+
+    def add_page(self, page, body, filename='', shard=None):
+        """Index one rendered page (with final heading ids).
+
+        Results link to the page's first heading in `filename`, or the
+        heading before the page. Without a shard number a new shard starts
+        at every level-1 heading or once a shard holds CHAPTER_MAX_BYTES.
+        """
+        started = time.perf_counter()
+        headings = HEADING.findall(body)
+        if shard is None:
+            if not self.shards or body.startswith('<h1') or self.shard_bytes >= CHAPTER_MAX_BYTES:
+                self.shards.append({'docs': [], 'terms': {}})
+                self.shard_bytes = 0
+        else:
+            while len(self.shards) < shard:
+                self.shards.append({'docs': [], 'terms': {}})
+        current = self.shards[-1] if shard is None else self.shards[shard - 1]
+
+        if headings:
+            self.title = plain_text(headings[0][2]).strip()
+            self.href = f"{filename}#{html.unescape(headings[0][1])}"
+        elif filename and not self.href.startswith(f"{filename}#"):
+            self.href = filename
+        text_bytes, terms = self._cached(('page', body), lambda: self._page_terms(body))
+        self.text_bytes += text_bytes
+        self.shard_bytes += len(body)
+
+        number = len(current['docs'])
+        current['docs'].append([self.title, self.href or '#', page])
+        for term in terms:
+            current['terms'].setdefault(term, []).append(number)
+        self.seconds += time.perf_counter() - started
+
+    def _cached(self, key, compute):
+        if self.cache is None:
+            return compute()
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+        self.used[key] = value
+        return value
+
+    @staticmethod
+    def _page_terms(body):
+        text = plain_text(body)
+        return len(text.encode('utf-8')), frozenset(tokenize(text))
+
+    def files(self):
+        """Return ({filename: script text}, stats) for the search directory, within the size budget."""
+        started = time.perf_counter()
+        # Estimated bytes and page count of every term; terms in most pages barely narrow a search
+        sizes = {}
+        pages = {}
+        for current in self.shards:
+            for term, docs in current['terms'].items():
+                sizes[term] = sizes.get(term, 0) + len(term.encode('utf-8')) + 2 * len(docs)
+                pages[term] = pages.get(term, 0) + len(docs)
+        budget = max(int(self.text_bytes * SIZE_BUDGET), MIN_BUDGET_BYTES)
+        total = sum(sizes.values())
+        documents = sum(len(current['docs']) for current in self.shards)
+        common = set()
+        for term in sorted(pages, key=pages.get, reverse=True):
+            if total <= budget or pages[term] < documents * COMMON_SHARE:
+                break
+            common.add(term)
+            total -= sizes[term]
+
+        files = {}
+        shards = []
+        for number, current in enumerate(self.shards, 1):
+            terms = sorted(term for term in current['terms'] if term not in common)
+            postings = []
+            for term in terms:
+                docs = current['terms'][term]
+                postings.append(','.join(base36(b - a) for a, b in zip([0] + docs, docs)))
+            shard = {'docs': current['docs'], 'terms': front_coded(terms), 'postings': ';'.join(postings)}
+            name = f"shard{number:04d}.js"
+            files[name] = f"bookSearchShard({number},{compact_json(shard)});\n"
+            bits, bloom = self._cached(('shard', files[name]), lambda: bloom_filter(terms))
+            shards.append({'file': name, 'bits': bits, 'bloom': bloom})
+        manifest = {'hashes': BLOOM_HASHES, 'shards': shards, 'common': sorted(common)}
+        files[MANIFEST_SCRIPT] = f"window.bookSearch={compact_json(manifest)};\n"
+
+        if self.cache is not None:
+            # Only what this build used is kept, so the cache does not grow with every edit
+            self.cache.clear()
+            self.cache.update(self.used)
+        self.seconds += time.perf_counter() - started
+        index_bytes = sum(len(text.encode('utf-8')) for text in files.values())
+        stats = {'shards': len(shards), 'terms': len(sizes) - len(common), 'dropped': len(common),
+                 'bytes': index_bytes, 'text_bytes': self.text_bytes, 'budget_bytes': budget,
+                 'seconds': self.seconds}
+        return files, stats
+
+
+def write_search_files(files, search_dir):
+    """Write the index files that changed into search_dir and remove stale ones; return the number written."""
+    search_dir = Path(search_dir)
+    search_dir.mkdir(parents=True, exist_ok=True)
+    written = 0
+    for name, text in files.items():
+        target = search_dir / name
+        try:
+            if target.read_text(encoding='utf-8') == text:
+                continue
+        except OSError:
+            pass
+        atomic_write_text(target, text)
+        written += 1
+    for path in search_dir.iterdir():
+        if path.name not in files:
+            path.unlink()
+    return written
+
+
+def report(stats):
+    share = stats['bytes'] / stats['text_bytes'] if stats['text_bytes'] else 0
+    dropped = f", {stats['dropped']} common terms dropped" if stats['dropped'] else ''
+    print(f"Search index: {stats['terms']} terms in {stats['shards']} shards, {stats['bytes'] / 1024:.0f} KB "
+          f"({share:.0%} of the book text{dropped}) built in {stats['seconds']:.2f}s")
+    if stats['bytes'] > stats['budget_bytes']:
+        print(f"Warning: the search index is over its budget of {SIZE_BUDGET:.0%} of the book text")
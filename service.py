@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+"""
+Translation Service
+A long-running daemon with a local HTTP job API. Extraction and rendering
+run on a warm process pool, translation on warm threads that share pooled
+API connections, a global rate limit and an in-memory translation cache.
+Urgent jobs, and single pages someone is waiting for, jump the queue.
+
+API (JSON unless noted):
+    POST   /jobs?filename=book.epub[&olang=zh&lang=auto&priority=urgent]   body: the ebook
+    GET    /jobs                              all jobs
+    GET    /jobs/<id>                         status and progress
+    GET    /jobs/<id>/pages                   per-page states
+    GET    /jobs/<id>/pages/<n>               translated page n (text/markdown)
+    POST   /jobs/<id>/pages/<n>/translate     translate page n next
+    POST   /jobs/<id>/priority?priority=urgent
+    GET    /jobs/<id>/output                  output.html, or output.md before rendering
+    DELETE /jobs/<id>                         cancel
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from batch import DEFAULT_RATE_LIMIT, DEFAULT_RETRIES, SUPPORTED_EXTENSIONS, run_book_stage
+from build_graph import BuildGraph
+from pipeline import temp_dir_for
+from run_journal import RunJournal
+from scheduler import PriorityWorkQueue, RateLimiter
+from step3_translate import JOURNAL_STAGE, create_translator, output_path_for, translate_tracked, translation_params
+
+DEFAULT_PORT = 8765
+
+# Queue priorities: lower runs first
+PRIORITIES = {'urgent': 0, 'normal': 10, 'low': 20}
+PAGE_NOW_PRIORITY = -1
+
+# Translations kept in memory across jobs
+DEFAULT_CACHE_ENTRIES = 20000
+
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class TranslationCache:
+    """Thread-safe in-memory LRU of translations keyed by content, model and language."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(content, model, target_language):
+        return hashlib.sha256(f"{model}\0{target_language}\0{content}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, translation):
+        with self._lock:
+            self._entries[key] = translation
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CachingTranslator:
+    """Wrap a translator so identical pages (in any job) are translated once."""
+
+    def __init__(self, translator, cache):
+        self.translator = translator
+        self.cache = cache
+        self.model = getattr(translator, 'model', 'manual')
+
+    def translate_markdown(self, markdown_content, target_language="zh"):
+        key = self.cache.key(markdown_content, self.model, target_language)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        translated = self.translator.translate_markdown(markdown_content, target_language)
+        self.cache.put(key, translated)
+        return translated
+
+
+@dataclass
+class Job:
+    """One submitted ebook."""
+
+    id: str
+    input_file: Path
+    options: Dict[str, str]
+    priority: int
+    status: str = "queued"
+    pages: List[Path] = field(default_factory=list)
+    done: set = field(default_factory=set)
+    failed: Dict[str, str] = field(default_factory=dict)
+    claimed: set = field(default_factory=set)
+    error: Optional[str] = None
+    submitted: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+    graph: Optional[BuildGraph] = None
+    journal: Optional[RunJournal] = None
+
+    @property
+    def temp_dir(self):
+        return temp_dir_for(self.input_file)
+
+    @property
+    def output_dir(self):
+        return self.temp_dir / "output"
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'input': self.input_file.name,
+            'status': self.status,
+            'priority': self.priority,
+            'pages': len(self.pages),
+            'pages_done': len(self.done),
+            'pages_failed': len(self.failed),
+            'error': self.error,
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+
+class TranslationService:
+    """Job manager behind the HTTP API; usable directly as a library."""
+
+    def __init__(self, root, translator, cpu_workers=None, translate_workers=4,
+                 rate_limit=DEFAULT_RATE_LIMIT, retries=DEFAULT_RETRIES, end_step=6,
+                 cache_entries=DEFAULT_CACHE_ENTRIES):
+        self.root = Path(root)
+        self.cache = TranslationCache(cache_entries)
+        self.translator = CachingTranslator(translator, self.cache)
+        self.cpu_workers = cpu_workers
+        self.translate_workers = translate_workers
+        self.limiter = RateLimiter(rate_limit)
+        self.retries = retries
+        self.end_step = end_step
+        self.jobs = {}
+        self.work = PriorityWorkQueue()
+        self._lock = threading.RLock()
+        self._executor = None
+        self._threads = []
+
+    def _new_executor(self):
+        # spawn, not fork: this process already runs HTTP and translator threads
+        return ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def start(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._executor = self._new_executor()
+        self._threads = [threading.Thread(target=self._translate_worker, name=f"translate-{i}", daemon=True)
+                         for i in range(self.translate_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self.work.close()
+        for thread in self._threads:
+            thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    # Job control
+
+    def submit(self, filename, data, options=None, priority='normal'):
+        """Store an uploaded ebook and queue it; return the Job."""
+        filename = Path(filename).name
+        if Path(filename).suffix.lower() not in SUPPORTED_EXTENSIONS:
+            raise ValueError(f"unsupported file type: {filename}")
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = self.root / job_id
+        job_dir.mkdir(parents=True)
+        input_file = job_dir / filename
+        input_file.write_bytes(data)
+
+        job = Job(job_id, input_file, dict(options or {}), PRIORITIES.get(priority, PRIORITIES['normal']))
+        with self._lock:
+            self.jobs[job_id] = job
+        job.status = "extracting"
+        self._submit_stage(job, 1, 2, self._on_extracted)
+        return job
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self.jobs[job_id]
+            if job.status in FINAL_STATES:
+                return job
+            self.work.drop(job_id)
+            self._finish(job, "cancelled")
+        return job
+
+    def set_priority(self, job_id, priority):
+        with self._lock:
+            job = self.jobs[job_id]
+            job.priority = PRIORITIES.get(priority, job.priority)
+            # Pages asked for with translate_page_now stay at the front
+            self.work.reprioritize(job_id, job.priority, keep=(PAGE_NOW_PRIORITY,))
+        return job
+
+    def translate_page_now(self, job_id, page_number):
+        """Put one page at the very front of the translation queue; return False if it is not queued."""
+        with self._lock:
+            job = self.jobs[job_id]
+            md_path = self.page_path(job, page_number)
+            if job.status != "translating" or md_path not in job.pages or md_path.name in job.done:
+                return False
+            self.work.put(job_id, md_path, PAGE_NOW_PRIORITY)
+            return True
+
+    def page_path(self, job, page_number):
+        return job.temp_dir / "pages" / f"page{int(page_number):04d}.md"
+
+    def page_states(self, job):
+        with self._lock:
+            states = []
+            for md_path in job.pages:
+                name = md_path.name
+                if name in job.done:
+                    state = "done"
+                elif name in job.failed:
+                    state = "failed"
+                elif name in job.claimed:
+                    state = "in_flight"
+                else:
+                    state = "pending"
+                states.append({'page': name, 'state': state, 'error': job.failed.get(name)})
+            return states
+
+    # Pipeline stages
+
+    def _submit_stage(self, job, start_step, end_step, callback):
+        options = {'output_lang': job.options.get('olang', 'zh'),
+                   'input_lang': job.options.get('lang', 'auto')}
+        args = (run_book_stage, str(job.input_file), start_step, end_step, options)
+        with self._lock:
+            try:
+                future = self._executor.submit(*args)
+            except BrokenProcessPool:
+                # A crashed worker breaks the whole pool; replace it so the service keeps running
+                print("Process pool broken, restarting it")
+                self._executor = self._new_executor()
+                future = self._executor.submit(*args)
+        future.add_done_callback(lambda f: callback(job, f))
+
+    def _on_extracted(self, job, future):
+        try:
+            failed_step, pages, output_lang = future.result()
+        except Exception as e:
+            failed_step, pages, output_lang = 2, [], None
+            job.error = str(e)
+        with self._lock:
+            if job.status == "cancelled":
+                return
+            if failed_step or not pages:
+                self._finish(job, "failed", job.error or f"extraction failed, see {job.temp_dir}.log")
+                return
+            job.pages = [Path(p) for p in pages]
+            job.options['olang'] = output_lang
+            job.graph = BuildGraph(job.temp_dir)
+            job.journal = RunJournal(job.temp_dir)
+            job.journal.register(JOURNAL_STAGE, [p.name for p in job.pages])
+            job.status = "translating"
+            for md_path in job.pages:
+                self.work.put(job.id, md_path, job.priority)
+
+    def _translate_worker(self):
+        while True:
+            task = self.work.get()
+            if task is None:
+                return
+            job_id, md_path = task
+            with self._lock:
+                job = self.jobs[job_id]
+                # A page may be queued twice (translate_page_now); translate it once
+                if job.status != "translating" or md_path.name in job.claimed or md_path.name in job.done:
+                    continue
+                job.claimed.add(md_path.name)
+
+            output_path = output_path_for(md_path, job.output_dir)
+            params = translation_params(self.translator, job.options['olang'])
+            error = None
+            try:
+                translate_tracked(md_path, output_path, job.options['olang'], self.translator,
+                                  job.graph, job.journal, params, self.retries, self.limiter.acquire)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+
+            with self._lock:
+                job.claimed.discard(md_path.name)
+                if job.status in FINAL_STATES:
+                    # Cancelled while this page was in flight
+                    self._close_journal(job)
+                    continue
+                if error:
+                    job.failed[md_path.name] = error
+                else:
+                    # A failed page may succeed when it is queued again
+                    job.failed.pop(md_path.name, None)
+                    job.done.add(md_path.name)
+                if job.status == "translating" and len(job.done.union(job.failed)) == len(job.pages):
+                    job.graph.save()
+                    if job.failed:
+                        self._finish(job, "failed", f"{len(job.failed)} pages failed to translate")
+                    elif self.end_step >= 4:
+                        job.status = "rendering"
+                        self._submit_stage(job, 4, self.end_step, self._on_rendered)
+                    else:
+                        self._finish(job, "done")
+
+    def _on_rendered(self, job, future):
+        try:
+            failed_step = future.result()[0]
+        except Exception as e:
+            failed_step, job.error = 4, str(e)
+        with self._lock:
+            if job.status == "cancelled":
+                return
+            if failed_step:
+                self._finish(job, "failed", job.error or f"step {failed_step} failed, see {job.temp_dir}.log")
+            else:
+                self._finish(job, "done")
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        self._close_journal(job)
+        print(f"[{job.id}] {job.input_file.name}: {status}" + (f" ({error})" if error else ""))
+
+
+    def _close_journal(self, job):
+        # Pages still in flight keep using the journal until they return
+        if job.journal is not None and not job.claimed:
+            job.journal.close()
+            job.journal = None
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Routes the job API onto a TranslationService (set as server.service)."""
+
+    routes = [
+        ('POST', r'/jobs', 'submit'),
+        ('GET', r'/jobs', 'list_jobs'),
+        ('GET', r'/jobs/(\w+)', 'status'),
+        ('DELETE', r'/jobs/(\w+)', 'cancel'),
+        ('POST', r'/jobs/(\w+)/cancel', 'cancel'),
+        ('POST', r'/jobs/(\w+)/priority', 'priority'),
+        ('GET', r'/jobs/(\w+)/pages', 'pages'),
+        ('GET', r'/jobs/(\w+)/pages/(\d+)', 'page'),
+        ('POST', r'/jobs/(\w+)/pages/(\d+)/translate', 'page_now'),
+        ('GET', r'/jobs/(\w+)/output', 'output'),
+    ]
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        # Keep request logging out of the job output
+        pass
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, url.path.rstrip('/'))
+            if route_method == method and match:
+                try:
+                    getattr(self, handler)(*match.groups())
+                except KeyError:
+                    self._send_json({'error': 'no such job'}, 404)
+                except ValueError as e:
+                    self._send_json({'error': str(e)}, 400)
+                return
+        self._send_json({'error': 'not found'}, 404)
+
+    def _send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, status=200):
+        self._send(json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8', status)
+
+    def _send_file(self, path, content_type):
+        if not path.exists():
+            self._send_json({'error': 'not available yet'}, 404)
+        else:
+            self._send(path.read_bytes(), content_type)
+
+    def submit(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        options = {key: self.query[key] for key in ('olang', 'lang') if key in self.query}
+        job = self.service.submit(self.query.get('filename', 'book.md'), data, options,
+                                  self.query.get('priority', 'normal'))
+        self._send_json(job.to_dict(), 201)
+
+    def list_jobs(self):
+        self._send_json([job.to_dict() for job in list(self.service.jobs.values())])
+
+    def status(self, job_id):
+        self._send_json(self.service.jobs[job_id].to_dict())
+
+    def cancel(self, job_id):
+        self._send_json(self.service.cancel(job_id).to_dict())
+
+    def priority(self, job_id):
+        self._send_json(self.service.set_priority(job_id, self.query.get('priority', 'normal')).to_dict())
+
+    def pages(self, job_id):
+        self._send_json(self.service.page_states(self.service.jobs[job_id]))
+
+    def page(self, job_id, number):
+        job = self.service.jobs[job_id]
+        md_path = self.service.page_path(job, number)
+        if md_path.name not in job.done:
+            self._send_json({'error': 'page not translated yet'}, 404)
+            return
+        self._send_file(output_path_for(md_path, job.output_dir), 'text/markdown; charset=utf-8')
+
+    def page_now(self, job_id, number):
+        job = self.service.jobs[job_id]
+        if job.pages and self.service.page_path(job, number) not in job.pages:
+            self._send_json({'error': 'no such page'}, 404)
+            return
+        queued = self.service.translate_page_now(job_id, number)
+        self._send_json({'queued': queued}, 202 if queued else 200)
+
+    def output(self, job_id):
+        job = self.service.jobs[job_id]
+        html_file = job.output_dir / "output.html"
+        if html_file.exists() and job.status == "done":
+            self._send_file(html_file, 'text/html; charset=utf-8')
+        else:
+            self._send_file(job.output_dir / "output.md", 'text/markdown; charset=utf-8')
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT):
+    """Start the service and an HTTP server for it; return the server (call serve_forever or run it in a thread)."""
+    service.start()
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the translation service with a local HTTP job API")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port (default: {DEFAULT_PORT})")
+    parser.add_argument("--root", default="service_jobs", help="Directory for uploaded books and their work dirs")
+    parser.add_argument("--api-key", help="SiliconFlow API密钥 (或设置SILICONFLOW_API_KEY环境变量)")
+    parser.add_argument("--cpu-workers", type=int, help="Processes for extraction and rendering (default: CPU count)")
+    parser.add_argument("--translate-workers", type=int, default=4, help="Concurrent translation requests (default: 4)")
+    parser.add_argument("--rate-limit", type=float, default=DEFAULT_RATE_LIMIT,
+                       help=f"Translation requests per minute, 0 for unlimited (default: {DEFAULT_RATE_LIMIT})")
+    parser.add_argument("--cache-entries", type=int, default=DEFAULT_CACHE_ENTRIES,
+                       help=f"Translations kept in memory across jobs (default: {DEFAULT_CACHE_ENTRIES})")
+
+    args = parser.parse_args()
+
+    translator = create_translator(args.api_key)
+    if translator is None:
+        print("Error: the service needs a working SiliconFlow API key")
+        return 1
+
+    service = TranslationService(args.root, translator, args.cpu_workers, args.translate_workers,
+                                 args.rate_limit, cache_entries=args.cache_entries)
+    server = serve(service, args.host, args.port)
+    print(f"Translation service listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -4,11 +4,14 @@ SiliconFlow AI Translation Module
 使用SiliconFlow API进行文本翻译
 """
 
-import requests
 import json
 import os
+import threading
 from typing import Optional
 
+from progress import track_request
+from tracing import span
+
 
 class SiliconFlowTranslator:
     """SiliconFlow翻译服务类"""
@@ -31,6 +34,19 @@ class SiliconFlowTranslator:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        
+        # 每个线程复用一个HTTP会话（保持连接），避免每次请求重新握手
+        self._local = threading.local()
+    
+    def _session(self):
+        """返回当前线程的requests会话"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = requests.Session()
+            session.headers.update(self.headers)
+            self._local.session = session
+        return session
     
     def translate_text(self, text: str, target_language: str = "zh", source_language: str = "auto") -> str:
         """
@@ -86,12 +102,24 @@ class SiliconFlowTranslator:
             "max_tokens": 4000
         }
         
+        import requests
+        
         try:
-            response = requests.post(self.base_url, json=payload, headers=self.headers, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            translated_text = result['choices'][0]['message']['content'].strip()
+            with span("api_call", "api", model=self.model, bytes=len(text.encode('utf-8'))) as api_span, \
+                    track_request() as request:
+                response = self._session().post(self.base_url, json=payload, timeout=30)
+                api_span.set(status=response.status_code)
+                response.raise_for_status()
+                
+                result = response.json()
+                translated_text = result['choices'][0]['message']['content'].strip()
+                
+                # 记录token用量（如果API返回）
+                usage = result.get('usage', {})
+                tokens = {'prompt_tokens': usage.get('prompt_tokens'),
+                          'completion_tokens': usage.get('completion_tokens')}
+                api_span.set(**tokens)
+                request.set(**tokens)
             
             return translated_text
             
@@ -9,15 +9,21 @@ import argparse
 import shutil
 from pathlib import Path
 
+from atomic_io import atomic_open
+from tracing import add_trace_arguments, trace_file_for, trace_session
 
-def create_temp_directory(input_file_path, auto_overwrite=False):
+
+def create_temp_directory(input_file_path, auto_overwrite=False, reuse_existing=False):
     """Create temporary directory based on input file name."""
     input_file = Path(input_file_path)
     temp_dir = input_file.parent / f"{input_file.stem}_temp"
     
     if temp_dir.exists():
         print(f"Warning: Temporary directory {temp_dir} already exists.")
-        if auto_overwrite:
+        if reuse_existing:
+            print("Using existing directory.")
+            return temp_dir
+        elif auto_overwrite:
             print("Auto-removing existing directory...")
             shutil.rmtree(temp_dir)
         else:
@@ -38,11 +44,56 @@ def create_temp_directory(input_file_path, auto_overwrite=False):
     return temp_dir
 
 
+def initialize_environment(input_file, input_lang=None, output_lang="zh", auto_overwrite=False,
+                           reuse_existing=False, packed=False):
+    """Create the working directory layout and config.txt; return the temp dir.
+
+    With packed=True pages, translations and images live in workspace.sqlite
+    instead of the pages/ and images/ directories.
+    """
+    temp_dir = create_temp_directory(input_file, auto_overwrite, reuse_existing)
+    
+    # Create subdirectories
+    if not packed:
+        (temp_dir / "pages").mkdir(exist_ok=True)
+        (temp_dir / "images").mkdir(exist_ok=True)
+    (temp_dir / "output").mkdir(exist_ok=True)
+    
+    # Save configuration
+    config_file = temp_dir / "config.txt"
+    with atomic_open(config_file) as f:
+        f.write(f"INPUT_FILE={input_file}\n")
+        f.write(f"INPUT_LANG={input_lang or 'auto'}\n")
+        f.write(f"OUTPUT_LANG={output_lang}\n")
+        f.write(f"TEMP_DIR={temp_dir}\n")
+        if packed:
+            f.write("WORKSPACE=packed\n")
+    
+    print(f"Configuration saved to: {config_file}")
+    return temp_dir
+
+
+def run(ctx):
+    """Run step 1 for a pipeline RunContext."""
+    if not Path(ctx.input_file).exists():
+        print(f"Error: Input file {ctx.input_file} does not exist.")
+        return False
+    
+    ctx.temp_dir = initialize_environment(ctx.input_file, ctx.input_lang, ctx.output_lang,
+                                          ctx.auto_overwrite, ctx.reuse_existing, ctx.packed)
+    ctx.reload_config()
+    print("Environment initialization completed successfully!")
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(description="Initialize environment for ebook translation")
     parser.add_argument("-i", "--input", required=True, help="Input ebook file path")
     parser.add_argument("-l", "--lang", help="Input text language (auto-detect if not specified)")
     parser.add_argument("--olang", default="zh", help="Output language (default: zh)")
+    parser.add_argument("--packed", action="store_true",
+                       help="Keep pages, translations and images in one workspace.sqlite file")
+    add_trace_arguments(parser)
     
     args = parser.parse_args()
     
@@ -52,23 +103,10 @@ def main():
         print(f"Error: Input file {args.input} does not exist.")
         return 1
     
-    # Create temporary directory
-    temp_dir = create_temp_directory(args.input)
-    
-    # Create subdirectories
-    (temp_dir / "pages").mkdir(exist_ok=True)
-    (temp_dir / "images").mkdir(exist_ok=True)
-    (temp_dir / "output").mkdir(exist_ok=True)
-    
-    # Save configuration
-    config_file = temp_dir / "config.txt"
-    with open(config_file, 'w') as f:
-        f.write(f"INPUT_FILE={args.input}\n")
-        f.write(f"INPUT_LANG={args.lang or 'auto'}\n")
-        f.write(f"OUTPUT_LANG={args.olang}\n")
-        f.write(f"TEMP_DIR={temp_dir}\n")
-    
-    print(f"Configuration saved to: {config_file}")
+    temp_dir = input_path.parent / f"{input_path.stem}_temp"
+    profile_dir = temp_dir / "profile" if args.profile else None
+    with trace_session("step1_init", trace_file_for(args.trace, temp_dir), profile_dir):
+        initialize_environment(args.input, args.lang, args.olang, packed=args.packed)
     print("Environment initialization completed successfully!")
     return 0
 
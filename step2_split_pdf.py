@@ -6,145 +6,278 @@ Converts input ebook to individual markdown pages.
 
 import os
 import argparse
+import hashlib
+import importlib.util
 from pathlib import Path
+import shutil
 import subprocess
+import sys
+import tempfile
 
-# Try to import optional dependencies
-try:
-    import fitz  # PyMuPDF
-    PYMUPDF_AVAILABLE = True
-except ImportError:
-    PYMUPDF_AVAILABLE = False
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
 
-try:
-    from pdf2image import convert_from_path
-    PDF2IMAGE_AVAILABLE = True
-except ImportError:
-    PDF2IMAGE_AVAILABLE = False
+from pipeline import RunContext
+from atomic_io import atomic_path, atomic_write_bytes, atomic_write_text
+from build_graph import BuildGraph
+from progress import add_total, item_done
+from tracing import add_trace_arguments, span, trace_file_for, trace_session
+from workspace_store import IMAGE, PACK_FILENAME, PAGE, PackedWorkspace
+from markdown_splitter import DEFAULT_MAX_PAGE_CHARS, iter_markdown_sections, split_markdown_file
+from ebook_reader import read_docx_chapters, read_epub_chapters
+from pdf_ocr import (TESSERACT_LANGS, check_tesseract, choose_ocr_dpi, needs_ocr,
+                     page_content_key, run_ocr)
 
-try:
-    import pypandoc
-    PYPANDOC_AVAILABLE = True
-except ImportError:
-    PYPANDOC_AVAILABLE = False
+# Optional dependencies are only imported by the functions that need them
+PYMUPDF_AVAILABLE = importlib.util.find_spec("fitz") is not None
+PYPANDOC_AVAILABLE = importlib.util.find_spec("pypandoc") is not None
+
+
+# Encoded formats that browsers display as-is and can be written without re-encoding
+RAW_IMAGE_FORMATS = {'jpeg': 'jpg', 'jpg': 'jpg', 'png': 'png'}
+
+
+def image_content_key(pdf_document, xref, smask=0):
+    """Hash the raw (still encoded) image stream, plus its soft mask if any."""
+    digest = hashlib.sha256(pdf_document.xref_stream_raw(xref) or b'')
+    if smask:
+        digest.update(b'|smask|')
+        digest.update(pdf_document.xref_stream_raw(smask) or b'')
+    return digest.hexdigest()
+
+
+def extract_pdf_image(pdf_document, xref, smask, images_dir, extracted):
+    """Write one PDF image to images_dir once and return its filename.
+
+    ``extracted`` maps both xrefs and content hashes to filenames already
+    written, so an image referenced from many pages (or stored under several
+    xrefs with identical content) is decoded and written only once.
+    """
+    if xref in extracted:
+        return extracted[xref]
+    
+    content_key = image_content_key(pdf_document, xref, smask)
+    if content_key in extracted:
+        extracted[xref] = extracted[content_key]
+        return extracted[xref]
+    
+    stem = f"img_{content_key[:16]}"
+    info = pdf_document.extract_image(xref) if not smask else None
+    
+    if info and info.get('ext') in RAW_IMAGE_FORMATS and info.get('colorspace', 3) != 4:
+        # Original JPEG/PNG stream, no decode/re-encode round-trip
+        img_filename = f"{stem}.{RAW_IMAGE_FORMATS[info['ext']]}"
+        atomic_write_bytes(images_dir / img_filename, info['image'])
+    else:
+        # CMYK, JPX, masked or exotic images: decode and convert to RGB PNG
+        import fitz
+        pix = fitz.Pixmap(pdf_document, xref)
+        if pix.n - pix.alpha >= 4:
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        if smask:
+            pix = fitz.Pixmap(pix, fitz.Pixmap(pdf_document, smask))
+        img_filename = f"{stem}.png"
+        with atomic_path(images_dir / img_filename) as tmp_path:
+            pix.save(str(tmp_path), output="png")
+        pix = None
+    
+    extracted[xref] = img_filename
+    extracted[content_key] = img_filename
+    return img_filename
 
 
-def load_config(temp_dir):
-    """Load configuration from config.txt file."""
-    config_file = Path(temp_dir) / "config.txt"
-    config = {}
+def build_page_markdown(page_num, text, page_images):
+    """Build the markdown for one PDF page."""
+    md_content = f"# Page {page_num+1}\n\n"
+    md_content += text + "\n\n"
     
-    with open(config_file, 'r') as f:
-        for line in f:
-            key, value = line.strip().split('=', 1)
-            config[key] = value
+    if page_images:
+        md_content += "## Images\n\n"
+        md_content += "\n\n".join(page_images) + "\n\n"
     
-    return config
+    return md_content
+
 
+def pdf_page_count(input_file):
+    """Return the number of pages in a PDF."""
+    import fitz
+    with fitz.open(input_file) as pdf_document:
+        return len(pdf_document)
 
-def split_pdf(input_file, temp_dir):
-    """Split PDF into individual markdown pages."""
+
+def split_pdf(input_file, temp_dir, ocr=True, ocr_lang='auto', workers=None, on_page=None, page_range=None):
+    """Split PDF into individual markdown pages; on_page(path) is called as each page is written.
+
+    page_range=(start, end) limits extraction to those 0-based pages (end exclusive),
+    so several workers can split one PDF in chunks.
+    """
     if not PYMUPDF_AVAILABLE:
         print("Error: PyMuPDF (fitz) not installed. Install with: pip install PyMuPDF")
         return False
     
+    import fitz
+    
     pdf_document = fitz.open(input_file)
     pages_dir = Path(temp_dir) / "pages"
     images_dir = Path(temp_dir) / "images"
     
-    total_pages = len(pdf_document)
+    first_page, last_page = page_range or (0, len(pdf_document))
+    last_page = min(last_page, len(pdf_document))
+    total_pages = max(0, last_page - first_page)
     print(f"Processing {total_pages} pages from PDF...")
+    add_total("extract", total_pages)
     
-    for page_num in range(total_pages):
-        page = pdf_document.load_page(page_num)
-        
-        # Extract text
-        text = page.get_text()
-        
-        # Extract images
-        image_list = page.get_images()
-        page_images = []
-        
-        for img_index, img in enumerate(image_list):
-            xref = img[0]
-            pix = fitz.Pixmap(pdf_document, xref)
+    if ocr and not check_tesseract():
+        print("Warning: tesseract not found, scanned pages will not be OCR'd")
+        ocr = False
+    tesseract_lang = TESSERACT_LANGS.get(ocr_lang, ocr_lang)
+    
+    # xref / content hash -> image filename, shared across all pages
+    extracted_images = {}
+    # Pages without a usable text layer, written after OCR: page_num -> images
+    ocr_pages = {}
+    ocr_tasks = []
+    
+    for page_num in range(first_page, last_page):
+        with span("pdf_page", page=page_num + 1) as page_span:
+            page = pdf_document.load_page(page_num)
+            
+            # Extract text
+            text = page.get_text()
             
-            if pix.n - pix.alpha < 4:  # GRAY or RGB
-                img_filename = f"page{page_num+1:04d}_img{img_index+1:03d}.png"
-                img_path = images_dir / img_filename
-                pix.save(str(img_path))
+            # Extract images
+            image_list = page.get_images(full=True)
+            page_images = []
+            
+            for img_index, img in enumerate(image_list):
+                xref, smask = img[0], img[1]
+                img_filename = extract_pdf_image(pdf_document, xref, smask, images_dir, extracted_images)
                 page_images.append(f"![Image {img_index+1}](../images/{img_filename})")
+            page_span.set(bytes=len(text), images=len(page_images))
             
-            pix = None
-        
-        # Create markdown content
-        md_content = f"# Page {page_num+1}\n\n"
-        md_content += text + "\n\n"
+            if ocr and needs_ocr(text):
+                dpi = choose_ocr_dpi(page.rect.width, page.rect.height)
+                cache_key = page_content_key(pdf_document, page, dpi, tesseract_lang)
+                ocr_tasks.append((page_num, cache_key, (str(input_file), page_num, dpi, tesseract_lang)))
+                ocr_pages[page_num] = (text, page_images)
+                continue
+            
+            # Save markdown file
+            md_filename = f"page{page_num+1:04d}.md"
+            md_path = pages_dir / md_filename
+            
+            atomic_write_text(md_path, build_page_markdown(page_num, text, page_images))
+            
+            print(f"Created: {md_filename}")
+            item_done("extract")
         
-        if page_images:
-            md_content += "## Images\n\n"
-            md_content += "\n\n".join(page_images) + "\n\n"
+        # Outside the span so time blocked on a full streaming queue is not counted as extraction
+        if on_page:
+            on_page(md_path)
+    
+    pdf_document.close()
+    
+    if ocr_tasks:
+        print(f"{len(ocr_tasks)} pages have no text layer, running OCR...")
+        with span("ocr", pages=len(ocr_tasks), workers=workers):
+            ocr_results = run_ocr(ocr_tasks, Path(temp_dir) / "ocr_cache", workers)
         
-        # Save markdown file
-        md_filename = f"page{page_num+1:04d}.md"
-        md_path = pages_dir / md_filename
+        for page_num, (text, page_images) in ocr_pages.items():
+            md_path = pages_dir / f"page{page_num+1:04d}.md"
+            atomic_write_text(md_path, build_page_markdown(page_num, ocr_results.get(page_num, text).strip(), page_images))
+            print(f"Created: {md_path.name}")
+            item_done("extract")
+            if on_page:
+                on_page(md_path)
+    
+    unique_images = len(set(extracted_images.values()))
+    print(f"PDF splitting completed. Created {total_pages} markdown files and {unique_images} unique images.")
+    return True
+
+
+def write_markdown_pages(sections, pages_dir, start_page=1, on_page=None):
+    """Write an iterable of markdown sections as consecutively numbered pages."""
+    page_num = start_page - 1
+    for md_content in sections:
+        page_num += 1
+        md_filename = f"page{page_num:04d}.md"
         
-        with open(md_path, 'w', encoding='utf-8') as f:
-            f.write(md_content)
+        md_path = Path(pages_dir) / md_filename
+        with span("write_page", page=page_num, bytes=len(md_content)):
+            atomic_write_text(md_path, md_content)
         
         print(f"Created: {md_filename}")
+        item_done("extract")
+        if on_page:
+            on_page(md_path)
     
-    pdf_document.close()
-    print(f"PDF splitting completed. Created {total_pages} markdown files.")
-    return True
+    return page_num - start_page + 1
 
 
-def handle_markdown_file(input_file, temp_dir):
+def handle_markdown_file(input_file, temp_dir, split_level=1, max_page_chars=DEFAULT_MAX_PAGE_CHARS, on_page=None):
     """Handle markdown files directly by splitting on headers."""
     pages_dir = Path(temp_dir) / "pages"
-    input_path = Path(input_file)
     
     try:
-        # Read the markdown file
-        with open(input_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        sections = split_markdown_file(input_file, split_level, max_page_chars)
+        page_count = write_markdown_pages(sections, pages_dir, on_page=on_page)
         
-        # Split by main headers (# )
-        sections = content.split('\n# ')
+        print(f"Markdown splitting completed. Created {page_count} pages.")
+        return True
         
-        for i, section_content in enumerate(sections):
-            if i == 0:
-                # First section doesn't need '# ' prefix added back
-                md_content = section_content
-            else:
-                md_content = '# ' + section_content
-            
-            # Skip empty sections
-            if not md_content.strip():
-                continue
-            
-            md_filename = f"page{i+1:04d}.md"
-            md_path = pages_dir / md_filename
-            
-            with open(md_path, 'w', encoding='utf-8') as f:
-                f.write(md_content)
-            
-            print(f"Created: {md_filename}")
+    except Exception as e:
+        print(f"Error processing markdown file: {e}")
+        return False
+
+
+def convert_epub_native(input_file, temp_dir, split_level=1, max_page_chars=DEFAULT_MAX_PAGE_CHARS, workers=None,
+                        on_page=None):
+    """Convert EPUB chapters from the OPF spine in parallel, one page set per chapter."""
+    pages_dir = Path(temp_dir) / "pages"
+    images_dir = Path(temp_dir) / "images"
+    
+    try:
+        page_count = 0
+        for chapter in read_epub_chapters(input_file, images_dir, workers):
+            # Every spine document starts a new page; large ones are sub-split
+            sections = iter_markdown_sections(chapter.splitlines(keepends=True), split_level, max_page_chars)
+            page_count += write_markdown_pages(sections, pages_dir, page_count + 1, on_page)
         
-        print(f"Markdown splitting completed. Created {len([s for s in sections if s.strip()])} pages.")
+        print(f"EPUB splitting completed. Created {page_count} markdown files.")
         return True
         
     except Exception as e:
-        print(f"Error processing markdown file: {e}")
+        print(f"Error reading EPUB file: {e}")
+        return False
+
+
+def convert_docx_native(input_file, temp_dir, split_level=1, max_page_chars=DEFAULT_MAX_PAGE_CHARS, on_page=None):
+    """Convert DOCX to pages split at heading-styled paragraphs."""
+    pages_dir = Path(temp_dir) / "pages"
+    images_dir = Path(temp_dir) / "images"
+    
+    try:
+        page_count = 0
+        for chapter in read_docx_chapters(input_file, images_dir, split_level):
+            sections = iter_markdown_sections(chapter.splitlines(keepends=True), split_level, max_page_chars)
+            page_count += write_markdown_pages(sections, pages_dir, page_count + 1, on_page)
+        
+        print(f"DOCX splitting completed. Created {page_count} markdown files.")
+        return True
+        
+    except Exception as e:
+        print(f"Error reading DOCX file: {e}")
         return False
 
 
-def convert_docx_epub(input_file, temp_dir):
+def convert_docx_epub(input_file, temp_dir, split_level=1, max_page_chars=DEFAULT_MAX_PAGE_CHARS, on_page=None):
     """Convert DOCX/EPUB to markdown using pandoc."""
     if not PYPANDOC_AVAILABLE:
         print("Error: pypandoc not installed. Install with: pip install pypandoc")
         return False
     
+    import pypandoc
+    
     pages_dir = Path(temp_dir) / "pages"
     input_path = Path(input_file)
     
@@ -155,32 +288,14 @@ def convert_docx_epub(input_file, temp_dir):
         output = pypandoc.convert_file(str(input_path), 'md', outputfile=str(temp_md))
         print(f"Converted {input_path.suffix} to markdown")
         
-        # Read the converted markdown
-        with open(temp_md, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Split by headings or page breaks (simple implementation)
-        pages = content.split('\n# ')
-        
-        for i, page_content in enumerate(pages):
-            if i == 0:
-                # First page doesn't need '# ' prefix added back
-                md_content = page_content
-            else:
-                md_content = '# ' + page_content
-            
-            md_filename = f"page{i+1:04d}.md"
-            md_path = pages_dir / md_filename
-            
-            with open(md_path, 'w', encoding='utf-8') as f:
-                f.write(md_content)
-            
-            print(f"Created: {md_filename}")
+        # Stream-split the converted markdown at headings
+        sections = split_markdown_file(temp_md, split_level, max_page_chars)
+        page_count = write_markdown_pages(sections, pages_dir, on_page=on_page)
         
         # Remove temporary file
         temp_md.unlink()
         
-        print(f"Document splitting completed. Created {len(pages)} markdown files.")
+        print(f"Document splitting completed. Created {page_count} markdown files.")
         
     except Exception as e:
         print(f"Error converting {input_path.suffix} file: {e}")
@@ -189,36 +304,129 @@ def convert_docx_epub(input_file, temp_dir):
     return True
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Split ebook into markdown pages")
-    parser.add_argument("temp_dir", help="Temporary directory path")
-    
-    args = parser.parse_args()
-    
-    # Load configuration
-    config = load_config(args.temp_dir)
-    input_file = config['INPUT_FILE']
+def split_params(ctx):
+    """Settings that decide how a book is split into pages."""
+    return {'split_level': ctx.split_level, 'max_page_chars': ctx.max_page_chars,
+            'reader': ctx.reader, 'ocr': ctx.ocr, 'input_lang': ctx.input_lang}
+
+
+def run(ctx):
+    """Run step 2 for a pipeline RunContext."""
+    if not ctx.config:
+        ctx.reload_config()
+    input_file = ctx.config['INPUT_FILE']
     input_path = Path(input_file)
+    temp_dir = ctx.temp_dir
     
     if not input_path.exists():
         print(f"Error: Input file {input_file} does not exist.")
-        return 1
+        return False
+    
+    # Skip extraction if the input and split settings are unchanged
+    graph = BuildGraph(temp_dir)
+    params = split_params(ctx)
+    if ctx.packed:
+        return split_packed(ctx, input_path, graph, params)
+    pages = ctx.refresh_pages()
+    if pages and graph.is_fresh("split", [input_path], params, pages, check_outputs=False):
+        print(f"Pages are up to date ({len(pages)} pages), skipping extraction")
+        if ctx.on_page:
+            for md_path in pages:
+                ctx.on_page(md_path)
+        return True
     
-    # Process based on file extension
+    # Remove pages from a previous split so renumbering leaves no stale files
+    for md_path in pages:
+        md_path.unlink()
+    
+    ok = extract_to(ctx, input_path, temp_dir)
+    
+    pages = ctx.refresh_pages()
+    if ok:
+        graph.record("split", [input_path], params, pages)
+        graph.save()
+    return ok
+
+
+def extract_to(ctx, input_path, temp_dir, on_page=None):
+    """Convert the input ebook into pages/ and images/ under temp_dir with the reader for its format."""
+    input_file = str(input_path)
+    on_page = on_page or ctx.on_page
     file_ext = input_path.suffix.lower()
     
     if file_ext == '.pdf':
-        if not split_pdf(input_file, args.temp_dir):
-            return 1
-    elif file_ext in ['.docx', '.epub']:
-        if not convert_docx_epub(input_file, args.temp_dir):
-            return 1
+        return split_pdf(input_file, temp_dir, ctx.ocr, ctx.input_lang, ctx.workers, on_page)
+    elif file_ext in ['.docx', '.epub'] and ctx.reader == 'pandoc':
+        return convert_docx_epub(input_file, temp_dir, ctx.split_level, ctx.max_page_chars, on_page)
+    elif file_ext == '.epub':
+        return convert_epub_native(input_file, temp_dir, ctx.split_level, ctx.max_page_chars, ctx.workers,
+                                   on_page)
+    elif file_ext == '.docx':
+        return convert_docx_native(input_file, temp_dir, ctx.split_level, ctx.max_page_chars, on_page)
     elif file_ext == '.md':
         # Handle markdown files directly
-        if not handle_markdown_file(input_file, args.temp_dir):
-            return 1
-    else:
-        print(f"Error: Unsupported file format {file_ext}")
+        return handle_markdown_file(input_file, temp_dir, ctx.split_level, ctx.max_page_chars, on_page)
+    
+    print(f"Error: Unsupported file format {file_ext}")
+    return False
+
+
+def split_packed(ctx, input_path, graph, params):
+    """Extract into a local scratch directory, then store pages and images in workspace.sqlite in one transaction."""
+    store = PackedWorkspace(ctx.temp_dir)
+    try:
+        page_count = len(store.names(PAGE))
+        if page_count and graph.is_fresh("split", [input_path], params):
+            print(f"Pages are up to date ({page_count} pages), skipping extraction")
+            return True
+        
+        scratch = Path(tempfile.mkdtemp(prefix="ebook_split_"))
+        try:
+            (scratch / "pages").mkdir()
+            (scratch / "images").mkdir()
+            if input_path.suffix.lower() == '.pdf':
+                # Keep the OCR cache in the working directory so reruns still reuse it
+                (ctx.temp_dir / "ocr_cache").mkdir(exist_ok=True)
+                (scratch / "ocr_cache").symlink_to((ctx.temp_dir / "ocr_cache").resolve(), target_is_directory=True)
+            
+            ok = extract_to(ctx, input_path, scratch, on_page=lambda md_path: None)
+            if not ok:
+                return False
+            with store.batch():
+                pages = store.pack_directory(PAGE, scratch / "pages", "page*.md", replace=True)
+                images = store.pack_directory(IMAGE, scratch / "images", replace=True)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    finally:
+        store.close()
+    
+    graph.record("split", [input_path], params)
+    graph.save()
+    print(f"Packed {len(pages)} pages and {len(images)} images into {PACK_FILENAME}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split ebook into markdown pages")
+    parser.add_argument("temp_dir", help="Temporary directory path")
+    parser.add_argument("--split-level", type=int, default=1, choices=range(1, 7),
+                       help="Split markdown at headings up to this level (default: 1)")
+    parser.add_argument("--max-page-chars", type=int, default=DEFAULT_MAX_PAGE_CHARS,
+                       help=f"Sub-split larger sections at paragraph boundaries, 0 disables (default: {DEFAULT_MAX_PAGE_CHARS})")
+    parser.add_argument("--reader", choices=["native", "pandoc"], default="native",
+                       help="DOCX/EPUB reader: native per-chapter reader or whole-book pandoc (default: native)")
+    parser.add_argument("--workers", type=int, help="Worker processes for EPUB chapters and OCR (default: CPU count)")
+    parser.add_argument("--no-ocr", action="store_true", help="Do not OCR PDF pages without a text layer")
+    add_trace_arguments(parser)
+    
+    args = parser.parse_args()
+    
+    ctx = RunContext.from_temp_dir(args.temp_dir, split_level=args.split_level,
+                                   max_page_chars=args.max_page_chars, reader=args.reader,
+                                   workers=args.workers, ocr=not args.no_ocr)
+    with trace_session("step2_split", trace_file_for(args.trace, ctx.temp_dir), ctx.temp_dir / "profile" if args.profile else None):
+        ok = run(ctx)
+    if not ok:
         return 1
     
     print("Step 2 completed successfully!")
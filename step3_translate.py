@@ -10,29 +10,29 @@ from pathlib import Path
 import glob
 from typing import Optional
 import sys
+import time
 
 # 添加项目根目录到Python路径
 sys.path.insert(0, str(Path(__file__).parent))
 
+from pipeline import load_config
+from atomic_io import atomic_write_text
+from build_graph import BuildGraph
+from progress import add_total, item_done, item_failed, item_retried
+from tracing import add_trace_arguments, span, trace_file_for, trace_session
+from run_journal import RunJournal, IN_FLIGHT, DONE, FAILED
 from siliconflow_translator import SiliconFlowTranslator
+from workspace_store import PAGE, TRANSLATION, PackedWorkspace
 
+# 日志中翻译阶段的名称
+JOURNAL_STAGE = "translate"
 
-def load_config(temp_dir):
-    """从config.txt文件加载配置"""
-    config_file = Path(temp_dir) / "config.txt"
-    config = {}
-    
-    with open(config_file, 'r') as f:
-        for line in f:
-            if '=' in line:
-                key, value = line.strip().split('=', 1)
-                config[key] = value
-    
-    return config
+# 默认重试间隔（秒），每次失败后翻倍
+RETRY_BACKOFF_SECONDS = 2.0
 
 
-def manual_translation_prompt(md_file, target_lang):
-    """生成手动翻译提示"""
+def manual_translation_prompt(md_file, target_lang, content=None):
+    """生成手动翻译提示；content为None时从md_file读取原文"""
     print(f"\n{'='*60}")
     print(f"手动翻译模式")
     print(f"{'='*60}")
@@ -40,8 +40,9 @@ def manual_translation_prompt(md_file, target_lang):
     print(f"目标语言: {target_lang}")
     print(f"{'='*60}")
     
-    with open(md_file, 'r', encoding='utf-8') as f:
-        content = f.read()
+    if content is None:
+        with open(md_file, 'r', encoding='utf-8') as f:
+            content = f.read()
     
     print("原文内容:")
     print(content)
@@ -61,14 +62,212 @@ def manual_translation_prompt(md_file, target_lang):
     return '\n'.join(translated_lines)
 
 
-def translate_markdown_files(temp_dir, use_api=False, api_key=None):
-    """翻译所有markdown文件"""
+def create_translator(api_key=None):
+    """初始化SiliconFlow翻译器，失败时返回None"""
+    try:
+        translator = SiliconFlowTranslator(api_key)
+        print("SiliconFlow API翻译器初始化成功")
+        return translator
+    except Exception as e:
+        print(f"SiliconFlow API初始化失败: {e}")
+        print("切换到手动翻译模式")
+        return None
+
+
+def output_path_for(md_path, output_dir):
+    """返回页面对应的译文文件路径"""
+    return Path(output_dir) / f"output_{Path(md_path).name}"
+
+
+def translate_content(content, name, target_lang, translator=None):
+    """翻译一页原文并返回译文；没有翻译器时进入手动翻译"""
+    if translator:
+        # 使用SiliconFlow API翻译
+        print("使用SiliconFlow API翻译中...")
+        return translator.translate_markdown(content, target_lang)
+    
+    # 手动翻译
+    return manual_translation_prompt(name, target_lang, content)
+
+
+def translate_page(md_path, output_path, target_lang, translator=None):
+    """翻译单个页面并写入译文；没有翻译器时进入手动翻译"""
+    # 读取原文内容
+    with open(md_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    
+    translated_content = translate_content(content, str(md_path), target_lang, translator)
+    
+    # 先写临时文件再重命名，崩溃时不会留下不完整的译文
+    atomic_write_text(output_path, translated_content)
+    
+    return translated_content
+
+
+def translation_params(translator, target_lang):
+    """翻译结果依赖的参数：模型与目标语言"""
+    model = getattr(translator, 'model', 'manual') if translator else 'manual'
+    return {'model': model, 'olang': target_lang}
+
+
+def translation_is_fresh(graph, md_path, output_path, params, adopt_existing=True):
+    """原文与参数未变且译文存在时无需重新翻译（保留人工修改的译文）
+
+    adopt_existing=True时，没有构建记录的已有译文（早期版本的工作目录）被记录下来并视为最新；
+    --force清除记录后不再沿用。
+    """
+    name = f"translate:{Path(md_path).name}"
+    if graph.is_fresh(name, [md_path], params, [output_path], check_outputs=False):
+        return True
+    if adopt_existing and graph.adopt_unrecorded and name not in graph.nodes and Path(output_path).exists():
+        record_translation(graph, md_path, output_path, params)
+        return True
+    return False
+
+
+def record_translation(graph, md_path, output_path, params):
+    """记录页面译文的构建信息"""
+    graph.record(f"translate:{Path(md_path).name}", [md_path], params, [output_path])
+
+
+def translate_tracked(md_path, output_path, target_lang, translator, graph, journal, params,
+                      retries=1, before_attempt=None, adopt_existing=True):
+    """翻译单页并在日志中记录状态；已是最新时返回False，失败时记录原因并抛出异常
+
+    journal为None时不记录页面状态（例如分布式模式下由任务队列记录）。
+    adopt_existing=False时，没有构建记录的已有译文也会重新翻译。
+    """
+    name = Path(md_path).name
+    mark = journal.mark if journal is not None else lambda *args: None
+    with span("translate_page", page=name) as page_span:
+        if translation_is_fresh(graph, md_path, output_path, params, adopt_existing):
+            mark(JOURNAL_STAGE, name, DONE)
+            page_span.set(skipped=True)
+            item_done(JOURNAL_STAGE, skipped=True)
+            return False
+        
+        mark(JOURNAL_STAGE, name, IN_FLIGHT)
+        try:
+            for attempt in range(retries):
+                if before_attempt:
+                    with span("rate_limit_wait", page=name):
+                        before_attempt()
+                try:
+                    translated = translate_page(md_path, output_path, target_lang, translator)
+                    break
+                except Exception:
+                    if attempt == retries - 1:
+                        raise
+                    item_retried(JOURNAL_STAGE)
+                    time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+        except Exception as e:
+            mark(JOURNAL_STAGE, name, FAILED, f"{type(e).__name__}: {e}")
+            item_failed(JOURNAL_STAGE)
+            raise
+        
+        page_span.set(bytes=len(translated.encode('utf-8')), attempts=attempt + 1)
+        record_translation(graph, md_path, output_path, params)
+        mark(JOURNAL_STAGE, name, DONE)
+        item_done(JOURNAL_STAGE)
+        return True
+
+
+def schedule_pages(journal, page_names, resume, target_lang):
+    """在日志中登记本次要翻译的页面并返回它们；resume=True时只返回上次未完成的页面"""
+    if resume and journal.items(JOURNAL_STAGE):
+        # 只处理上次未完成的页面，无需逐个检查已完成的译文
+        unfinished = set(journal.unfinished(JOURNAL_STAGE))
+        scheduled = [name for name in page_names if name in unfinished]
+        print(f"恢复运行: 重新调度 {len(scheduled)} 个未完成的页面")
+        return scheduled
+    
+    journal.forget(JOURNAL_STAGE, keep=page_names)
+    journal.register(JOURNAL_STAGE, page_names)
+    print(f"找到 {len(page_names)} 个文件需要翻译为 {target_lang}")
+    return list(page_names)
+
+
+def translate_packed_pages(temp_dir, target_lang, translator, resume=False):
+    """翻译打包工作区(workspace.sqlite)中的页面，每页译文在单独的事务中提交；有页面失败时返回False"""
+    store = PackedWorkspace(temp_dir)
+    journal = RunJournal(temp_dir)
+    params = translation_params(translator, target_lang)
+    failed = 0
+    
+    try:
+        page_names = store.names(PAGE)
+        if not page_names:
+            print("未找到需要翻译的页面")
+            return False
+        
+        scheduled = schedule_pages(journal, page_names, resume, target_lang)
+        store.delete(TRANSLATION, keep=page_names)
+        add_total(JOURNAL_STAGE, len(scheduled))
+        
+        for name in scheduled:
+            with span("translate_page", page=name) as page_span:
+                page = store.info(PAGE, name)
+                existing = store.info(TRANSLATION, name)
+                # 原文哈希与参数都未变化时跳过
+                if existing and existing['source_hash'] == page['hash'] and existing['params'] in (params, None):
+                    if existing['params'] is None:
+                        # 打包前没有构建记录的译文：记录参数后直接采用
+                        store.put(TRANSLATION, name, store.get(TRANSLATION, name), source_hash=page['hash'],
+                                  params=params)
+                    journal.mark(JOURNAL_STAGE, name, DONE)
+                    page_span.set(skipped=True)
+                    item_done(JOURNAL_STAGE, skipped=True)
+                    print(f"跳过 {name} - 已翻译")
+                    continue
+                
+                journal.mark(JOURNAL_STAGE, name, IN_FLIGHT)
+                try:
+                    translated = translate_content(store.get_text(PAGE, name), name, target_lang, translator)
+                    store.put(TRANSLATION, name, translated, source_hash=page['hash'], params=params)
+                except Exception as e:
+                    journal.mark(JOURNAL_STAGE, name, FAILED, f"{type(e).__name__}: {e}")
+                    item_failed(JOURNAL_STAGE)
+                    print(f"翻译 {name} 时出错: {e}")
+                    failed += 1
+                    continue
+                
+                page_span.set(bytes=len(translated.encode('utf-8')))
+                journal.mark(JOURNAL_STAGE, name, DONE)
+                item_done(JOURNAL_STAGE)
+                print(f"翻译完成: {name}")
+    finally:
+        journal.close()
+        store.close()
+    
+    if failed:
+        print(f"翻译未完成: {failed} 个页面失败，可使用 --resume 重试")
+        return False
+    
+    print("翻译完成!")
+    return True
+
+
+def translate_markdown_files(temp_dir, use_api=False, api_key=None, translator=None, resume=False):
+    """翻译所有markdown文件；可传入已初始化的翻译器。有页面失败时返回False
+
+    resume=True时只重新调度日志中未完成（待处理、进行中或失败）的页面。
+    """
     config = load_config(temp_dir)
     target_lang = config['OUTPUT_LANG']
     
     pages_dir = Path(temp_dir) / "pages"
     output_dir = Path(temp_dir) / "output"
     
+    # 初始化翻译器（如果使用API）
+    if translator is not None:
+        use_api = True
+    elif use_api:
+        translator = create_translator(api_key)
+        use_api = translator is not None
+    
+    if config.get('WORKSPACE') == 'packed':
+        return translate_packed_pages(temp_dir, target_lang, translator if use_api else None, resume)
+    
     # 获取所有页面markdown文件
     md_files = sorted(glob.glob(str(pages_dir / "page*.md")))
     
@@ -76,63 +275,57 @@ def translate_markdown_files(temp_dir, use_api=False, api_key=None):
         print("未找到需要翻译的markdown文件")
         return False
     
-    print(f"找到 {len(md_files)} 个文件需要翻译为 {target_lang}")
+    journal = RunJournal(temp_dir)
+    scheduled = set(schedule_pages(journal, [Path(md_file).name for md_file in md_files], resume, target_lang))
+    md_files = [md_file for md_file in md_files if Path(md_file).name in scheduled]
+    add_total(JOURNAL_STAGE, len(md_files))
     
-    # 初始化翻译器（如果使用API）
-    translator = None
-    if use_api:
-        try:
-            translator = SiliconFlowTranslator(api_key)
-            print("SiliconFlow API翻译器初始化成功")
-        except Exception as e:
-            print(f"SiliconFlow API初始化失败: {e}")
-            print("切换到手动翻译模式")
-            use_api = False
-    
-    for md_file in md_files:
-        md_path = Path(md_file)
-        output_filename = f"output_{md_path.name}"
-        output_path = output_dir / output_filename
-        
-        # 跳过已翻译的文件
-        if output_path.exists():
-            print(f"跳过 {md_path.name} - 已翻译")
-            continue
-        
-        print(f"正在翻译 {md_path.name}...")
-        
-        # 读取原文内容
-        with open(md_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        try:
-            if use_api and translator:
-                # 使用SiliconFlow API翻译
-                print("使用SiliconFlow API翻译中...")
-                translated_content = translator.translate_markdown(content, target_lang)
-            else:
-                # 手动翻译
-                translated_content = manual_translation_prompt(md_file, target_lang)
-            
-            # 保存翻译内容
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(translated_content)
-            
-            print(f"翻译完成: {output_filename}")
+    graph = BuildGraph(temp_dir)
+    params = translation_params(translator if use_api else None, target_lang)
+    failed = 0
+    
+    try:
+        for md_file in md_files:
+            md_path = Path(md_file)
+            output_path = output_path_for(md_path, output_dir)
             
-        except Exception as e:
-            print(f"翻译 {md_path.name} 时出错: {e}")
-            continue
+            try:
+                # 跳过原文和参数都未变化的已翻译文件
+                if translate_tracked(md_path, output_path, target_lang, translator if use_api else None,
+                                     graph, journal, params):
+                    print(f"翻译完成: {output_path.name}")
+                else:
+                    print(f"跳过 {md_path.name} - 已翻译")
+                
+            except Exception as e:
+                print(f"翻译 {md_path.name} 时出错: {e}")
+                failed += 1
+    finally:
+        graph.save()
+        journal.close()
+    
+    if failed:
+        print(f"翻译未完成: {failed} 个页面失败，可使用 --resume 重试")
+        return False
     
     print("翻译完成!")
     return True
 
 
+def run(ctx):
+    """在RunContext中执行步骤3，翻译器保存在ctx中供后续复用"""
+    if ctx.use_api and ctx.translator is None:
+        ctx.translator = create_translator(ctx.api_key)
+    return translate_markdown_files(ctx.temp_dir, ctx.use_api, ctx.api_key, ctx.translator, ctx.resume)
+
+
 def main():
     parser = argparse.ArgumentParser(description="翻译markdown页面")
     parser.add_argument("temp_dir", help="临时目录路径")
     parser.add_argument("--api", action="store_true", help="使用SiliconFlow API翻译")
     parser.add_argument("--api-key", help="SiliconFlow API密钥 (或设置SILICONFLOW_API_KEY环境变量)")
+    parser.add_argument("--resume", action="store_true", help="只重新翻译上次失败或中断的页面")
+    add_trace_arguments(parser)
     
     args = parser.parse_args()
     
@@ -143,7 +336,9 @@ def main():
         return 1
     
     # 执行翻译
-    if not translate_markdown_files(args.temp_dir, args.api, args.api_key):
+    with trace_session("step3_translate", trace_file_for(args.trace, temp_path), temp_path / "profile" if args.profile else None):
+        ok = translate_markdown_files(args.temp_dir, args.api, args.api_key, resume=args.resume)
+    if not ok:
         return 1
     
     print("步骤3完成!")
@@ -1,26 +1,27 @@
 #!/usr/bin/env python3
 """
 Step 4: Merge Markdown Files
-Merges all translated markdown files into a single output.md file.
+Merges all translated markdown files into a single output.md file and
+indexes its headings for the table of contents.
 """
 
 import argparse
 from pathlib import Path
 import glob
 import re
+import sys
 
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
 
-def load_config(temp_dir):
-    """Load configuration from config.txt file."""
-    config_file = Path(temp_dir) / "config.txt"
-    config = {}
-    
-    with open(config_file, 'r') as f:
-        for line in f:
-            key, value = line.strip().split('=', 1)
-            config[key] = value
-    
-    return config
+from heading_index import build_heading_index, load_headings
+from merge_index import file_source, load_index, merge_pages, read_file_chunks
+from tracing import add_trace_arguments, span, trace_file_for, trace_session
+from workspace_store import PAGE, TRANSLATION, PackedWorkspace, is_packed
+
+
+# Written between consecutive pages in output.md
+PAGE_SEPARATOR = '\n\n---\n\n'
 
 
 def natural_sort_key(text):
@@ -28,47 +29,112 @@ def natural_sort_key(text):
     return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', text)]
 
 
-def merge_markdown_files(temp_dir):
-    """Merge all translated markdown files into output.md."""
+def find_translated_files(temp_dir):
+    """Return translated page files in page order, ignoring pages no longer in pages/."""
     output_dir = Path(temp_dir) / "output"
+    pages_dir = Path(temp_dir) / "pages"
     
     # Get all translated markdown files
     translated_files = glob.glob(str(output_dir / "output_page*.md"))
     
-    if not translated_files:
-        print("No translated markdown files found.")
-        return False
+    # Drop translations left over from an earlier split with more pages
+    current_pages = {p.name for p in pages_dir.glob("page*.md")} if pages_dir.exists() else set()
+    if current_pages:
+        translated_files = [f for f in translated_files if Path(f).name[len("output_"):] in current_pages]
     
     # Sort files naturally (page0001, page0002, etc.)
     translated_files.sort(key=natural_sort_key)
+    return translated_files
+
+
+def report_merge(output_file, pages, how, merge_span):
+    """Print and trace how output.md was produced."""
+    merge_span.set(mode=how, bytes=output_file.stat().st_size)
+    if how == 'fresh':
+        print(f"{output_file} is up to date, skipping merge")
+    elif how == 'patched':
+        print(f"Patched the end of {output_file} in place ({pages} pages)")
+    else:
+        print(f"Merged {pages} pages into {output_file}")
+
+
+def index_headings(output_file):
+    """Bring output.md.headings.json up to date with a freshly merged output.md."""
+    if load_headings(output_file) is not None:
+        return
+    index = load_index(output_file, PAGE_SEPARATOR)
+    if index is None:
+        return
+    with span("index_headings", pages=len(index['pages'])):
+        build_heading_index(output_file, index)
+
+
+def merge_packed_translations(temp_dir):
+    """Merge the translations stored in workspace.sqlite into output.md in page order."""
+    output_file = Path(temp_dir) / "output" / "output.md"
+    store = PackedWorkspace(temp_dir)
+    try:
+        # Translations of pages no longer in the store are left over from an earlier split
+        pages = set(store.names(PAGE))
+        hashes = {name: digest for name, digest in store.hashes(TRANSLATION).items() if name in pages}
+        if not hashes:
+            print("No translated pages found in the packed workspace.")
+            return False
+        
+        names = sorted(hashes, key=natural_sort_key)
+        print(f"Found {len(names)} translated pages to merge")
+        
+        # Stored content hashes identify unchanged pages exactly
+        sources = [(name, hashes[name], lambda name=name: [store.get_text(TRANSLATION, name)]) for name in names]
+        with span("merge", pages=len(names)) as merge_span:
+            how = merge_pages(output_file, sources, PAGE_SEPARATOR)
+            report_merge(output_file, len(names), how, merge_span)
+        index_headings(output_file)
+    finally:
+        store.close()
+    return True
+
+
+def merge_markdown_files(temp_dir):
+    """Merge all translated markdown files into output.md.
+
+    Pages are streamed into the file and their byte offsets, lines and hashes
+    are recorded in output.md.index.json; when only some pages changed the
+    unchanged spans are kept instead of re-reading every page.
+    """
+    if is_packed(temp_dir):
+        return merge_packed_translations(temp_dir)
+    
+    output_dir = Path(temp_dir) / "output"
+    translated_files = find_translated_files(temp_dir)
+    
+    if not translated_files:
+        print("No translated markdown files found.")
+        return False
     
     print(f"Found {len(translated_files)} translated files to merge")
     
     # Output file
     output_file = output_dir / "output.md"
     
-    with open(output_file, 'w', encoding='utf-8') as outf:
-        for i, md_file in enumerate(translated_files):
-            print(f"Merging {Path(md_file).name}")
-            
-            # Read content
-            with open(md_file, 'r', encoding='utf-8') as inf:
-                content = inf.read().strip()
-            
-            # Write content
-            outf.write(content)
-            
-            # Add page separator (except for the last page)
-            if i < len(translated_files) - 1:
-                outf.write('\n\n---\n\n')
-    
-    print(f"Merged {len(translated_files)} files into {output_file}")
+    sources = [(Path(md_file).name[len("output_"):], file_source(md_file),
+                lambda md_file=md_file: read_file_chunks(md_file)) for md_file in translated_files]
+    with span("merge", pages=len(translated_files)) as merge_span:
+        how = merge_pages(output_file, sources, PAGE_SEPARATOR)
+        report_merge(output_file, len(translated_files), how, merge_span)
+    index_headings(output_file)
     return True
 
 
+def run(ctx):
+    """Run step 4 for a pipeline RunContext."""
+    return merge_markdown_files(ctx.temp_dir)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Merge translated markdown files")
     parser.add_argument("temp_dir", help="Temporary directory path")
+    add_trace_arguments(parser)
     
     args = parser.parse_args()
     
@@ -79,7 +145,9 @@ def main():
         return 1
     
     # Merge files
-    if not merge_markdown_files(args.temp_dir):
+    with trace_session("step4_merge", trace_file_for(args.trace, temp_path), temp_path / "profile" if args.profile else None):
+        ok = merge_markdown_files(args.temp_dir)
+    if not ok:
         return 1
     
     print("Step 4 completed successfully!")
@@ -1,26 +1,287 @@
 #!/usr/bin/env python3
 """
 Step 5: Convert Markdown to HTML
-Converts the merged markdown file to HTML using pandoc with template.
+Converts the merged markdown file to HTML with template.html, either with
+the in-process renderer (pages are rendered separately and cached by content
+hash in render_cache.sqlite) or with pandoc (--renderer pandoc) when
+pandoc's exact output is needed; large books are then rendered in chunks by
+parallel pandoc processes and stitched into one document. The default,
+--renderer auto, uses pandoc only for books with pandoc-only syntax.
+--html-layout chapters writes a file per chapter and an index page instead,
+and --html-layout epub an EPUB3 package.
 """
 
 import argparse
+import hashlib
+import json
+import os
 from pathlib import Path
-import subprocess
+import sqlite3
 import shutil
+import subprocess
+import sys
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from atomic_io import atomic_open, atomic_path
+from build_graph import BuildGraph
+from epub_writer import EPUB_FILENAME, write_epub
+from heading_index import load_headings, nested_toc
+from chapter_html import INDEX_FILENAME, SITE_DIRNAME, link_images, shared_stylesheet, write_chapter_site
+from image_assets import EmbeddedImages, asset_params, pandoc_image_filter, prepare_images, sync_images
+from markdown_renderer import RENDERER_VERSION, HeadingIds, fill_template, find_pandoc_syntax, render_fragment
+from merge_index import load_index
+from pipeline import load_config
+from pandoc_render import plan_chunks, render_chunked, run_pandoc
+from progress import add_total, item_done
+from search_index import SEARCH_DIRNAME, SearchIndex, report, write_search_files
+from step4_merge_md import PAGE_SEPARATOR
+from step6_generate_toc import add_toc_styles
+from tracing import add_trace_arguments, span, trace_file_for, trace_session
+from workspace_store import IMAGE, PackedWorkspace, is_packed
+
+
+RENDERERS = ["auto", "builtin", "pandoc"]
+
+HTML_LAYOUTS = ["single", "chapters", "epub"]
+
+RENDER_CACHE_FILENAME = "render_cache.sqlite"
+
+# Used by the builtin renderer when template.html is missing
+DEFAULT_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8" />
+<title>$title$</title>
+$for(css)$<link rel="stylesheet" href="$css$" />
+$endfor$</head>
+<body>
+$body$
+</body>
+</html>
+"""
+
+# Marks where the rendered pages go in the filled template
+BODY_MARK = "\x00body\x00"
+
+
+class FragmentCache:
+    """Rendered HTML fragments keyed by renderer version and page content hash."""
+    
+    def __init__(self, temp_dir):
+        self._db = sqlite3.connect(Path(temp_dir) / RENDER_CACHE_FILENAME, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS fragments (key TEXT PRIMARY KEY, html TEXT NOT NULL, "
+                         "ids TEXT NOT NULL)")
+    
+    def get(self, key):
+        row = self._db.execute("SELECT html, ids FROM fragments WHERE key = ?", (key,)).fetchone()
+        return (row[0], [tuple(heading) for heading in json.loads(row[1])]) if row else None
+    
+    def put(self, key, fragment, heading_ids):
+        self._db.execute("INSERT OR REPLACE INTO fragments VALUES (?, ?, ?)", (key, fragment, json.dumps(heading_ids)))
+    
+    def prune(self, keep):
+        """Drop fragments of pages that are no longer in the book."""
+        keep = set(keep)
+        stale = [(key,) for (key,) in self._db.execute("SELECT key FROM fragments") if key not in keep]
+        self._db.executemany("DELETE FROM fragments WHERE key = ?", stale)
+    
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class RenderMemo:
+    """In-memory caches a long-running process (watch mode) keeps across renders.
+    
+    fragments holds the fragments of the last render by render cache key and
+    search the search index's page terms and shard filters, so a rebuild
+    only renders and indexes the pages that changed.
+    """
+    
+    def __init__(self):
+        self.fragments = {}
+        self.search = {}
+
+
+def markdown_pages(md_file):
+    """Return (page, content hash, offset, length) for each page of output.md from its merge index.
+    
+    Without a valid index the whole file is treated as one page.
+    """
+    index = load_index(md_file, PAGE_SEPARATOR)
+    if index is None:
+        data = Path(md_file).read_bytes()
+        return [("output.md", hashlib.sha256(data).hexdigest(), 0, len(data))]
+    return [(entry['page'], entry['hash'], entry['offset'], entry['length']) for entry in index['pages']]
+
+
+def page_fragments(temp_dir, md_file, counts=None, memo=None):
+    """Yield (page, fragment, heading ids) for each page of output.md, rendering pages missing from the render cache.
+    
+    counts, if given, receives the number of pages and of cache hits, and
+    the pages are then reported as "render" progress. memo, a dict kept by a
+    long-running caller, is checked before the render cache and left
+    holding the fragments of this pass.
+    """
+    pages = markdown_pages(md_file)
+    cache = FragmentCache(temp_dir)
+    keys = []
+    fragments = {}
+    if counts is not None:
+        add_total("render", len(pages))
+    try:
+        with open(md_file, 'rb') as src:
+            for page, digest, offset, length in pages:
+                key = f"{RENDERER_VERSION}:{digest}"
+                keys.append(key)
+                hit = memo.get(key) if memo is not None else None
+                hit = hit or cache.get(key)
+                if hit:
+                    fragment, ids = hit
+                    if counts is not None:
+                        counts['cached'] = counts.get('cached', 0) + 1
+                else:
+                    src.seek(offset)
+                    fragment, ids = render_fragment(src.read(length).decode('utf-8'))
+                    cache.put(key, fragment, ids)
+                if counts is not None:
+                    counts['pages'] = counts.get('pages', 0) + 1
+                    item_done("render", skipped=bool(hit))
+                fragments[key] = (fragment, ids)
+                yield page, fragment, ids
+        cache.prune(keys)
+        if memo is not None:
+            memo.clear()
+            memo.update(fragments)
+    finally:
+        cache.close()
+
+
+def inline_stylesheet():
+    """Return style.css as a <style> element for the head of a self-contained page, or ''."""
+    if not Path("style.css").exists():
+        return ''
+    return f"<style>\n{Path('style.css').read_text(encoding='utf-8')}\n</style>\n"
+
+
+def write_search_index(search, search_dir, metrics=None):
+    """Write the search index built while rendering and report its size and build time."""
+    with span("search_index") as search_span:
+        files, stats = search.files()
+        written = write_search_files(files, search_dir)
+        search_span.set(written=written, **stats)
+    report(stats)
+    if metrics is not None:
+        metrics['search_index_bytes'] = stats['bytes']
+        metrics['search_index_seconds'] = stats['seconds']
+    return stats
+
 
+def render_builtin(temp_dir, md_file, html_file, template_file, title, assets=None, headings=None, metrics=None,
+                   memo=None):
+    """Render output.md page by page with the in-process renderer, reusing cached page fragments.
+    
+    Like pandoc --self-contained, style.css is inlined and images are embedded
+    as data: URIs, so output.html can be shipped on its own. With the heading index from step 4 the table of contents and its styles
+    are written along with the pages, leaving nothing for step 6 to do. A
+    template with a search widget ($search$) also gets a search index. A
+    RenderMemo in `memo` keeps fragments and search terms for the next render.
+    """
+    images = EmbeddedImages()
+    template = template_file.read_text(encoding='utf-8') if template_file else DEFAULT_TEMPLATE
+    search = SearchIndex(memo.search if memo else None) if '$search$' in template else None
+    head, tail = fill_template(template, {'title': title, 'css': [], 'body': BODY_MARK,
+                                          'search': f"{SEARCH_DIRNAME}/" if search else ''}).split(BODY_MARK, 1)
+    head = head.replace('</head>', inline_stylesheet() + '</head>', 1)
+    if headings:
+        head = head.replace('</head>', add_toc_styles() + '</head>', 1) + nested_toc(headings)
+    
+    heading_ids = HeadingIds()
+    counts = {'pages': 0, 'cached': 0}
+    with span("render", renderer="builtin") as render_span, atomic_open(html_file) as out:
+        out.write(head)
+        fragments = page_fragments(temp_dir, md_file, counts, memo.fragments if memo else None)
+        for number, (page, fragment, ids) in enumerate(fragments):
+            # Pages are separated by --- in output.md; the comment maps HTML back to its page
+            if number:
+                out.write("\n<hr />\n")
+            out.write(f"<!-- page: {page} -->\n")
+            body = heading_ids.fill(fragment, ids)
+            if search:
+                search.add_page(page, body)
+            out.write(link_images(body, images, Path(html_file).parent, lazy=False, assets=assets))
+        out.write(tail)
+        render_span.set(pages=counts['pages'], cached=counts['cached'], output_bytes=out.tell())
+    
+    print(f"Rendered {counts['pages'] - counts['cached']} of {counts['pages']} pages "
+          f"({counts['cached']} from the render cache)")
+    if search:
+        write_search_index(search, Path(html_file).parent / SEARCH_DIRNAME, metrics)
+    return True
 
-def load_config(temp_dir):
-    """Load configuration from config.txt file."""
-    config_file = Path(temp_dir) / "config.txt"
-    config = {}
+
+def render_chapters(temp_dir, md_file, output_dir, template_file, title, assets=None, metrics=None, memo=None):
+    """Render output.md into one HTML file per chapter and an index page under output/html."""
+    template = template_file.read_text(encoding='utf-8') if template_file else DEFAULT_TEMPLATE
+    css = ["style.css"] if Path("style.css").exists() else []
+    toc_css = shared_stylesheet(add_toc_styles())[1]
+    search = SearchIndex(memo.search if memo else None) if '$search$' in template else None
     
-    with open(config_file, 'r') as f:
-        for line in f:
-            key, value = line.strip().split('=', 1)
-            config[key] = value
+    # Pages are read twice (to plan chapters, then to write them); count cache hits once
+    counts = {'pages': 0, 'cached': 0}
+    passes = iter([counts])
+    fragments = memo.fragments if memo else None
+    with span("render", renderer="builtin", layout="chapters") as render_span:
+        written, total, chapters = write_chapter_site(
+            lambda: page_fragments(temp_dir, md_file, next(passes, None), fragments), output_dir, template, css, title, toc_css, assets, search)
+        render_span.set(pages=counts['pages'], cached=counts['cached'], chapters=chapters, written=written)
     
-    return config
+    print(f"Rendered {counts['pages'] - counts['cached']} of {counts['pages']} pages "
+          f"({counts['cached']} from the render cache)")
+    print(f"Wrote {written} of {total} files for {chapters} chapters to {Path(output_dir) / SITE_DIRNAME}")
+    if search:
+        write_search_index(search, Path(output_dir) / SITE_DIRNAME / SEARCH_DIRNAME, metrics)
+    return True
+
+
+def render_epub(temp_dir, md_file, epub_file, title, assets=None, memo=None):
+    """Render output.md into an EPUB3 package with the in-process renderer."""
+    config = load_config(temp_dir) if (Path(temp_dir) / "config.txt").exists() else {}
+    counts = {'pages': 0, 'cached': 0}
+    passes = iter([counts])
+    fragments = memo.fragments if memo else None
+    with span("render", renderer="builtin", layout="epub") as render_span:
+        chapters, entries, reused = write_epub(
+            lambda: page_fragments(temp_dir, md_file, next(passes, None), fragments), epub_file, Path(md_file).parent,
+            title, config.get('OUTPUT_LANG', 'zh'), config.get('INPUT_FILE', str(temp_dir)),
+            "style.css" if Path("style.css").exists() else None, assets)
+        render_span.set(pages=counts['pages'], cached=counts['cached'], chapters=chapters, reused=reused,
+                        output_bytes=Path(epub_file).stat().st_size)
+    
+    print(f"Rendered {counts['pages'] - counts['cached']} of {counts['pages']} pages "
+          f"({counts['cached']} from the render cache)")
+    print(f"Packed {chapters} chapters into {epub_file} ({reused} of {entries} entries reused from the previous package)")
+    return True
+
+
+def choose_renderer(md_file, layout):
+    """Resolve --renderer auto: builtin, unless output.md uses syntax only pandoc renders."""
+    with open(md_file, 'r', encoding='utf-8') as f:
+        feature = find_pandoc_syntax(f)
+    if feature is None:
+        return "builtin"
+    if layout != "single":
+        print(f"Warning: {md_file.name} uses {feature}, which only pandoc renders; "
+              f"the {layout} layout leaves them as text")
+        return "builtin"
+    if shutil.which("pandoc") is None:
+        print(f"Warning: {md_file.name} uses {feature}, which only pandoc renders; "
+              "pandoc is not installed, so they are left as text")
+        return "builtin"
+    print(f"{md_file.name} uses {feature}; rendering with pandoc")
+    return "pandoc"
 
 
 def check_pandoc():
@@ -36,27 +297,50 @@ def check_pandoc():
         return False
 
 
-def copy_images_to_output(temp_dir, output_dir):
-    """Copy images directory to output directory for HTML access."""
-    images_dir = Path(temp_dir) / "images"
-    output_images_dir = output_dir / "images"
-    
-    if images_dir.exists() and any(images_dir.iterdir()):
-        if output_images_dir.exists():
-            shutil.rmtree(output_images_dir)
-        
-        shutil.copytree(images_dir, output_images_dir)
-        print(f"Copied images to {output_images_dir}")
-        return True
-    
-    return False
+def sync_images_to_output(assets, output_dir):
+    """Link the processed images into output/images, touching only new ones."""
+    if not assets and not (output_dir / "images").exists():
+        return 0
+    changed = sync_images(assets, output_dir / "images")
+    print(f"Synced images to {output_dir / 'images'} ({changed} of {len(set(assets.values()))} new)")
+    return changed
 
 
-def convert_to_html(temp_dir):
-    """Convert merged markdown to HTML using pandoc."""
+def materialize_packed_images(temp_dir):
+    """Write images stored in workspace.sqlite to images/ (pandoc embeds them from files)."""
+    store = PackedWorkspace(temp_dir)
+    try:
+        written = store.materialize(IMAGE, Path(temp_dir) / "images")
+    finally:
+        store.close()
+    if written:
+        print(f"Extracted {written} images from the packed workspace")
+    return written
+
+
+def convert_to_html(temp_dir, renderer="auto", workers=None, metrics=None, layout="single", memo=None):
+    """Convert merged markdown to HTML with the builtin renderer or pandoc.
+    
+    With renderer "auto" the builtin renderer is used unless output.md holds
+    pandoc-only syntax (see choose_renderer).
+    
+    With layout "chapters" the builtin renderer writes one file per chapter
+    and an index page to output/html instead of output.html, and with layout
+    "epub" it writes output.epub. Images are processed by up to `workers`
+    processes and large books rendered by as many pandoc processes (default:
+    CPU count); pandoc's parallelism and peak memory are added to `metrics` if given.
+    The builtin renderer keeps its work in `memo` (a RenderMemo) if given.
+    """
     output_dir = Path(temp_dir) / "output"
     md_file = output_dir / "output.md"
     html_file = output_dir / "output.html"
+    if layout == "chapters":
+        html_file = output_dir / SITE_DIRNAME / INDEX_FILENAME
+    elif layout == "epub":
+        html_file = output_dir / EPUB_FILENAME
+    if layout != "single" and renderer == "pandoc":
+        print(f"Error: {layout} output is only written by the builtin renderer")
+        return False
     
     if not md_file.exists():
         print(f"Error: Markdown file {md_file} does not exist.")
@@ -66,48 +350,134 @@ def convert_to_html(temp_dir):
     # Check for template
     template_file = Path("template.html")
     if not template_file.exists():
-        print("Warning: template.html not found, using default pandoc template")
+        print("Warning: template.html not found, using the default template")
         template_args = []
     else:
         template_args = ["--template", str(template_file)]
     
-    # Copy images to output directory
-    copy_images_to_output(temp_dir, output_dir)
+    # Re-render only if output.md, template.html, style.css or the renderer changed
+    render_inputs = [md_file] + [p for p in (template_file, Path("style.css")) if p.exists()]
+    render_params = {'title': "Translated Ebook", 'renderer': renderer, 'layout': layout, 'images': asset_params(),
+                     'self_contained': layout == "single"}
+    graph = BuildGraph(temp_dir)
+    if graph.is_fresh("render", render_inputs, render_params, [html_file]):
+        print(f"{html_file} is up to date, skipping render")
+        return True
+    
+    # Images are downscaled and re-encoded once and cached under asset_cache/
+    if is_packed(temp_dir):
+        materialize_packed_images(temp_dir)
+    with span("images") as images_span:
+        assets = prepare_images(temp_dir, workers=workers)
+        images_span.set(images=len(assets))
+    
+    if renderer == "auto":
+        renderer = choose_renderer(md_file, layout)
     
-    # Build pandoc command
+    if layout != "single":
+        # Images are copied into the output under content-hashed names instead;
+        # a single-file output from an earlier run would otherwise shadow it in step 6
+        (output_dir / "output.html").unlink(missing_ok=True)
+        if layout == "epub":
+            render_epub(temp_dir, md_file, html_file, render_params['title'], assets, memo)
+        else:
+            render_chapters(temp_dir, md_file, output_dir, template_file if template_args else None,
+                            render_params['title'], assets, metrics, memo)
+        graph.record("render", render_inputs, render_params, [html_file])
+        graph.save()
+        print(f"{'EPUB' if layout == 'epub' else 'Chapter HTML'} created: {html_file}")
+        return True
+    
+    if renderer == "builtin":
+        # The heading index holds the ids the builtin renderer assigns, so the TOC is written with the pages
+        headings = load_headings(md_file)
+        render_builtin(temp_dir, md_file, html_file, template_file if template_args else None,
+                       render_params['title'], assets, headings, metrics, memo)
+        graph.record("render", render_inputs, render_params, [html_file])
+        if headings is not None:
+            graph.record("toc", params={'source': graph.recorded_output("render", html_file)},
+                         outputs=[html_file], derived_from="render")
+        graph.save()
+        print(f"HTML file created: {html_file}")
+        return True
+    
+    sync_images_to_output(assets, output_dir)
+    
+    # Options shared by a single pandoc pass and by chunked rendering
     pandoc_cmd = [
         "pandoc",
-        str(md_file),
-        "-o", str(html_file),
+        "--from", "markdown",
+        "--to", "html",
         "--standalone",
         "--self-contained",
         "--metadata", "title=Translated Ebook"
     ]
     
-    # Add template if available
-    if template_args:
-        pandoc_cmd.extend(template_args)
-    
-    # Add CSS if available
+    # Template and CSS shape the document around the body
+    shell_args = list(template_args)
     if Path("style.css").exists():
-        pandoc_cmd.extend(["--css", "style.css"])
+        shell_args.extend(["--css", "style.css"])
+    
+    # A Lua filter points pandoc at the processed images instead of the full-size originals
+    if assets:
+        filter_file = pandoc_image_filter(assets, temp_dir, output_dir)
+        pandoc_cmd.extend(["--lua-filter", str(filter_file)])
+    
+    # Large books are split into runs of pages rendered by parallel pandoc processes
+    workers = workers or os.cpu_count() or 1
+    chunks = plan_chunks(markdown_pages(md_file), workers)
+    workers = min(workers, len(chunks))
     
     try:
-        print(f"Converting {md_file} to HTML...")
-        result = subprocess.run(pandoc_cmd, capture_output=True, text=True, check=True)
+        with span("pandoc", bytes=md_file.stat().st_size, chunks=len(chunks)) as pandoc_span:
+            if len(chunks) > 1:
+                print(f"Converting {md_file} to HTML in {len(chunks)} chunks with {workers} pandoc workers...")
+                stats = render_chunked(md_file, html_file, chunks, workers, pandoc_cmd, shell_args)
+                print(f"Rendered {stats['chunks']} chunks in {stats['seconds']:.1f}s "
+                      f"({stats['pandoc_seconds']:.1f}s of pandoc time, {stats['parallelism']:.1f}x parallelism), "
+                      f"peak pandoc memory {stats['peak_rss_mb']:.0f} MB")
+            else:
+                print(f"Converting {md_file} to HTML...")
+                # pandoc writes a temporary file that replaces output.html only on success
+                with atomic_path(html_file) as tmp_html:
+                    seconds, peak = run_pandoc(pandoc_cmd + shell_args + [str(md_file), "-o", str(tmp_html)])
+                stats = {'chunks': 1, 'workers': 1, 'seconds': seconds, 'pandoc_seconds': seconds,
+                         'parallelism': 1.0, 'peak_rss_mb': peak}
+                print(f"Rendered in {seconds:.1f}s, peak pandoc memory {peak:.0f} MB")
+            pandoc_span.set(output_bytes=html_file.stat().st_size, **stats)
+        if metrics is not None:
+            metrics['pandoc_parallelism'] = stats['parallelism']
+            metrics['pandoc_peak_rss_mb'] = stats['peak_rss_mb']
+        graph.record("render", render_inputs, render_params, [html_file])
+        graph.save()
         print(f"HTML file created: {html_file}")
         return True
         
     except subprocess.CalledProcessError as e:
         print(f"Error running pandoc: {e}")
-        print(f"Command: {' '.join(pandoc_cmd)}")
+        print(f"Command: {' '.join(e.cmd)}")
         print(f"Error output: {e.stderr}")
         return False
 
 
+def run(ctx):
+    """Run step 5 for a pipeline RunContext."""
+    if ctx.renderer == "pandoc" and not check_pandoc():
+        return False
+    return convert_to_html(ctx.temp_dir, ctx.renderer, ctx.workers, ctx.metrics, ctx.html_layout, ctx.render_memo)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Convert markdown to HTML")
     parser.add_argument("temp_dir", help="Temporary directory path")
+    parser.add_argument("--renderer", choices=RENDERERS, default="auto",
+                       help="builtin: in-process renderer with a per-page cache; pandoc: exact pandoc output; "
+                            "auto: builtin unless the book uses pandoc-only syntax (default: auto)")
+    parser.add_argument("--workers", type=int, help="Image processing workers and parallel pandoc processes for large books (default: CPU count)")
+    parser.add_argument("--html-layout", choices=HTML_LAYOUTS, default="single",
+                       help="single: one output.html; chapters: a file per chapter plus index.html in output/html; "
+                            "epub: output.epub (default: single)")
+    add_trace_arguments(parser)
     
     args = parser.parse_args()
     
@@ -118,11 +488,13 @@ def main():
         return 1
     
     # Check pandoc availability
-    if not check_pandoc():
+    if args.renderer == "pandoc" and not check_pandoc():
         return 1
     
     # Convert to HTML
-    if not convert_to_html(args.temp_dir):
+    with trace_session("step5_render", trace_file_for(args.trace, temp_path), temp_path / "profile" if args.profile else None):
+        ok = convert_to_html(args.temp_dir, args.renderer, args.workers, layout=args.html_layout)
+    if not ok:
         return 1
     
     print("Step 5 completed successfully!")
@@ -1,173 +1,102 @@
 #!/usr/bin/env python3
 """
 Step 6: Generate Table of Contents (TOC)
-Generates and inserts TOC at the beginning of the HTML file.
+Generates and inserts TOC at the beginning of the HTML file in a streaming
+pass, without loading the document into a DOM. The builtin renderer already
+writes the TOC from step 4's heading index, so this is only needed for
+pandoc output or when the index is missing.
 """
 
 import argparse
+import html
+from html.parser import HTMLParser
 from pathlib import Path
 import re
+import sys
 
-# Try to import optional dependencies
-try:
-    from bs4 import BeautifulSoup
-    BS4_AVAILABLE = True
-except ImportError:
-    BS4_AVAILABLE = False
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent))
 
+from atomic_io import atomic_open
+from build_graph import BuildGraph
+from chapter_html import INDEX_FILENAME, SITE_DIRNAME
+from epub_writer import EPUB_FILENAME
+from heading_index import nested_toc
+from tracing import add_trace_arguments, span, trace_file_for, trace_session
 
-def load_config(temp_dir):
-    """Load configuration from config.txt file."""
-    config_file = Path(temp_dir) / "config.txt"
-    config = {}
-    
-    with open(config_file, 'r') as f:
-        for line in f:
-            key, value = line.strip().split('=', 1)
-            config[key] = value
-    
-    return config
-
-
-def generate_toc_simple(html_content):
-    """Generate TOC using simple regex parsing (fallback when BeautifulSoup not available)."""
-    import re
-    
-    # Find all heading tags
-    heading_pattern = r'<(h[1-6])[^>]*id="([^"]*)"[^>]*>([^<]+)</h[1-6]>'
-    headings = re.findall(heading_pattern, html_content, re.IGNORECASE)
-    
-    if not headings:
-        # Try to find headings without id and add them
-        heading_pattern_no_id = r'<(h[1-6])[^>]*>([^<]+)</h[1-6]>'
-        headings_no_id = re.findall(heading_pattern_no_id, html_content, re.IGNORECASE)
-        
-        if not headings_no_id:
-            print("No headings found in HTML file.")
-            return html_content
-        
-        # Add IDs to headings without them
-        for i, (tag, text) in enumerate(headings_no_id):
-            heading_id = f"heading-{i+1}-{re.sub(r'[^w]', '-', text.lower())}"
-            old_heading = f'<{tag}>{text}</{tag}>'
-            new_heading = f'<{tag} id="{heading_id}">{text}</{tag}>'
-            html_content = html_content.replace(old_heading, new_heading, 1)
-            headings.append((tag, heading_id, text))
-    
-    if not headings:
-        return html_content
-    
-    print(f"Found {len(headings)} headings for TOC")
-    
-    # Generate TOC HTML
-    toc_html = '''
-<div id="table-of-contents">
-<h2>Table of Contents</h2>
-<ul>
-'''
-    
-    for tag, anchor_id, text in headings:
-        level = int(tag[1])  # h1 -> 1, h2 -> 2, etc.
-        indent = '  ' * (level - 1)
-        toc_html += f'{indent}<li><a href="#{anchor_id}">{text}</a></li>\n'
-    
-    toc_html += '''</ul>
-</div>
 
-'''
-    
-    # Add TOC styles
-    toc_styles = '''
-<style>
-#table-of-contents {
-    background-color: #f9f9f9;
-    border: 1px solid #ddd;
-    border-radius: 5px;
-    padding: 20px;
-    margin: 20px 0;
-}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
 
-#table-of-contents h2 {
-    margin-top: 0;
-    color: #333;
-    border-bottom: 2px solid #007acc;
-    padding-bottom: 5px;
-}
+# Chunk size for feeding output.html to the scanner
+READ_CHUNK = 64 * 1024
 
-#table-of-contents ul {
-    list-style-type: none;
-    padding-left: 0;
-}
 
-#table-of-contents li {
-    margin: 5px 0;
-    padding-left: 20px;
-}
+def heading_anchor(index, text):
+    """Stable id for the index-th heading (1-based) when it has none."""
+    anchor_id = re.sub(r'[^\w\s-]', '', text.lower())
+    anchor_id = re.sub(r'[-\s]+', '-', anchor_id)
+    return f"heading-{index}-{anchor_id}"
 
-#table-of-contents a {
-    text-decoration: none;
-    color: #007acc;
-}
 
-#table-of-contents a:hover {
-    text-decoration: underline;
-    color: #005fa3;
-}
-</style>
-'''
-    
-    # Insert styles in head
-    if '<head>' in html_content:
-        html_content = html_content.replace('<head>', f'<head>\n{toc_styles}', 1)
-    else:
-        # Add styles at the beginning
-        html_content = toc_styles + html_content
-    
-    # Insert TOC after opening body tag
-    if '<body>' in html_content:
-        html_content = html_content.replace('<body>', f'<body>\n{toc_html}', 1)
-    else:
-        # Add TOC at the beginning
-        html_content = toc_html + html_content
-    
-    return html_content
+def advance(position, text):
+    """Return the (line, column) position just after text starting at position."""
+    line, column = position
+    newlines = text.count('\n')
+    if not newlines:
+        return line, column + len(text)
+    return line + newlines, len(text) - text.rfind('\n') - 1
 
 
-def generate_toc_from_headings(soup):
-    """Generate TOC from heading tags (h1, h2, h3, etc.)."""
-    headings = soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+class TocScanner(HTMLParser):
+    """Collect headings and the positions where ids, styles and the TOC are inserted.
     
-    if not headings:
-        print("No headings found in HTML file.")
-        return None
+    Positions are (line, column) pairs as reported by HTMLParser, so the
+    rewrite can splice the file line by line without holding it in memory.
+    """
     
-    print(f"Found {len(headings)} headings for TOC")
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.headings = []
+        self.current = None
+        self.head_end = None
+        self.body_start = None
     
-    toc_html = '<div id="table-of-contents">\n<h2>Table of Contents</h2>\n<ul>\n'
+    def handle_starttag(self, tag, attrs):
+        start_text = self.get_starttag_text()
+        if tag == 'body' and self.body_start is None:
+            self.body_start = advance(self.getpos(), start_text)
+        elif tag in HEADING_TAGS:
+            heading_id = dict(attrs).get('id')
+            # New ids go last among the attributes, before the closing > or />
+            closing = 2 if start_text.endswith('/>') else 1
+            id_position = None if heading_id else advance(self.getpos(), start_text[:-closing])
+            self.current = {'level': int(tag[1]), 'id': heading_id, 'text': [], 'id_position': id_position}
+            self.headings.append(self.current)
     
-    for i, heading in enumerate(headings):
-        # Generate anchor ID if not present
-        if not heading.get('id'):
-            # Create ID from heading text
-            heading_text = heading.get_text().strip()
-            anchor_id = re.sub(r'[^\w\s-]', '', heading_text.lower())
-            anchor_id = re.sub(r'[-\s]+', '-', anchor_id)
-            anchor_id = f"heading-{i+1}-{anchor_id}"
-            heading['id'] = anchor_id
-        else:
-            anchor_id = heading['id']
-        
-        # Get heading level for indentation
-        level = int(heading.name[1])  # h1 -> 1, h2 -> 2, etc.
-        indent = '  ' * (level - 1)
-        
-        heading_text = heading.get_text().strip()
-        
-        toc_html += f'{indent}<li><a href="#{anchor_id}">{heading_text}</a></li>\n'
+    def handle_endtag(self, tag):
+        if tag == 'head' and self.head_end is None:
+            self.head_end = self.getpos()
+        elif tag in HEADING_TAGS:
+            self.current = None
     
-    toc_html += '</ul>\n</div>\n'
+    def handle_data(self, data):
+        if self.current is not None:
+            self.current['text'].append(data)
+
+
+def scan_headings(html_file):
+    """Stream html_file through TocScanner; return the finished scanner."""
+    scanner = TocScanner()
+    with open(html_file, 'r', encoding='utf-8', newline='\n') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), ''):
+            scanner.feed(chunk)
+    scanner.close()
     
-    return toc_html
+    for index, heading in enumerate(scanner.headings, 1):
+        heading['text'] = ''.join(heading['text']).strip()
+        if not heading['id']:
+            heading['id'] = heading_anchor(index, heading['text'])
+    return scanner
 
 
 def add_toc_styles():
@@ -199,6 +128,10 @@ def add_toc_styles():
     padding-left: 20px;
 }
 
+#table-of-contents summary {
+    cursor: pointer;
+}
+
 #table-of-contents a {
     text-decoration: none;
     color: #007acc;
@@ -216,70 +149,95 @@ def generate_toc(temp_dir):
     """Generate and insert TOC into HTML file."""
     output_dir = Path(temp_dir) / "output"
     html_file = output_dir / "output.html"
+    site_index = output_dir / SITE_DIRNAME / INDEX_FILENAME
+    epub_file = output_dir / EPUB_FILENAME
+    
+    # Chapter and EPUB output carry their own table of contents. The render record
+    # tells which layout step 5 wrote last; output of an earlier layout may remain
+    graph = BuildGraph(temp_dir)
+    layout = graph.nodes.get("render", {}).get('params', {}).get('layout')
+    if layout is None and not html_file.exists():
+        layout = "chapters" if site_index.exists() else "epub" if epub_file.exists() else None
+    if layout == "chapters":
+        print(f"Chapter output: the table of contents is in {site_index}")
+        return True
+    if layout == "epub":
+        print(f"EPUB output: the table of contents is in the nav document of {epub_file}")
+        return True
     
     if not html_file.exists():
         print(f"Error: HTML file {html_file} does not exist.")
         print("Please run step 5 (convert to HTML) first.")
         return False
     
-    # Read HTML file
-    with open(html_file, 'r', encoding='utf-8') as f:
-        html_content = f.read()
+    # The TOC is rebuilt only when step 5 produced a new output.html
+    toc_params = {'source': graph.recorded_output("render", html_file)}
+    if toc_params['source'] and graph.is_fresh("toc", params=toc_params, outputs=[html_file]):
+        print(f"TOC in {html_file} is up to date, skipping")
+        return True
+    
+    with span("insert_toc", parser="stream", bytes=html_file.stat().st_size):
+        if not insert_toc(html_file):
+            return False
+    
+    graph.record("toc", params=toc_params, outputs=[html_file], derived_from="render")
+    graph.save()
+    return True
+
+
+def insert_toc(html_file):
+    """Insert TOC and its styles into an HTML file in place.
+    
+    The file is read twice as a stream: once to collect headings, once to
+    copy it line by line with the heading ids, styles and TOC spliced in.
+    """
+    scanner = scan_headings(html_file)
+    
+    if not scanner.headings:
+        print("No headings found in HTML file; no TOC generated.")
+        return True
     
-    if BS4_AVAILABLE:
-        # Use BeautifulSoup if available
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Generate TOC
-        toc_html = generate_toc_from_headings(soup)
-        
-        if not toc_html:
-            print("No TOC generated - no headings found.")
-            return True
-        
-        # Add TOC styles to head
-        head = soup.find('head')
-        if head:
-            style_tag = BeautifulSoup(add_toc_styles(), 'html.parser')
-            head.append(style_tag)
-        
-        # Find body and insert TOC at the beginning
-        body = soup.find('body')
-        if body:
-            # Create TOC element
-            toc_soup = BeautifulSoup(toc_html, 'html.parser')
-            
-            # Insert TOC as first element in body
-            if body.contents:
-                body.insert(0, toc_soup)
-            else:
-                body.append(toc_soup)
-        else:
-            print("Warning: No body tag found, appending TOC to end of HTML")
-            soup.append(BeautifulSoup(toc_html, 'html.parser'))
-        
-        # Write updated HTML
-        with open(html_file, 'w', encoding='utf-8') as f:
-            f.write(str(soup))
-        
-        print(f"TOC generated and inserted into {html_file}")
+    print(f"Found {len(scanner.headings)} headings for TOC")
+    
+    toc_html = nested_toc(scanner.headings)
+    insertions = [(heading['id_position'], f' id="{html.escape(heading["id"])}"')
+                  for heading in scanner.headings if heading['id_position']]
+    if scanner.head_end:
+        insertions.append((scanner.head_end, add_toc_styles()))
+    if scanner.body_start:
+        insertions.append((scanner.body_start, toc_html))
     else:
-        # Use simple regex-based approach
-        print("BeautifulSoup not available, using simple TOC generation...")
-        updated_html = generate_toc_simple(html_content)
-        
-        # Write updated HTML
-        with open(html_file, 'w', encoding='utf-8') as f:
-            f.write(updated_html)
-        
-        print(f"TOC generated and inserted into {html_file}")
+        print("Warning: No body tag found, appending TOC to end of HTML")
+    
+    # Insertions are applied in file order; sort is stable for equal positions
+    insertions.sort(key=lambda insertion: insertion[0])
+    pending = iter(insertions)
+    insertion = next(pending, None)
+    with open(html_file, 'r', encoding='utf-8', newline='\n') as source, atomic_open(html_file) as out:
+        for line_number, line in enumerate(source, 1):
+            column = 0
+            while insertion and insertion[0][0] == line_number:
+                out.write(line[column:insertion[0][1]])
+                out.write(insertion[1])
+                column = insertion[0][1]
+                insertion = next(pending, None)
+            out.write(line[column:])
+        if not scanner.body_start:
+            out.write(toc_html)
     
+    print(f"TOC generated and inserted into {html_file}")
     return True
 
 
+def run(ctx):
+    """Run step 6 for a pipeline RunContext."""
+    return generate_toc(ctx.temp_dir)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Generate Table of Contents for HTML")
     parser.add_argument("temp_dir", help="Temporary directory path")
+    add_trace_arguments(parser)
     
     args = parser.parse_args()
     
@@ -290,7 +248,9 @@ def main():
         return 1
     
     # Generate TOC
-    if not generate_toc(args.temp_dir):
+    with trace_session("step6_toc", trace_file_for(args.trace, temp_path), temp_path / "profile" if args.profile else None):
+        ok = generate_toc(args.temp_dir)
+    if not ok:
         return 1
     
     print("Step 6 completed successfully!")
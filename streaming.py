@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Streaming Pipeline
+Overlaps steps 2-4: pages are queued for translation as soon as they are
+extracted, and translated pages are appended to output.md in page order
+while extraction and translation are still running. Bounded queues between
+the stages provide backpressure.
+"""
+
+import queue
+import re
+import threading
+import time
+from pathlib import Path
+
+import step2_split_pdf
+from atomic_io import replace_with, temp_path_for
+from build_graph import BuildGraph
+from run_journal import RunJournal
+from step3_translate import JOURNAL_STAGE, output_path_for, translate_tracked, translation_params
+from merge_index import MergeWriter, file_source, read_file_chunks, save_index
+from progress import add_total
+from step4_merge_md import PAGE_SEPARATOR
+
+# Default number of concurrent translation requests
+DEFAULT_TRANSLATE_WORKERS = 4
+
+# Default capacity of each inter-stage queue
+DEFAULT_QUEUE_SIZE = 16
+
+_DONE = object()
+
+
+def page_number(md_path):
+    """Return the page number encoded in a pageNNNN.md filename."""
+    return int(re.search(r'(\d+)', Path(md_path).stem).group(1))
+
+
+class OrderedMerger:
+    """Append translated pages to output.md strictly in page order."""
+
+    def __init__(self, output_file):
+        self.output_file = Path(output_file)
+        self.pending = {}
+        self.next_page = 1
+        self.merged = 0
+        self.skipped = []
+        # Written under a temporary name and renamed into place by close()
+        self._tmp_file = temp_path_for(self.output_file)
+        self._out = open(self._tmp_file, 'wb')
+        # Records page offsets for output.md.index.json, as step 4 does
+        self._writer = MergeWriter(self._out, PAGE_SEPARATOR)
+
+    def add(self, number, translated_path):
+        """Buffer one finished page (translated_path None if it failed) and flush what is ready."""
+        self.pending[number] = translated_path
+        while self.next_page in self.pending:
+            self._write(self.next_page, self.pending.pop(self.next_page))
+            self.next_page += 1
+        self._out.flush()
+
+    def _write(self, number, translated_path):
+        if translated_path is None:
+            self.skipped.append(number)
+            return
+        self._writer.write_page(Path(translated_path).name.removeprefix("output_"),
+                                file_source(translated_path), read_file_chunks(translated_path))
+        self.merged += 1
+        print(f"Merged page {number}")
+
+    def close(self):
+        """Flush any pages left after gaps and move the finished output.md into place."""
+        for number in sorted(self.pending):
+            self._write(number, self.pending[number])
+        self.pending.clear()
+        self._out.close()
+        replace_with(self._tmp_file, self.output_file)
+        save_index(self.output_file, self._writer.entries, PAGE_SEPARATOR)
+
+    def abort(self):
+        """Discard the partial output, leaving any previous output.md untouched."""
+        self._out.close()
+        self._tmp_file.unlink(missing_ok=True)
+
+
+def run_streaming(ctx, translate_workers=DEFAULT_TRANSLATE_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+    """Run extraction, translation and merging as overlapped stages; return True on success."""
+    if ctx.translator is None and ctx.use_api:
+        from step3_translate import create_translator
+        ctx.translator = create_translator(ctx.api_key)
+    if ctx.translator is None:
+        print("Error: streaming mode needs an API translator (use --api)")
+        return False
+
+    ctx.output_dir.mkdir(parents=True, exist_ok=True)
+    translate_queue = queue.Queue(maxsize=queue_size)
+    merge_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    started = time.perf_counter()
+    graph = BuildGraph(ctx.temp_dir)
+    journal = RunJournal(ctx.temp_dir)
+    params = translation_params(ctx.translator, ctx.output_lang)
+
+    def enqueue(md_path):
+        journal.register(JOURNAL_STAGE, [md_path.name])
+        add_total(JOURNAL_STAGE, 1)
+        # Blocking put() pauses extraction while translators are saturated
+        translate_queue.put(md_path)
+
+    def extract():
+        ctx.on_page = enqueue
+        try:
+            if not step2_split_pdf.run(ctx):
+                errors.append("extraction failed")
+        except Exception as e:
+            errors.append(f"extraction raised {type(e).__name__}: {e}")
+        finally:
+            ctx.on_page = None
+            for _ in range(translate_workers):
+                translate_queue.put(_DONE)
+            ctx.metrics["stream_extract_seconds"] = time.perf_counter() - started
+
+    def translate():
+        while True:
+            md_path = translate_queue.get()
+            if md_path is _DONE:
+                merge_queue.put(_DONE)
+                return
+
+            output_path = output_path_for(md_path, ctx.output_dir)
+            try:
+                if translate_tracked(md_path, output_path, ctx.output_lang, ctx.translator,
+                                     graph, journal, params):
+                    print(f"翻译完成: {output_path.name}")
+                else:
+                    print(f"跳过 {md_path.name} - 已翻译")
+                merge_queue.put((page_number(md_path), output_path))
+            except Exception as e:
+                print(f"翻译 {md_path.name} 时出错: {e}")
+                errors.append(f"{md_path.name}: {e}")
+                merge_queue.put((page_number(md_path), None))
+
+    threads = [threading.Thread(target=extract, name="extract", daemon=True)]
+    threads += [threading.Thread(target=translate, name=f"translate-{i}", daemon=True)
+                for i in range(translate_workers)]
+    for thread in threads:
+        thread.start()
+
+    # Merge on the calling thread until every translator has finished
+    merger = OrderedMerger(ctx.output_dir / "output.md")
+    finished_translators = 0
+    try:
+        while finished_translators < translate_workers:
+            item = merge_queue.get()
+            if item is _DONE:
+                finished_translators += 1
+            else:
+                merger.add(*item)
+    except BaseException:
+        merger.abort()
+        raise
+    merger.close()
+
+    for thread in threads:
+        thread.join()
+    journal.forget(JOURNAL_STAGE, keep=[p.name for p in ctx.refresh_pages()])
+    journal.close()
+    graph.save()
+
+    ctx.metrics["stream_seconds"] = time.perf_counter() - started
+    print(f"Streamed {len(ctx.pages)} pages, merged {merger.merged} into {merger.output_file}")
+
+    if errors:
+        print(f"Streaming run finished with {len(errors)} errors:")
+        for error in errors:
+            print(f"  - {error}")
+        return False
+    return True
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Synthetic Book Generators
+Deterministic markdown, EPUB and PDF books of any size with images, code
+blocks and deep heading trees, used by the benchmark suite. Only the
+standard library is needed, so books can be generated on any machine.
+"""
+
+import argparse
+import random
+import struct
+import zipfile
+import zlib
+from html import escape
+from pathlib import Path
+
+WORDS = ("translation pipeline chapter section paragraph ebook markdown render "
+         "language model token latency throughput memory process thread queue "
+         "image table figure heading index search archive format page merge").split()
+
+# Every Nth page gets an image; every Mth page a code block
+IMAGE_EVERY = 5
+CODE_EVERY = 3
+
+# Distinct images in a book; pages reuse them so deduplication is exercised
+DISTINCT_IMAGES = 20
+
+
+def make_png(width, height, seed):
+    """Return a small valid RGB PNG whose pixels depend on `seed`."""
+    rng = random.Random(seed)
+    color = bytes(rng.randrange(256) for _ in range(3))
+    raw = b''.join(b'\x00' + color * width for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def paragraph(rng, words=60):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def iter_chapters(pages, seed=0):
+    """Yield (number, blocks) per page; blocks are ('h', level, text), ('p', text), ('code', text) or ('img', n)."""
+    rng = random.Random(seed)
+    for number in range(1, pages + 1):
+        blocks = [('h', 1, f"Chapter {number}")]
+        # Heading tree up to level 4 below each chapter
+        for section in range(1, 3):
+            blocks.append(('h', 2, f"Section {number}.{section}"))
+            blocks.append(('p', paragraph(rng)))
+            blocks.append(('h', 3, f"Topic {number}.{section}.1"))
+            blocks.append(('p', paragraph(rng)))
+            blocks.append(('h', 4, f"Detail {number}.{section}.1.1"))
+            blocks.append(('p', paragraph(rng, 30)))
+        if number % CODE_EVERY == 0:
+            blocks.append(('code', f"def page_{number}(x):\n    # not a heading\n    return x * {number}"))
+        if number % IMAGE_EVERY == 0:
+            blocks.append(('img', number % DISTINCT_IMAGES))
+        yield number, blocks
+
+
+def generate_markdown_book(path, pages, seed=0):
+    """Write a markdown book with `pages` level-1 chapters; images go next to it."""
+    path = Path(path)
+    images_dir = path.parent / f"{path.stem}_images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for number, blocks in iter_chapters(pages, seed):
+            for block in blocks:
+                if block[0] == 'h':
+                    f.write(f"{'#' * block[1]} {block[2]}\n\n")
+                elif block[0] == 'p':
+                    f.write(block[1] + "\n\n")
+                elif block[0] == 'code':
+                    f.write(f"```python\n# Heading-like comment\n{block[1]}\n```\n\n")
+                else:
+                    image = images_dir / f"pic{block[1]}.png"
+                    if not image.exists():
+                        image.write_bytes(make_png(16, 16, block[1]))
+                    f.write(f"![Figure {number}]({images_dir.name}/{image.name})\n\n")
+    return path
+
+
+def chapter_xhtml(blocks):
+    body = []
+    for block in blocks:
+        if block[0] == 'h':
+            body.append(f"<h{block[1]}>{escape(block[2])}</h{block[1]}>")
+        elif block[0] == 'p':
+            body.append(f"<p>{escape(block[1])}</p>")
+        elif block[0] == 'code':
+            body.append(f"<pre><code>{escape(block[1])}</code></pre>")
+        else:
+            body.append(f'<p><img src="../images/pic{block[1]}.png" alt="Figure"/></p>')
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter</title></head><body>'
+            + ''.join(body) + '</body></html>')
+
+
+def generate_epub_book(path, pages, seed=0):
+    """Write an EPUB with one spine chapter per page."""
+    path = Path(path)
+    manifest = []
+    spine = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml',
+                      '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                      '<rootfile full-path="OEBPS/content.opf"/></rootfiles></container>')
+        for n in range(min(DISTINCT_IMAGES, pages)):
+            epub.writestr(f'OEBPS/images/pic{n}.png', make_png(16, 16, n))
+            manifest.append(f'<item id="img{n}" href="images/pic{n}.png" media-type="image/png"/>')
+        for number, blocks in iter_chapters(pages, seed):
+            name = f"chapter{number:05d}.xhtml"
+            epub.writestr(f'OEBPS/text/{name}', chapter_xhtml(blocks))
+            manifest.append(f'<item id="c{number}" href="text/{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="c{number}"/>')
+        epub.writestr('OEBPS/content.opf',
+                      '<package xmlns="http://www.idpf.org/2007/opf" version="3.0"><manifest>'
+                      + ''.join(manifest) + '</manifest><spine>' + ''.join(spine) + '</spine></package>')
+    return path
+
+
+def pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def generate_pdf_book(path, pages, seed=0):
+    """Write a PDF with one text page per chapter and an embedded image on every IMAGE_EVERY page."""
+    path = Path(path)
+    objects = []  # object bodies; object n is objects[n - 1]
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    images = {}
+    for n in range(min(DISTINCT_IMAGES, pages)):
+        rng = random.Random(n)
+        pixels = zlib.compress(bytes(rng.randrange(256) for _ in range(3)) * 256)
+        images[n] = add(b"<< /Type /XObject /Subtype /Image /Width 16 /Height 16 /ColorSpace /DeviceRGB "
+                        b"/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>\nstream\n" % len(pixels)
+                        + pixels + b"\nendstream")
+
+    pages_obj = len(objects) + 1
+    add(b"")  # placeholder for the page tree, filled in below
+    page_ids = []
+    for number, blocks in iter_chapters(pages, seed):
+        lines = []
+        image = None
+        for block in blocks:
+            if block[0] == 'h':
+                lines.append(block[2])
+            elif block[0] in ('p', 'code'):
+                text = block[1].replace('\n', ' ')
+                lines.extend(text[i:i + 90] for i in range(0, len(text), 90))
+            else:
+                image = block[1]
+        ops = ["BT /F1 9 Tf 11 TL 40 800 Td"]
+        ops += [f"({pdf_text(line)}) '" for line in lines[:70]]
+        ops.append("ET")
+        resources = f"/Font << /F1 {font} 0 R >>"
+        if image is not None:
+            ops.append(f"q 64 0 0 64 480 40 cm /Im{image} Do Q")
+            resources += f" /XObject << /Im{image} {images[image]} 0 R >>"
+        content = '\n'.join(ops).encode('latin-1', 'replace')
+        stream = add(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        page_ids.append(add(f"<< /Type /Page /Parent {pages_obj} 0 R /MediaBox [0 0 595 842] "
+                            f"/Resources << {resources} >> /Contents {stream} 0 R >>".encode()))
+
+    kids = ' '.join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[pages_obj - 1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+    catalog = add(f"<< /Type /Catalog /Pages {pages_obj} 0 R >>".encode())
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                % (len(objects) + 1, catalog, xref))
+    return path
+
+
+GENERATORS = {
+    'md': generate_markdown_book,
+    'epub': generate_epub_book,
+    'pdf': generate_pdf_book,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic ebook for benchmarking")
+    parser.add_argument("output", help="Output file (.md, .epub or .pdf)")
+    parser.add_argument("--pages", type=int, default=1000, help="Number of chapters/pages (default: 1000)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the filler text")
+
+    args = parser.parse_args()
+
+    fmt = Path(args.output).suffix.lstrip('.').lower()
+    if fmt not in GENERATORS:
+        print(f"Error: unsupported format .{fmt} (use .md, .epub or .pdf)")
+        return 1
+    GENERATORS[fmt](args.output, args.pages, args.seed)
+    print(f"Created {args.output} with {args.pages} pages")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -9,12 +9,45 @@ import shutil
 from pathlib import Path
 import os
 import sys
+import time
+import re
+import io
+from contextlib import redirect_stdout
 
 # Add the project root to Python path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from step1_init import create_temp_directory
-from step4_merge_md import natural_sort_key
+from step4_merge_md import merge_markdown_files, natural_sort_key
+from step2_split_pdf import extract_pdf_image, convert_docx_native, convert_epub_native
+from pdf_ocr import choose_ocr_dpi, needs_ocr, run_ocr
+from pipeline import RunContext, load_config, run_steps
+from streaming import OrderedMerger, run_streaming
+from build_graph import BuildGraph
+from scheduler import FairQueue, PriorityWorkQueue, RateLimiter
+from batch import discover_books, run_batch
+from markdown_splitter import iter_markdown_sections, split_markdown_file
+from run_journal import RunJournal, DONE, FAILED, IN_FLIGHT
+from atomic_io import atomic_write_text
+from step3_translate import translate_markdown_files
+from tracing import add_trace_arguments, span, start_tracing, stop_tracing, trace_file_for
+from benchmark import MockTranslator, compare, run_case
+from service import PAGE_NOW_PRIORITY, TranslationService, serve
+from distributed import LeaseQueue, Worker, queue_status, submit
+from workspace_store import PAGE, TRANSLATION, PackedWorkspace, pack_workspace
+from merge_index import load_index, merge_pages, page_at, page_at_line
+from markdown_renderer import fill_template, find_pandoc_syntax, render_fragment, render_markdown
+from image_assets import prepare_images, sync_images
+from step5_convert_html import RenderMemo, convert_to_html
+from step6_generate_toc import add_toc_styles, insert_toc
+from heading_index import COLLAPSE_THRESHOLD, load_headings, nested_toc
+from search_index import SearchIndex, bloom_positions, tokenize
+from watcher import PollingWatcher, rebuild, watched_files
+from progress import (LiveView, add_total, item_done, item_failed, metrics_url, start_progress, stop_progress,
+                      track_request)
+from pandoc_render import ChunkStitcher, collect_definitions, plan_chunks
+from epub_writer import write_epub, xhtml_safe
+from ebook_reader import html_to_markdown, read_epub_chapters
 
 
 class TestStep1Init(unittest.TestCase):
@@ -60,6 +93,1561 @@ class TestStep4MergeMd(unittest.TestCase):
         self.assertEqual(sorted_names, expected)
 
 
+class FakePdfDocument:
+    """Minimal stand-in for a fitz.Document exposing raw JPEG streams."""
+    
+    def __init__(self, streams):
+        self.streams = streams
+        self.extract_calls = 0
+    
+    def xref_stream_raw(self, xref):
+        return self.streams[xref]
+    
+    def extract_image(self, xref):
+        self.extract_calls += 1
+        return {'ext': 'jpeg', 'colorspace': 3, 'image': self.streams[xref]}
+
+
+class TestStep2SplitPdf(unittest.TestCase):
+    """Test PDF image extraction helpers."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.images_dir = Path(self.temp_dir)
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.temp_dir)
+    
+    def test_images_deduplicated_by_xref_and_content(self):
+        """Test repeated and identical images are written once as raw JPEG."""
+        doc = FakePdfDocument({10: b'\xff\xd8logo', 11: b'\xff\xd8logo', 12: b'\xff\xd8photo'})
+        extracted = {}
+        
+        first = extract_pdf_image(doc, 10, 0, self.images_dir, extracted)
+        again = extract_pdf_image(doc, 10, 0, self.images_dir, extracted)
+        same_content = extract_pdf_image(doc, 11, 0, self.images_dir, extracted)
+        other = extract_pdf_image(doc, 12, 0, self.images_dir, extracted)
+        
+        self.assertEqual(first, again)
+        self.assertEqual(first, same_content)
+        self.assertNotEqual(first, other)
+        self.assertTrue(first.endswith('.jpg'))
+        self.assertEqual(doc.extract_calls, 2)
+        self.assertEqual(len(list(self.images_dir.iterdir())), 2)
+        self.assertEqual((self.images_dir / first).read_bytes(), b'\xff\xd8logo')
+
+
+class TestMarkdownSplitter(unittest.TestCase):
+    """Test the streaming markdown splitter."""
+    
+    def split(self, text, **kwargs):
+        return list(iter_markdown_sections(text.splitlines(keepends=True), **kwargs))
+    
+    def test_headings_inside_code_fences_do_not_split(self):
+        """Test that '# comments' in fenced code stay with their section."""
+        text = "# One\n\n```python\n# not a heading\nx = 1\n```\n\n# Two\n\nBody\n"
+        sections = self.split(text)
+        
+        self.assertEqual(len(sections), 2)
+        self.assertIn("# not a heading", sections[0])
+        self.assertTrue(sections[1].startswith("# Two"))
+    
+    def test_split_level_and_empty_sections(self):
+        """Test splitting at H2 and dropping whitespace-only sections."""
+        text = "\n\n# Book\n## A\nText A\n## B\nText B\n"
+        
+        self.assertEqual(len(self.split(text)), 1)
+        self.assertEqual(self.split(text, split_level=2), ["# Book\n", "## A\nText A\n", "## B\nText B\n"])
+    
+    def test_large_sections_split_at_paragraphs(self):
+        """Test that oversized sections are sub-split on blank lines only."""
+        paragraphs = [f"Paragraph {i} " + "x" * 40 + "\n" for i in range(10)]
+        text = "# Big\n\n" + "\n".join(paragraphs)
+        sections = self.split(text, max_chars=120)
+        
+        self.assertGreater(len(sections), 1)
+        self.assertEqual("".join(sections), text)
+        for section in sections:
+            self.assertLessEqual(len(section), 120)
+    
+    def test_mmap_matches_buffered_reading(self):
+        """Test mmap-backed splitting gives the same pages as buffered reading."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            md_file = Path(temp_dir) / "book.md"
+            md_file.write_text("# 一\n\n内容\n\n# 二\n\n更多\n", encoding='utf-8')
+            
+            self.assertEqual(list(split_markdown_file(md_file, use_mmap=True)),
+                             list(split_markdown_file(md_file, use_mmap=False)))
+            
+            md_file.write_bytes("# 一\r\n\r\n内容\r旧式换行\r\n# 二\r\n\r\n更多\r\n".encode('utf-8'))
+            pages = list(split_markdown_file(md_file, use_mmap=True))
+            self.assertEqual(pages, list(split_markdown_file(md_file, use_mmap=False)))
+            self.assertEqual(pages, ["# 一\n\n内容\n旧式换行\n", "# 二\n\n更多\n"])
+            
+            md_file.write_bytes("# 一\r\n分页\x0c# 不是标题\u2028# 也不是\r\n".encode('utf-8'))
+            pages = list(split_markdown_file(md_file, use_mmap=True))
+            self.assertEqual(pages, list(split_markdown_file(md_file, use_mmap=False)))
+            self.assertEqual(pages, ["# 一\n分页\x0c# 不是标题\u2028# 也不是\n"])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+def build_test_epub(path, chapters, image=b'\x89PNG fake'):
+    """Write a minimal EPUB with the given (filename, xhtml) chapters and one image."""
+    import zipfile
+    manifest = ''.join(f'<item id="c{i}" href="text/{name}" media-type="application/xhtml+xml"/>'
+                       for i, (name, _) in enumerate(chapters))
+    spine = ''.join(f'<itemref idref="c{i}"/>' for i in range(len(chapters)))
+    with zipfile.ZipFile(path, 'w') as epub:
+        epub.writestr('mimetype', 'application/epub+zip')
+        epub.writestr('META-INF/container.xml',
+                      '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                      '<rootfile full-path="OEBPS/content.opf"/></rootfiles></container>')
+        epub.writestr('OEBPS/content.opf',
+                      '<package xmlns="http://www.idpf.org/2007/opf"><manifest>' + manifest +
+                      '<item id="img" href="images/pic.png" media-type="image/png"/>'
+                      '</manifest><spine>' + spine + '</spine></package>')
+        epub.writestr('OEBPS/images/pic.png', image)
+        for name, xhtml in chapters:
+            epub.writestr(f'OEBPS/text/{name}', xhtml)
+
+
+class TestEbookReader(unittest.TestCase):
+    """Test the native EPUB/DOCX readers."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        for sub in ("pages", "images"):
+            (self.temp_dir / sub).mkdir()
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.temp_dir)
+    
+    def test_epub_chapters_follow_spine(self):
+        """Test EPUB pages follow the spine order and images come from the archive."""
+        epub_path = self.temp_dir / "book.epub"
+        build_test_epub(epub_path, [
+            ("ch2.xhtml", "<html><body><h1>Second</h1><p>Two <em>b</em></p></body></html>"),
+            ("ch1.xhtml", '<html><body><h2>First</h2><p>One</p><img src="../images/pic.png" alt="Pic"/></body></html>'),
+        ])
+        
+        self.assertTrue(convert_epub_native(epub_path, self.temp_dir, workers=2))
+        
+        pages = sorted((self.temp_dir / "pages").glob("page*.md"))
+        self.assertEqual(len(pages), 2)
+        self.assertTrue(pages[0].read_text(encoding='utf-8').startswith("# Second"))
+        second = pages[1].read_text(encoding='utf-8')
+        self.assertIn("## First", second)
+        images = list((self.temp_dir / "images").iterdir())
+        self.assertEqual(len(images), 1)
+        self.assertIn(f"![Pic](../images/{images[0].name})", second)
+    
+    def test_docx_splits_at_heading_paragraphs(self):
+        """Test DOCX paragraphs styled as headings start new pages."""
+        import zipfile
+        w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        
+        def para(text, style=None):
+            ppr = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+            return f'<w:p>{ppr}<w:r><w:t>{text}</w:t></w:r></w:p>'
+        
+        body = para("Intro") + para("Chapter A", "Heading1") + para("Text A") + \
+            para("Section", "Heading2") + para("Chapter B", "Heading1") + para("Text B")
+        docx_path = self.temp_dir / "book.docx"
+        with zipfile.ZipFile(docx_path, 'w') as docx:
+            docx.writestr('word/document.xml', f'<w:document {w}><w:body>{body}</w:body></w:document>')
+        
+        self.assertTrue(convert_docx_native(docx_path, self.temp_dir))
+        
+        pages = [p.read_text(encoding='utf-8') for p in sorted((self.temp_dir / "pages").glob("page*.md"))]
+        self.assertEqual(pages, ["Intro\n", "# Chapter A\n\nText A\n\n## Section\n", "# Chapter B\n\nText B\n"])
+    
+    def test_nested_lists_keep_parent_items(self):
+        """Test an item holding a nested list keeps its marker and the child is indented under it."""
+        self.assertEqual(html_to_markdown("<ul><li>Parent<ul><li>Child</li></ul></li><li>Two</li></ul>"),
+                         "- Parent\n\n  - Child\n\n- Two\n")
+        self.assertEqual(html_to_markdown("<ol><li>One<ul><li>a</li><li>b</li></ul></li></ol>"),
+                         "1. One\n\n   - a\n\n   - b\n")
+
+    def test_paragraphs_in_list_items_keep_markers(self):
+        """Test the first paragraph of an item gets its marker and later ones are indented under it."""
+        self.assertEqual(html_to_markdown("<ul><li><p>First</p><p>Second</p></li><li><p>Two</p></li></ul>"),
+                         "- First\n\n  Second\n\n- Two\n")
+        self.assertEqual(html_to_markdown("<ol><li><p>One</p></li><li><p>Two</p></li></ol>"),
+                         "1. One\n\n2. Two\n")
+
+    def test_markdown_characters_in_text_are_escaped(self):
+        """Test text that looks like markdown syntax stays literal."""
+        markdown = html_to_markdown("<p># not a heading</p><p>1984. A year</p><p>- dash</p>"
+                                    "<p>+ plus</p><p>&gt; quote</p><p>a *b* _c_ `d` <code>x*y</code></p>")
+        self.assertEqual(markdown, "\\# not a heading\n\n1984\\. A year\n\n\\- dash\n\n\\+ plus\n\n"
+                                   "\\> quote\n\na \\*b\\* \\_c\\_ \\`d\\` `x*y`\n")
+
+    def test_tables_become_pipe_tables(self):
+        """Test table cells are kept apart as a pipe table."""
+        markdown = html_to_markdown("<table><tr><th>Name</th><th>Value</th></tr>"
+                                    "<tr><td><p>a</p></td><td>x|y</td></tr></table>")
+        self.assertEqual(markdown, "| Name | Value |\n| --- | --- |\n| a | x\\|y |\n")
+
+
+class TestPdfOcr(unittest.TestCase):
+    """Test OCR fallback helpers."""
+    
+    def test_needs_ocr(self):
+        """Test detection of empty or negligible text layers."""
+        self.assertTrue(needs_ocr(""))
+        self.assertTrue(needs_ocr("  12 \n\n"))
+        self.assertFalse(needs_ocr("This page has a real text layer with words."))
+    
+    def test_choose_ocr_dpi(self):
+        """Test DPI scales with page size and stays within bounds."""
+        a4 = choose_ocr_dpi(595, 842)
+        self.assertTrue(250 <= a4 <= 300)
+        self.assertEqual(choose_ocr_dpi(2000, 3000), 150)
+        self.assertEqual(choose_ocr_dpi(200, 300), 400)
+    
+    def test_cached_pages_skip_ocr(self):
+        """Test cached results are returned without running tesseract."""
+        cache_dir = Path(tempfile.mkdtemp())
+        try:
+            (cache_dir / "abc.txt").write_text("recognized", encoding='utf-8')
+            results = run_ocr([(4, "abc", ("missing.pdf", 4, 300, "eng"))], cache_dir)
+            self.assertEqual(results, {4: "recognized"})
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class UppercaseTranslator:
+    """Offline translator stand-in used by pipeline tests."""
+    
+    def __init__(self):
+        self.calls = 0
+    
+    def translate_markdown(self, markdown_content, target_language="zh"):
+        self.calls += 1
+        return markdown_content.upper()
+
+
+class TestPipelineRunner(unittest.TestCase):
+    """Test the in-process pipeline API."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("# One\n\nfirst\n\n# Two\n\nsecond\n", encoding='utf-8')
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_load_config_skips_malformed_lines(self):
+        """Test config lines without '=' are ignored instead of crashing."""
+        (self.work_dir / "config.txt").write_text("INPUT_LANG=en\n\ngarbage\nOUTPUT_LANG=zh\n", encoding='utf-8')
+        
+        self.assertEqual(load_config(self.work_dir), {'INPUT_LANG': 'en', 'OUTPUT_LANG': 'zh'})
+    
+    def test_steps_run_in_process_with_shared_context(self):
+        """Test steps 1-4 share one context, page list and translator."""
+        translator = UppercaseTranslator()
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book,
+                         output_lang="zh", translator=translator)
+        
+        self.assertEqual(run_steps(ctx, 1, 4), 0)
+        
+        self.assertEqual(ctx.config['OUTPUT_LANG'], 'zh')
+        self.assertEqual([p.name for p in ctx.pages], ["page0001.md", "page0002.md"])
+        self.assertEqual(translator.calls, 2)
+        merged = (ctx.output_dir / "output.md").read_text(encoding='utf-8')
+        self.assertEqual(merged, "# ONE\n\nFIRST\n\n---\n\n# TWO\n\nSECOND")
+        for step in range(1, 5):
+            self.assertIn(f"step{step}_seconds", ctx.metrics)
+    
+    def test_translator_module_imports_without_requests(self):
+        """Test heavy dependencies are not imported at module import time."""
+        import siliconflow_translator
+        
+        self.assertTrue(hasattr(siliconflow_translator, "SiliconFlowTranslator"))
+
+
+class TestStreaming(unittest.TestCase):
+    """Test the overlapped streaming pipeline."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_merger_writes_in_page_order(self):
+        """Test out-of-order completions are merged in page order, skipping failures."""
+        pages = {}
+        for n in (1, 2, 3, 4):
+            pages[n] = self.work_dir / f"output_page{n:04d}.md"
+            pages[n].write_text(f"page {n}\n", encoding='utf-8')
+        output_file = self.work_dir / "output.md"
+        
+        merger = OrderedMerger(output_file)
+        merger.add(3, pages[3])
+        self.assertEqual(merger.merged, 0)
+        merger.add(1, pages[1])
+        merger.add(2, None)
+        merger.add(4, pages[4])
+        merger.close()
+        
+        self.assertEqual(output_file.read_text(encoding='utf-8'), "page 1\n\n---\n\npage 3\n\n---\n\npage 4")
+        self.assertEqual(merger.skipped, [2])
+    
+    def test_streaming_run_matches_sequential_merge(self):
+        """Test streaming steps 2-4 produce the same output.md as the barrier pipeline."""
+        book = self.work_dir / "book.md"
+        book.write_text("".join(f"# Chapter {i}\n\ntext {i}\n\n" for i in range(1, 8)), encoding='utf-8')
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=book,
+                         translator=UppercaseTranslator())
+        self.assertEqual(run_steps(ctx, 1, 1), 0)
+        
+        self.assertTrue(run_streaming(ctx, translate_workers=3, queue_size=2))
+        
+        merged = (ctx.output_dir / "output.md").read_text(encoding='utf-8')
+        expected = "\n\n---\n\n".join(f"# CHAPTER {i}\n\nTEXT {i}" for i in range(1, 8))
+        self.assertEqual(merged, expected)
+        self.assertEqual(len(ctx.pages), 7)
+
+
+class TestBuildGraph(unittest.TestCase):
+    """Test content-hash freshness records."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_inputs_params_and_outputs_decide_freshness(self):
+        """Test a node goes stale when an input, parameter or output changes."""
+        source = self.work_dir / "in.md"
+        target = self.work_dir / "out.md"
+        source.write_text("a", encoding='utf-8')
+        target.write_text("A", encoding='utf-8')
+        graph = BuildGraph(self.work_dir)
+        graph.record("node", [source], {'olang': 'zh'}, [target])
+        graph.save()
+        
+        graph = BuildGraph(self.work_dir)
+        self.assertTrue(graph.is_fresh("node", [source], {'olang': 'zh'}, [target]))
+        self.assertFalse(graph.is_fresh("node", [source], {'olang': 'en'}, [target]))
+        target.write_text("edited", encoding='utf-8')
+        self.assertFalse(graph.is_fresh("node", [source], {'olang': 'zh'}, [target]))
+        self.assertTrue(graph.is_fresh("node", [source], {'olang': 'zh'}, [target], check_outputs=False))
+        source.write_text("b", encoding='utf-8')
+        self.assertFalse(graph.is_fresh("node", [source], {'olang': 'zh'}, [target], check_outputs=False))
+    
+    def test_in_place_rewrite_keeps_source_node_fresh(self):
+        """Test a derived node rewriting an output in place does not invalidate its source."""
+        html = self.work_dir / "output.html"
+        html.write_text("<h1>x</h1>", encoding='utf-8')
+        graph = BuildGraph(self.work_dir)
+        graph.record("render", outputs=[html])
+        source = graph.recorded_output("render", html)
+        html.write_text("<div>toc</div><h1>x</h1>", encoding='utf-8')
+        graph.record("toc", params={'source': source}, outputs=[html], derived_from="render")
+        
+        self.assertTrue(graph.is_fresh("render", outputs=[html]))
+        self.assertTrue(graph.is_fresh("toc", params={'source': source}, outputs=[html]))
+    
+    def test_rerun_rebuilds_only_stale_artifacts(self):
+        """Test reruns skip translation and an edited translation is re-merged."""
+        book = self.work_dir / "book.md"
+        book.write_text("# One\n\nfirst\n\n# Two\n\nsecond\n", encoding='utf-8')
+        translator = UppercaseTranslator()
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=book, translator=translator)
+        self.assertEqual(run_steps(ctx, 1, 4), 0)
+        self.assertEqual(translator.calls, 2)
+        
+        self.assertEqual(run_steps(ctx, 2, 4), 0)
+        self.assertEqual(translator.calls, 2)
+        
+        (ctx.output_dir / "output_page0002.md").write_text("# TWO\n\nFIXED\n", encoding='utf-8')
+        self.assertEqual(run_steps(ctx, 2, 4), 0)
+        self.assertEqual(translator.calls, 2)
+        self.assertIn("FIXED", (ctx.output_dir / "output.md").read_text(encoding='utf-8'))
+        
+        book.write_text("# One\n\nfirst\n\n# Two\n\nchanged\n", encoding='utf-8')
+        self.assertEqual(run_steps(ctx, 2, 4), 0)
+        self.assertEqual(translator.calls, 3)
+    
+    def test_translations_without_records_are_adopted(self):
+        """Test a workspace from before build records keeps its existing translations."""
+        book = self.work_dir / "book.md"
+        book.write_text("# One\n\nfirst\n\n# Two\n\nsecond\n", encoding='utf-8')
+        translator = UppercaseTranslator()
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=book, translator=translator)
+        self.assertEqual(run_steps(ctx, 1, 4), 0)
+        (ctx.output_dir / "output_page0001.md").write_text("# ONE\n\nHAND FIXED\n", encoding='utf-8')
+        (ctx.temp_dir / "build_state.json").unlink()
+        
+        self.assertEqual(run_steps(ctx, 2, 4), 0)
+        self.assertEqual(translator.calls, 2)
+        self.assertIn("HAND FIXED", (ctx.output_dir / "output.md").read_text(encoding='utf-8'))
+        
+        book.write_text("# One\n\nchanged\n\n# Two\n\nsecond\n", encoding='utf-8')
+        self.assertEqual(run_steps(ctx, 2, 4), 0)
+        self.assertEqual(translator.calls, 3)
+        
+        BuildGraph(ctx.temp_dir).reset()
+        self.assertEqual(run_steps(ctx, 2, 4), 0)
+        self.assertEqual(translator.calls, 5)
+
+
+class TestBatch(unittest.TestCase):
+    """Test multi-book batch scheduling."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_fair_queue_round_robins_across_books(self):
+        """Test a large book cannot starve a small one."""
+        work = FairQueue()
+        for i in range(3):
+            work.put("big", i)
+        work.put("small", 0)
+        work.close()
+        
+        order = []
+        while (task := work.get()) is not None:
+            order.append(task[0])
+        self.assertEqual(order, ["big", "small", "big", "big"])
+    
+    def test_rate_limiter_spaces_requests(self):
+        """Test the token bucket blocks once the burst is used up."""
+        limiter = RateLimiter(rate=20, per=1.0, burst=1)
+        started = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+    
+    def test_bad_book_does_not_stop_batch(self):
+        """Test good books finish while a broken EPUB is reported as failed."""
+        for name in ("a", "b"):
+            (self.work_dir / f"{name}.md").write_text(f"# {name}\n\nbody\n\n# {name}2\n\nmore\n", encoding='utf-8')
+        (self.work_dir / "broken.epub").write_bytes(b"not a zip")
+        (self.work_dir / "notes.txt").write_text("ignored", encoding='utf-8')
+        books = discover_books(self.work_dir)
+        self.assertEqual([b.name for b in books], ["a.md", "b.md", "broken.epub"])
+        
+        translator = UppercaseTranslator()
+        states = {s.name: s for s in run_batch(books, translator, cpu_workers=2, rate_limit=0, end_step=4)}
+        
+        self.assertEqual(states["a.md"].status, "done")
+        self.assertEqual(states["b.md"].status, "done")
+        self.assertEqual(states["broken.epub"].status, "failed")
+        self.assertEqual(translator.calls, 4)
+        merged = (self.work_dir / "a_temp" / "output" / "output.md").read_text(encoding='utf-8')
+        self.assertTrue(merged.startswith("# A"))
+    
+    def test_books_sharing_a_working_directory_are_rejected(self):
+        """Test book.md and book.epub are not translated into the same book_temp."""
+        (self.work_dir / "book.md").write_text("# One\n\nbody\n", encoding='utf-8')
+        build_test_epub(self.work_dir / "book.epub", [("ch1.xhtml", "<html><body><h1>Other</h1></body></html>")])
+        
+        translator = UppercaseTranslator()
+        with redirect_stdout(io.StringIO()):
+            states = run_batch(discover_books(self.work_dir), translator, cpu_workers=1, rate_limit=0, end_step=4)
+        
+        self.assertEqual([(s.name, s.status) for s in states], [("book.epub", "done"), ("book.md", "failed")])
+        self.assertIn("book.epub uses the same working directory", states[1].error)
+        self.assertEqual(translator.calls, 1)
+        merged = (self.work_dir / "book_temp" / "output" / "output.md").read_text(encoding='utf-8')
+        self.assertTrue(merged.startswith("# OTHER"))
+
+
+class FlakyTranslator(UppercaseTranslator):
+    """Translator stand-in that fails on pages containing a marker."""
+    
+    def __init__(self, fail_marker):
+        super().__init__()
+        self.fail_marker = fail_marker
+    
+    def translate_markdown(self, markdown_content, target_language="zh"):
+        if self.fail_marker and self.fail_marker in markdown_content:
+            raise RuntimeError("API timeout")
+        return super().translate_markdown(markdown_content, target_language)
+
+
+class TestRunJournal(unittest.TestCase):
+    """Test the crash-safe run journal, atomic writes and resume."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_states_survive_reopening(self):
+        """Test page states and failure reasons persist across journal instances."""
+        journal = RunJournal(self.work_dir)
+        journal.register("translate", ["page0001.md", "page0002.md", "page0003.md"])
+        journal.mark("translate", "page0001.md", IN_FLIGHT)
+        journal.mark("translate", "page0001.md", DONE)
+        journal.mark("translate", "page0002.md", IN_FLIGHT)
+        journal.mark("translate", "page0003.md", FAILED, "HTTP 500")
+        journal.close()
+        
+        journal = RunJournal(self.work_dir)
+        journal.register("translate", ["page0001.md"])
+        self.assertEqual(journal.state("translate", "page0001.md"), (DONE, None))
+        self.assertEqual(journal.unfinished("translate"), ["page0002.md", "page0003.md"])
+        self.assertEqual(journal.failures("translate"), [("page0003.md", "HTTP 500")])
+        journal.close()
+    
+    def test_atomic_write_keeps_old_file_on_error(self):
+        """Test a failed write leaves the previous file intact and no temporary files."""
+        target = self.work_dir / "output_page0001.md"
+        atomic_write_text(target, "complete")
+        
+        with self.assertRaises(TypeError):
+            atomic_write_text(target, 12345)
+        self.assertEqual(target.read_text(encoding='utf-8'), "complete")
+        self.assertEqual(list(self.work_dir.iterdir()), [target])
+    
+    def test_atomic_write_file_modes(self):
+        """Test new files get the umask's default mode and replaced files keep theirs."""
+        import stat
+        umask = os.umask(0)
+        os.umask(umask)
+        target = self.work_dir / "output.html"
+        atomic_write_text(target, "first")
+        self.assertEqual(stat.S_IMODE(target.stat().st_mode), 0o666 & ~umask)
+        
+        target.chmod(0o640)
+        atomic_write_text(target, "second")
+        self.assertEqual(stat.S_IMODE(target.stat().st_mode), 0o640)
+    
+    def test_failed_pages_fail_step_and_resume_retries_only_them(self):
+        """Test step 3 reports page failures and --resume retranslates just those pages."""
+        book = self.work_dir / "book.md"
+        book.write_text("".join(f"# Chapter {i}\n\ntext {i}\n\n" for i in range(1, 6)), encoding='utf-8')
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=book)
+        self.assertEqual(run_steps(ctx, 1, 2), 0)
+        
+        flaky = FlakyTranslator("Chapter 3")
+        self.assertFalse(translate_markdown_files(ctx.temp_dir, translator=flaky))
+        journal = RunJournal(ctx.temp_dir)
+        self.assertEqual(journal.unfinished("translate"), ["page0003.md"])
+        self.assertIn("API timeout", journal.failures("translate")[0][1])
+        journal.close()
+        self.assertFalse((ctx.output_dir / "output_page0003.md").exists())
+        
+        retry = FlakyTranslator(None)
+        self.assertTrue(translate_markdown_files(ctx.temp_dir, translator=retry, resume=True))
+        self.assertEqual(retry.calls, 1)
+        self.assertEqual((ctx.output_dir / "output_page0003.md").read_text(encoding='utf-8').strip(),
+                         "# CHAPTER 3\n\nTEXT 3")
+
+
+class TestTracing(unittest.TestCase):
+    """Test trace-event export and per-step profiling."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("# One\n\nfirst\n\n# Two\n\nsecond\n", encoding='utf-8')
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        stop_tracing()
+        shutil.rmtree(self.work_dir)
+    
+    def test_trace_has_step_and_page_spans(self):
+        """Test a traced run writes Chrome trace events with step and per-page spans."""
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book,
+                         translator=UppercaseTranslator())
+        start_tracing()
+        self.assertEqual(run_steps(ctx, 1, 4), 0)
+        trace_file = self.work_dir / "trace.json"
+        stop_tracing(trace_file)
+        
+        import json
+        events = json.loads(trace_file.read_text(encoding='utf-8'))['traceEvents']
+        complete = [e for e in events if e['ph'] == 'X']
+        self.assertEqual([e['args']['step'] for e in complete if e['cat'] == 'step'], [1, 2, 3, 4])
+        pages = [e['args'] for e in complete if e['name'] == 'translate_page']
+        self.assertEqual(sorted(a['page'] for a in pages), ["page0001.md", "page0002.md"])
+        self.assertTrue(all(a['bytes'] > 0 for a in pages))
+        self.assertTrue(all(e['dur'] >= 0 and 'tid' in e for e in complete))
+    
+    def test_spans_are_free_when_tracing_is_off(self):
+        """Test span() records nothing and accepts attributes while tracing is off."""
+        with span("noop", page=1) as s:
+            s.set(bytes=10)
+        self.assertIsNone(stop_tracing())
+    
+    def test_trace_file_defaults_to_temp_dir(self):
+        """Test --trace takes an optional FILE and defaults to <temp_dir>/trace.json."""
+        import argparse
+        parser = argparse.ArgumentParser()
+        add_trace_arguments(parser)
+        temp_dir = self.work_dir / "book_temp"
+        self.assertIsNone(trace_file_for(parser.parse_args([]).trace, temp_dir))
+        self.assertEqual(trace_file_for(parser.parse_args(["--trace"]).trace, temp_dir), temp_dir / "trace.json")
+        self.assertEqual(trace_file_for(parser.parse_args(["--trace", "t.json"]).trace, temp_dir), Path("t.json"))
+    
+    def test_profile_writes_stats_and_peak_memory(self):
+        """Test --profile mode stores a .prof file and peak memory per step."""
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book, profile=True)
+        self.assertEqual(run_steps(ctx, 1, 2), 0)
+        self.assertTrue((ctx.temp_dir / "profile" / "step2.prof").exists())
+        self.assertGreater(ctx.metrics["step2_peak_mb"], 0)
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test the synthetic book generators and regression gate."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_synthetic_books_split_into_requested_pages(self):
+        """Test generated markdown and EPUB books yield one page per chapter."""
+        for fmt in ("md", "epub"):
+            result = run_case(fmt, 12, self.work_dir / fmt, end_step=4)
+            self.assertEqual(result['failed_step'], 0)
+            self.assertEqual(result['page_files'], 12)
+            self.assertGreater(result['output_bytes'], 0)
+            self.assertIn('step2_seconds', result)
+    
+    def test_compare_flags_only_regressions_beyond_threshold(self):
+        """Test small or noisy changes pass and real slowdowns are reported."""
+        baseline = {'md-1000': {'wall_seconds': 2.0, 'step3_seconds': 0.01, 'peak_rss_mb': 100.0, 'output_bytes': 1000}}
+        ok = {'md-1000': {'wall_seconds': 2.3, 'step3_seconds': 0.03, 'peak_rss_mb': 103.0, 'output_bytes': 1000}}
+        slow = {'md-1000': {'wall_seconds': 3.0, 'step3_seconds': 0.01, 'peak_rss_mb': 180.0, 'output_bytes': 1000}}
+        self.assertEqual(compare(ok, baseline, 0.25), [])
+        regressions = compare(slow, baseline, 0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("md-1000 wall_seconds"))
+
+
+class TestService(unittest.TestCase):
+    """Test the HTTP translation service."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        import threading
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.translator = UppercaseTranslator()
+        self.service = TranslationService(self.work_dir, self.translator, cpu_workers=1,
+                                          translate_workers=2, rate_limit=0, end_step=4)
+        self.server = serve(self.service, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.stop()
+        shutil.rmtree(self.work_dir)
+    
+    def call(self, method, path, data=None):
+        import json
+        import urllib.request
+        request = urllib.request.Request(self.base + path, data=data, method=method)
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+            return json.loads(body) if 'json' in response.headers['Content-Type'] else body.decode('utf-8')
+    
+    def wait_for(self, job_id):
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            job = self.call("GET", f"/jobs/{job_id}")
+            if job['status'] in ("done", "failed", "cancelled"):
+                return job
+            time.sleep(0.05)
+        self.fail("job did not finish")
+    
+    def test_priority_queue_orders_and_reprioritizes(self):
+        """Test lower priorities run first, FIFO within a priority, and keys can be bumped."""
+        work = PriorityWorkQueue()
+        work.put("a", 1, 10)
+        work.put("b", 1, 10)
+        work.put("a", 2, 10)
+        work.put("c", 1, 0)
+        work.put("a", 3, -1)
+        work.reprioritize("b", 5)
+        work.reprioritize("a", 20, keep=(-1,))
+        self.assertEqual([work.get() for _ in range(5)], [("a", 3), ("c", 1), ("b", 1), ("a", 1), ("a", 2)])
+    
+    def test_jobs_run_and_share_the_translation_cache(self):
+        """Test a submitted book is translated, served per page, and a repeat hits the cache."""
+        book = b"# One\n\nfirst\n\n# Two\n\nsecond\n"
+        job = self.call("POST", "/jobs?filename=book.md&priority=urgent", book)
+        self.assertEqual(self.wait_for(job['id'])['status'], "done")
+        self.assertEqual(self.call("GET", f"/jobs/{job['id']}/pages/2").strip(), "# TWO\n\nSECOND")
+        self.assertIn("---", self.call("GET", f"/jobs/{job['id']}/output"))
+        self.assertEqual(self.translator.calls, 2)
+        
+        again = self.call("POST", "/jobs?filename=book.md", book)
+        self.assertEqual(self.wait_for(again['id'])['pages_done'], 2)
+        self.assertEqual(self.translator.calls, 2)
+        self.assertEqual(self.service.cache.hits, 2)
+    
+    def test_translate_now_rejects_unknown_pages(self):
+        """Test asking for a page the book does not have is a 404 and leaves the job alone."""
+        import urllib.error
+        job = self.call("POST", "/jobs?filename=book.md", b"# One\n\nfirst\n\n# Two\n\nsecond\n")
+        deadline = time.time() + 30
+        while self.call("GET", f"/jobs/{job['id']}")['pages'] == 0 and time.time() < deadline:
+            time.sleep(0.02)
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.call("POST", f"/jobs/{job['id']}/pages/99/translate")
+        self.assertEqual(raised.exception.code, 404)
+        self.assertFalse(self.service.translate_page_now(job['id'], 99))
+        
+        finished = self.wait_for(job['id'])
+        self.assertEqual((finished['status'], finished['pages_done'], finished['pages_failed']), ("done", 2, 0))
+    
+    def test_failed_page_can_be_translated_again(self):
+        """Test a failed page queued again counts as done once, and done pages are not retranslated."""
+        import threading
+        
+        class SlowFlakyTranslator(FlakyTranslator):
+            def __init__(self):
+                super().__init__("second")
+                self.release = threading.Event()
+            
+            def translate_markdown(self, markdown_content, target_language="zh"):
+                if "first" in markdown_content:
+                    self.release.wait(10)
+                return super().translate_markdown(markdown_content, target_language)
+        
+        def wait_until(condition):
+            deadline = time.time() + 30
+            while not condition():
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.02)
+        
+        translator = SlowFlakyTranslator()
+        service = TranslationService(self.work_dir / "jobs", translator, cpu_workers=1, translate_workers=2,
+                                     rate_limit=0, retries=1, end_step=3)
+        service.start()
+        try:
+            with redirect_stdout(io.StringIO()):
+                job = service.submit("book.md", b"# One\n\nfirst\n\n# Two\n\nsecond\n")
+                wait_until(lambda: "page0002.md" in job.failed)
+                translator.fail_marker = None
+                self.assertTrue(service.translate_page_now(job.id, 2))
+                wait_until(lambda: "page0002.md" in job.done)
+                self.assertEqual(job.failed, {})
+                self.assertEqual(job.status, "translating")
+                
+                # A duplicate entry for a done page is skipped, even though its source changed since
+                calls = translator.calls
+                service.page_path(job, 2).write_text("# Two\n\nchanged\n", encoding='utf-8')
+                service.work.put(job.id, service.page_path(job, 2), PAGE_NOW_PRIORITY)
+                wait_until(lambda: service.work.pending(job.id) == 0)
+                translator.release.set()
+                wait_until(lambda: job.status == "done")
+        finally:
+            translator.release.set()
+            service.stop()
+        self.assertEqual(translator.calls, calls + 1)
+        self.assertEqual(job.to_dict()['pages_done'], 2)
+
+
+class TestDistributed(unittest.TestCase):
+    """Test lease-based workers sharing one working directory."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("".join(f"# Chapter {i}\n\ntext {i}\n\n" for i in range(1, 10)), encoding='utf-8')
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_expired_leases_are_stolen(self):
+        """Test a live lease blocks other workers and an expired one is taken over."""
+        first = LeaseQueue(self.work_dir, "first", lease_seconds=0.2)
+        second = LeaseQueue(self.work_dir, "second", lease_seconds=0.2)
+        self.assertTrue(first.claim("translate-page0001"))
+        self.assertFalse(second.claim("translate-page0001"))
+        time.sleep(0.3)
+        self.assertTrue(second.claim("translate-page0001"))
+        self.assertEqual(second.read_lease("translate-page0001")['worker'], "second")
+        self.assertFalse(first.claim("translate-page0001"))
+    
+    def test_workers_match_single_node_output(self):
+        """Test several concurrent workers produce the same output.md as a sequential run."""
+        import threading
+        temp_dir = submit(self.book)
+        translator = UppercaseTranslator()
+        workers = [Worker(temp_dir, translator, f"w{i}", lease_seconds=5, poll_seconds=0.02, end_step=4)
+                   for i in range(3)]
+        results = []
+        threads = [threading.Thread(target=lambda w=w: results.append(w.run())) for w in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(results, [True, True, True])
+        status = queue_status(temp_dir)
+        self.assertEqual(status['done'], status['total'])
+        self.assertEqual(status['by_kind']['translate']['done'], 9)
+        self.assertEqual(sum(w.completed for w in workers), status['total'])
+        self.assertEqual(translator.calls, 9)
+        
+        expected = "\n\n---\n\n".join(f"# CHAPTER {i}\n\nTEXT {i}" for i in range(1, 10))
+        self.assertEqual((temp_dir / "output" / "output.md").read_text(encoding='utf-8'), expected)
+    
+    def test_failed_page_stops_workers(self):
+        """Test a page that keeps failing gives up its render task and the worker returns False."""
+        temp_dir = submit(self.book)
+        worker = Worker(temp_dir, FlakyTranslator("Chapter 3"), "w", lease_seconds=5, poll_seconds=0.02, end_step=4)
+        with redirect_stdout(io.StringIO()):
+            self.assertFalse(worker.run())
+        
+        status = queue_status(temp_dir)
+        self.assertEqual(status['by_kind']['translate'], {'done': 8, 'running': 0, 'failed': 1, 'pending': 0})
+        self.assertEqual(status['by_kind']['render']['failed'], 1)
+        self.assertFalse((temp_dir / "output" / "output.md").exists())
+
+
+class TestPackedWorkspace(unittest.TestCase):
+    """Test the single-file packed workspace."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("".join(f"# Chapter {i}\n\ntext {i}\n\n" for i in range(1, 6)), encoding='utf-8')
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def run_book(self, name, packed, translator):
+        book = self.work_dir / name / "book.md"
+        book.parent.mkdir()
+        shutil.copy(self.book, book)
+        ctx = RunContext(temp_dir=book.parent / "book_temp", input_file=book, translator=translator,
+                         auto_overwrite=True, packed=packed)
+        self.assertEqual(run_steps(ctx, 1, 4), 0)
+        return ctx
+    
+    def test_packed_run_matches_directory_run(self):
+        """Test a packed run writes no page files, produces the same output.md and skips fresh pages."""
+        plain = self.run_book("plain", False, UppercaseTranslator())
+        translator = UppercaseTranslator()
+        packed = self.run_book("packed", True, translator)
+        
+        self.assertFalse((packed.temp_dir / "pages").exists())
+        self.assertEqual(list((packed.temp_dir / "output").glob("output_page*.md")), [])
+        self.assertEqual((packed.temp_dir / "output" / "output.md").read_text(encoding='utf-8'),
+                         (plain.temp_dir / "output" / "output.md").read_text(encoding='utf-8'))
+        
+        packed.reuse_existing = True
+        self.assertEqual(run_steps(packed, 1, 4), 0)
+        self.assertEqual(translator.calls, 5)
+    
+    def test_export_materializes_directory_layout(self):
+        """Test export writes pages and translations with the usual names."""
+        ctx = self.run_book("packed", True, UppercaseTranslator())
+        store = PackedWorkspace(ctx.temp_dir)
+        self.assertEqual(store.names(PAGE), [f"page{i:04d}.md" for i in range(1, 6)])
+        counts = store.export(self.work_dir / "exported")
+        self.assertEqual(counts['pages'], 5)
+        self.assertEqual((self.work_dir / "exported" / "output" / "output_page0002.md").read_text(encoding='utf-8'),
+                         store.get_text(TRANSLATION, "page0002.md"))
+        with self.assertRaises(RuntimeError):
+            with store.batch():
+                store.put(PAGE, "page0001.md", "changed")
+                raise RuntimeError("abort")
+        self.assertNotEqual(store.get_text(PAGE, "page0001.md"), "changed")
+        store.close()
+    
+    def test_packing_translated_workspace_keeps_translations(self):
+        """Test pack switches config.txt to the store and the next run translates nothing."""
+        translator = UppercaseTranslator()
+        ctx = self.run_book("plain", False, translator)
+        (ctx.output_dir / "output_page0001.md").write_text("# CHAPTER 1\n\nHAND FIXED\n", encoding='utf-8')
+        
+        counts = pack_workspace(ctx.temp_dir)
+        self.assertEqual(counts['translations'], 5)
+        ctx = RunContext.from_temp_dir(ctx.temp_dir, translator=translator, reuse_existing=True)
+        self.assertTrue(ctx.packed)
+        shutil.rmtree(ctx.temp_dir / "pages")
+        self.assertEqual(run_steps(ctx, 3, 4), 0)
+        self.assertEqual(translator.calls, 5)
+        self.assertIn("HAND FIXED", (ctx.output_dir / "output.md").read_text(encoding='utf-8'))
+        store = PackedWorkspace(ctx.temp_dir)
+        self.assertEqual(store.info(TRANSLATION, "page0001.md")['params'], {'model': 'manual', 'olang': 'zh'})
+        store.close()
+
+
+class TestMergeIndex(unittest.TestCase):
+    """Test the output.md page index and incremental re-merge."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        (self.work_dir / "output").mkdir()
+        self.output_file = self.work_dir / "output" / "output.md"
+        for n in range(1, 5):
+            self.write_page(n, f"\n# Page {n}\n\n页面 {n}\n\n")
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def write_page(self, n, text):
+        (self.work_dir / "output" / f"output_page{n:04d}.md").write_text(text, encoding='utf-8')
+    
+    def expected(self):
+        pages = sorted((self.work_dir / "output").glob("output_page*.md"))
+        return "\n\n---\n\n".join(p.read_text(encoding='utf-8').strip() for p in pages)
+    
+    def test_index_maps_offsets_and_lines_to_pages(self):
+        """Test each recorded offset and line points at the start of its page."""
+        self.assertTrue(merge_markdown_files(self.work_dir))
+        data = self.output_file.read_bytes()
+        lines = data.decode('utf-8').split('\n')
+        index = load_index(self.output_file)
+        self.assertEqual([e['page'] for e in index['pages']], [f"page{n:04d}.md" for n in range(1, 5)])
+        for n, entry in enumerate(index['pages'], 1):
+            self.assertTrue(data[entry['offset']:].startswith(f"# Page {n}".encode('utf-8')))
+            self.assertEqual(lines[entry['line'] - 1], f"# Page {n}")
+            self.assertEqual(page_at(index, entry['offset'] + entry['length'] - 1)['page'], entry['page'])
+            self.assertEqual(page_at_line(index, entry['line'] + 2)['page'], entry['page'])
+    
+    def test_changed_pages_are_patched_or_rebuilt(self):
+        """Test unchanged runs are fresh, tail edits patch in place and early edits reuse spans."""
+        def merge(versions):
+            sources = [(f"page{n:04d}.md", f"{n}.{v}", lambda n=n, v=v: [f"# Page {n}\n\nv{v}"])
+                       for n, v in enumerate(versions, 1)]
+            return merge_pages(self.output_file, sources, "\n\n---\n\n")
+        
+        self.assertEqual(merge([1, 1, 1, 1]), 'rebuilt')
+        self.assertEqual(merge([1, 1, 1, 1]), 'fresh')
+        self.assertEqual(merge([1, 1, 1, 2, 1]), 'patched')
+        self.assertEqual(merge([2, 1, 1, 2]), 'rebuilt')
+        self.assertTrue(self.output_file.read_text(encoding='utf-8').endswith("# Page 3\n\nv1\n\n---\n\n# Page 4\n\nv2"))
+        
+        self.assertTrue(merge_markdown_files(self.work_dir))
+        self.write_page(4, "# Page 4\n\nchanged and longer\n")
+        self.write_page(5, "# Page 5\n")
+        self.assertTrue(merge_markdown_files(self.work_dir))
+        self.assertEqual(self.output_file.read_text(encoding='utf-8'), self.expected())
+        self.assertIsNotNone(load_index(self.output_file))
+        
+        self.write_page(1, "# Page 1\n\nedited\n")
+        (self.work_dir / "output" / "output_page0005.md").unlink()
+        self.assertTrue(merge_markdown_files(self.work_dir))
+        self.assertEqual(self.output_file.read_text(encoding='utf-8'), self.expected())
+        self.assertEqual(len(load_index(self.output_file)['pages']), 4)
+
+
+class TestMarkdownRenderer(unittest.TestCase):
+    """Test the in-process markdown renderer and the per-page render cache."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("# One\n\nfirst\n\n# Two\n\nsecond\n\n# Three\n\nthird\n", encoding='utf-8')
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_heading_ids_match_pandoc(self):
+        """Test heading ids follow pandoc's rules and stay unique across the document."""
+        html = render_markdown("# Hello, World!\n\n## Hello, World!\n\n# 你好 世界\n\n# 123\n\n# Named {#custom}\n")
+        
+        for heading_id in ('hello-world', 'hello-world-1', '你好-世界', 'section', 'custom'):
+            self.assertIn(f'id="{heading_id}"', html)
+        self.assertEqual(fill_template("$if(title)$<title>$title$</title>$endif$$body$ $$",
+                                       {'title': "T", 'body': "B"}), "<title>T</title>B $")
+    
+    def test_block_structure(self):
+        """Test lists, figures, code blocks and tables render like pandoc's HTML."""
+        html = render_markdown("- a\n- b\n\n1. x\n\n   y\n2. z\n\n![cap](img.png)\n\n"
+                               "```py\nx<1\n```\n\n| a | b |\n|---|--:|\n| 1 | 2 |\n")
+        
+        self.assertIn("<ul>\n<li>a</li>\n<li>b</li>\n</ul>", html)
+        self.assertIn("<li>\n<p>x</p>\n<p>y</p>\n</li>", html)
+        self.assertIn('<figure>\n<img src="img.png" alt="cap" />\n<figcaption aria-hidden="true">cap</figcaption>\n</figure>', html)
+        self.assertIn('<pre class="py"><code>x&lt;1</code></pre>', html)
+        self.assertIn('<th style="text-align: right;">b</th>', html)
+    
+    def test_edited_page_is_rendered_again(self):
+        """Test step 5 re-renders only the pages whose translation changed."""
+        ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book,
+                         output_lang="zh", translator=UppercaseTranslator())
+        self.assertEqual(run_steps(ctx, 1, 5), 0)
+        html_file = ctx.output_dir / "output.html"
+        html = html_file.read_text(encoding='utf-8')
+        self.assertIn('<h1 id="one">ONE</h1>', html)
+        self.assertIn("<!-- page: page0002.md -->", html)
+        
+        (ctx.output_dir / "output_page0002.md").write_text("# Two\n\nedited\n", encoding='utf-8')
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(run_steps(ctx, 4, 5), 0)
+        self.assertIn("Rendered 1 of 3 pages (2 from the render cache)", output.getvalue())
+        self.assertIn("<p>edited</p>", html_file.read_text(encoding='utf-8'))
+    
+    def test_pandoc_only_syntax_is_detected(self):
+        """Test pandoc extensions are recognized and footnote definitions are not link definitions."""
+        for line in ("::: {#ch01 .chapter}\n", '![a](a.png){width="50%"}\n', "see[^1]\n", "[caps]{.smallcaps}\n"):
+            self.assertIsNotNone(find_pandoc_syntax([line]), line)
+        self.assertIsNone(find_pandoc_syntax(["# Title {#id}\n", "[link](url) and [ref][x]\n"]))
+        
+        html = render_markdown("Text[^1]\n\n[^1]: note\n")
+        self.assertNotIn('href="note"', html)
+        self.assertIn("[^1]: note", html)
+        
+        (self.work_dir / "output").mkdir()
+        (self.work_dir / "output" / "output.md").write_text("::: note\nText\n:::\n", encoding='utf-8')
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertTrue(convert_to_html(self.work_dir, renderer="auto"))
+        if shutil.which("pandoc"):
+            self.assertIn("uses fenced divs (:::); rendering with pandoc", out.getvalue())
+        else:
+            self.assertIn("pandoc is not installed, so they are left as text", out.getvalue())
+
+
+class TestPandocChunks(unittest.TestCase):
+    """Test splitting a book into pandoc chunks and stitching their HTML."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_chunks_cover_consecutive_pages(self):
+        """Test chunks are contiguous runs of whole pages sized by the worker count."""
+        pages = [(f"page{n:04d}.md", "", n * 300_000, 290_000) for n in range(10)]
+        chunks = plan_chunks(pages, 4)
+        
+        self.assertEqual(sum(count for _, _, count in chunks), 10)
+        self.assertEqual(chunks[0], (0, 590_000, 2))
+        small = [(f"page{n:04d}.md", "", n * 1000, 990) for n in range(10)]
+        self.assertEqual(plan_chunks(small, 8), [(0, 9990, 10)])
+        
+        md_file = self.work_dir / "output.md"
+        md_file.write_text("[a]: http://a\n```\n[b]: http://b\n```\n[^1]: note\n    more\ntext\n", encoding='utf-8')
+        self.assertEqual(collect_definitions(md_file), "[a]: http://a\n[^1]: note\n    more\n")
+    
+    def test_stitched_ids_match_a_single_pass(self):
+        """Test heading ids are deduplicated across chunks and footnotes renumbered into one list."""
+        chunk = ('<h1 id="intro">Intro</h1>\n<p>x<a href="#fn1" class="footnote-ref" id="fnref1" role="doc-noteref">'
+                 '<sup>1</sup></a></p>\n<h2 id="intro-1">Intro</h2>\n<h2 id="named">Other</h2>\n'
+                 '<section id="footnotes" class="footnotes footnotes-end-of-document" role="doc-endnotes">\n<hr />\n'
+                 '<ol>\n<li id="fn1"><p>note<a href="#fnref1" class="footnote-back" role="doc-backlink">↩︎</a></p></li>\n'
+                 '</ol>\n</section>')
+        stitcher = ChunkStitcher()
+        first = stitcher.stitch(chunk)
+        second = stitcher.stitch(chunk)
+        
+        self.assertNotIn("<section", first + second)
+        self.assertIn('<h1 id="intro-2">Intro</h1>', second)
+        self.assertIn('<h2 id="intro-3">Intro</h2>', second)
+        self.assertIn('<h2 id="named">Other</h2>', second)
+        self.assertIn('href="#fn2" class="footnote-ref" id="fnref2" role="doc-noteref"><sup>2</sup>', second)
+        notes = stitcher.footnotes()
+        self.assertEqual(notes.count("<li id="), 2)
+        self.assertIn('<li id="fn2"><p>note<a href="#fnref2"', notes)
+
+
+class TestChapterHtml(unittest.TestCase):
+    """Test the multi-file chapter HTML output."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("# One\n\nsee [two](#two)\n\n![pic](../images/pic.png)\n\n# Two\n\nsecond\n\n"
+                             "## Part\n\n# Three\n\nthird\n", encoding='utf-8')
+        self.ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book,
+                              translator=MockTranslator(), html_layout="chapters")
+        self.site = self.ctx.output_dir / "html"
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_chapters_link_to_each_other(self):
+        """Test each chapter gets a file with hashed lazy images, cross-chapter links and an index entry."""
+        self.assertEqual(run_steps(self.ctx, 1, 2), 0)
+        (self.ctx.images_dir / "pic.png").write_bytes(b"\x89PNG image")
+        self.assertEqual(run_steps(self.ctx, 3, 6), 0)
+        
+        self.assertEqual(sorted(p.name for p in self.site.glob("chapter*.html")),
+                         ["chapter0001.html", "chapter0002.html", "chapter0003.html"])
+        self.assertFalse((self.ctx.output_dir / "output.html").exists())
+        first = (self.site / "chapter0001.html").read_text(encoding='utf-8')
+        self.assertIn('href="chapter0002.html#two"', first)
+        self.assertIn('href="book.css"', first)
+        self.assertNotIn("<style", first)
+        image = re.search(r'<img loading="lazy" src="(images/[0-9a-f]{16}\.png)"', first).group(1)
+        self.assertEqual((self.site / image).read_bytes(), b"\x89PNG image")
+        index = (self.site / "index.html").read_text(encoding='utf-8')
+        self.assertIn('<a href="chapter0002.html#part">Part</a>', index)
+    
+    def test_only_changed_chapters_are_rewritten(self):
+        """Test a rebuild rewrites only the chapter whose page changed."""
+        self.assertEqual(run_steps(self.ctx, 1, 5), 0)
+        before = {p.name: p.stat().st_mtime_ns for p in self.site.glob("*.html")}
+        time.sleep(0.01)
+        
+        (self.ctx.output_dir / "output_page0003.md").write_text("# Three\n\nedited\n", encoding='utf-8')
+        self.assertEqual(run_steps(self.ctx, 4, 5), 0)
+        after = {p.name: p.stat().st_mtime_ns for p in self.site.glob("*.html")}
+        self.assertEqual([name for name in sorted(after) if after[name] != before[name]], ["chapter0003.html"])
+        self.assertIn("<p>edited</p>", (self.site / "chapter0003.html").read_text(encoding='utf-8'))
+    
+    def test_toc_step_follows_the_current_layout(self):
+        """Test step 6 reports the EPUB after switching from chapters, though the old site remains."""
+        self.assertEqual(run_steps(self.ctx, 1, 6), 0)
+        self.ctx.html_layout = "epub"
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(run_steps(self.ctx, 5, 6), 0)
+        
+        self.assertTrue((self.site / "index.html").exists())
+        self.assertIn("EPUB output: the table of contents is in the nav document", out.getvalue())
+        self.assertNotIn("Chapter output", out.getvalue())
+
+
+class TestEpubWriter(unittest.TestCase):
+    """Test the streaming EPUB3 writer."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        (self.work_dir / "images").mkdir()
+        (self.work_dir / "images" / "pic.png").write_bytes(b"\x89PNG image")
+        self.epub = self.work_dir / "output.epub"
+        self.pages = {
+            "page0001.md": "# One\n\nsee [part](#part) &copy; <br>\n\n![pic](images/pic.png)\n",
+            "page0002.md": "# Two\n\n## Part\n\ntext\n",
+            "page0003.md": "# Three\n\nthird\n",
+        }
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def write(self):
+        fragments = lambda: ((page, *render_fragment(text)) for page, text in self.pages.items())
+        return write_epub(fragments, self.epub, self.work_dir, "Book", "zh", "book.md")
+    
+    def test_package_is_valid_epub(self):
+        """Test the package has a stored mimetype first, well-formed XHTML, a nested nav and readable chapters."""
+        import zipfile
+        import xml.etree.ElementTree as ET
+        self.assertEqual(self.write(), (3, 8, 0))
+        
+        with zipfile.ZipFile(self.epub) as epub:
+            first = epub.infolist()[0]
+            self.assertEqual((first.filename, first.compress_type), ("mimetype", zipfile.ZIP_STORED))
+            self.assertIsNone(epub.testzip())
+            for name in epub.namelist():
+                if name.endswith(('.xhtml', '.opf', '.xml')):
+                    ET.fromstring(epub.read(name))
+            nav = epub.read("OEBPS/nav.xhtml").decode('utf-8')
+            first_chapter = epub.read("OEBPS/chapter0001.xhtml").decode('utf-8')
+        self.assertIn('<a href="chapter0002.xhtml#two">Two</a>\n<ol>\n<li><a href="chapter0002.xhtml#part">', nav)
+        self.assertIn('<a href="chapter0002.xhtml#part">part</a> © <br />', first_chapter)
+        
+        (self.work_dir / "read_back").mkdir()
+        chapters = list(read_epub_chapters(self.epub, self.work_dir / "read_back"))
+        self.assertEqual(len(chapters), 3)
+        self.assertTrue(chapters[2].startswith("# Three"))
+    
+    def test_unchanged_entries_are_copied(self):
+        """Test repackaging copies unchanged chapters and images from the previous package."""
+        import zipfile
+        self.write()
+        with zipfile.ZipFile(self.epub) as epub:
+            before = {info.filename: info.CRC for info in epub.infolist()}
+        
+        self.pages["page0003.md"] = "# Three\n\nedited\n"
+        chapters, entries, reused = self.write()
+        self.assertGreaterEqual(reused, 4)
+        with zipfile.ZipFile(self.epub) as epub:
+            self.assertIsNone(epub.testzip())
+            after = {info.filename: info.CRC for info in epub.infolist()}
+            self.assertIn("<p>edited</p>", epub.read("OEBPS/chapter0003.xhtml").decode('utf-8'))
+        self.assertEqual(before["OEBPS/chapter0001.xhtml"], after["OEBPS/chapter0001.xhtml"])
+        self.assertNotEqual(before["OEBPS/chapter0003.xhtml"], after["OEBPS/chapter0003.xhtml"])
+    
+    def test_raw_html_becomes_well_formed(self):
+        """Test unbalanced raw HTML in a page still gives chapters that parse as XML."""
+        import zipfile
+        import xml.etree.ElementTree as ET
+        self.pages["page0003.md"] = "# Three\n\n<div>unclosed\n\ntext </span> &nbsp;<input disabled>\n"
+        self.write()
+        with zipfile.ZipFile(self.epub) as epub:
+            for name in epub.namelist():
+                if name.endswith('.xhtml'):
+                    ET.fromstring(epub.read(name))
+            third = epub.read("OEBPS/chapter0003.xhtml").decode('utf-8')
+        self.assertIn('<input disabled="disabled" />', third)
+        self.assertIn('</div>\n</body>', third)
+    
+    def test_unbound_prefixes_and_comment_dashes_are_made_safe(self):
+        """Test prefixed names without a bound prefix are escaped or dropped and comments stay valid."""
+        import xml.etree.ElementTree as ET
+        body = xhtml_safe('<o:p>x</o:p><span foo:bar="1" epub:type="note" xml:lang="en">y</span><!-- a---b -->'
+                          '<!---->')
+        self.assertIn('&lt;o:p&gt;x', body)
+        self.assertIn('<span epub:type="note" xml:lang="en">y</span>', body)
+        self.assertNotIn('foo:bar', body)
+        self.assertIn('<!-- a- - -b -->', body)
+        ET.fromstring(f'<div xmlns:epub="http://www.idpf.org/2007/ops">{body}</div>')
+
+
+class TestImageAssets(unittest.TestCase):
+    """Test the cached image asset stage and the sync into output/images."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.images = self.temp_dir / "images"
+        self.images.mkdir()
+        (self.images / "a.png").write_bytes(b"\x89PNG first")
+        (self.images / "b.jpg").write_bytes(b"\xff\xd8 second")
+        self.dest = self.temp_dir / "output" / "images"
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.temp_dir)
+    
+    def prepare(self):
+        with redirect_stdout(io.StringIO()) as out:
+            assets = prepare_images(self.temp_dir, workers=1)
+        return assets, out.getvalue()
+    
+    def test_assets_are_cached_and_synced_incrementally(self):
+        """Test unchanged images are neither reprocessed nor relinked and stale ones are removed."""
+        assets, _ = self.prepare()
+        self.assertEqual(set(assets), {(self.images / "a.png").resolve(), (self.images / "b.jpg").resolve()})
+        self.assertEqual(sync_images(assets, self.dest), 2)
+        self.assertEqual(sorted(p.name for p in self.dest.iterdir()), sorted(p.name for p in assets.values()))
+        
+        assets, out = self.prepare()
+        self.assertNotIn("Processing", out)
+        self.assertEqual(sync_images(assets, self.dest), 0)
+        
+        (self.images / "a.png").write_bytes(b"\x89PNG changed")
+        (self.images / "b.jpg").unlink()
+        assets, out = self.prepare()
+        self.assertIn("Processing 1 images", out)
+        self.assertEqual(sync_images(assets, self.dest), 1)
+        self.assertEqual([p.name for p in self.dest.iterdir()], [p.name for p in assets.values()])
+        self.assertEqual(len(list((self.temp_dir / "asset_cache").iterdir())), 2)
+    
+    def test_html_embeds_processed_images(self):
+        """Test output.html embeds the processed images instead of linking the originals."""
+        import base64
+        (self.temp_dir / "output").mkdir()
+        (self.temp_dir / "output" / "output.md").write_text("# Pics\n\n![a](../images/a.png)\n", encoding='utf-8')
+        with redirect_stdout(io.StringIO()):
+            self.assertTrue(convert_to_html(self.temp_dir))
+            assets = prepare_images(self.temp_dir, workers=1)
+        
+        html_text = (self.temp_dir / "output" / "output.html").read_text(encoding='utf-8')
+        src = re.search(r'<img src="([^"]*)"', html_text).group(1)
+        self.assertTrue(src.startswith("data:image/png;base64,"))
+        self.assertEqual(base64.b64decode(src.split(",", 1)[1]),
+                         assets[(self.images / "a.png").resolve()].read_bytes())
+        self.assertNotIn("../images/a.png", html_text)
+
+
+class TestTocRewriter(unittest.TestCase):
+    """Test the streaming TOC rewriter of step 6."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.html_file = self.temp_dir / "output.html"
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.temp_dir)
+    
+    def rewrite(self, text):
+        self.html_file.write_text(text, encoding='utf-8')
+        with redirect_stdout(io.StringIO()):
+            self.assertTrue(insert_toc(self.html_file))
+        return self.html_file.read_text(encoding='utf-8')
+    
+    def test_toc_ids_and_styles_are_spliced_in(self):
+        """Test the TOC follows <body>, styles end <head>, missing ids are added and nothing else changes."""
+        original = ('<html>\n<head>\n<title>T</title>\n</head>\n<body class="book">\n'
+                    '<h1 id="intro">Intro &amp; <em>more</em></h1>\n<p>text</p>\n'
+                    '<h2\n  class="sub">Second Part!</h2>\n</body>\n</html>\n')
+        result = self.rewrite(original)
+        
+        self.assertIn('<li><details open><summary><a href="#intro">Intro &amp; more</a></summary><ul>\n'
+                      '  <li><a href="#heading-2-second-part">Second Part!</a></li>\n</ul></details></li>', result)
+        self.assertIn('<body class="book"><div id="table-of-contents">', result)
+        self.assertIn(add_toc_styles() + '</head>', result)
+        self.assertIn('<h2\n  class="sub" id="heading-2-second-part">', result)
+        
+        toc_start = result.index('<div id="table-of-contents">')
+        toc_end = result.index('</div>\n', toc_start) + len('</div>\n')
+        stripped = (result[:toc_start] + result[toc_end:]).replace(add_toc_styles(), '')
+        self.assertEqual(stripped.replace(' id="heading-2-second-part"', ''), original)
+    
+    def test_large_document_without_body(self):
+        """Test headings split across read chunks are found and the TOC is appended without <body>."""
+        filler = "<p>" + "x" * 1000 + "</p>\n"
+        original = "".join(f"{filler * 20}<h2>Part {i}</h2>\n" for i in range(20))
+        result = self.rewrite(original)
+        
+        self.assertEqual(result.count('<li>'), 20)
+        self.assertIn('<h2 id="heading-20-part-19">Part 19</h2>', result)
+        self.assertTrue(result.endswith('</ul>\n</div>\n'))
+        self.assertNotIn('<style>', result)
+
+
+class TestHeadingIndex(unittest.TestCase):
+    """Test the heading index written by step 4 and the TOC built from it."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("# One\n\nfirst\n\n# Two\n\n## Part {#part}\n\nsecond\n\n# One\n\nagain\n",
+                             encoding='utf-8')
+        self.ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book,
+                              translator=MockTranslator())
+        self.md_file = self.ctx.output_dir / "output.md"
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_index_records_ids_pages_and_offsets(self):
+        """Test headings get renderer ids and byte offsets, and only changed pages are parsed again."""
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(run_steps(self.ctx, 1, 4), 0)
+        headings = load_headings(self.md_file)
+        self.assertEqual([(h['level'], h['id']) for h in headings], [(1, "one"), (1, "two"), (2, "part"), (1, "one-1")])
+        data = self.md_file.read_bytes()
+        for heading in headings:
+            self.assertTrue(data[heading['offset']:].startswith(b"#"))
+        
+        page = self.ctx.output_dir / f"output_{headings[1]['page']}"
+        page.write_text(page.read_text(encoding='utf-8') + "\n\n### Extra\n", encoding='utf-8')
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(run_steps(self.ctx, 4, 4), 0)
+        self.assertRegex(out.getvalue(), r"Indexed 5 headings \(1 of \d+ pages parsed\)")
+        self.assertEqual(load_headings(self.md_file)[3]['id'], "extra")
+    
+    def test_renderer_writes_the_toc(self):
+        """Test the builtin renderer writes a nested TOC once and step 6 leaves output.html alone."""
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(run_steps(self.ctx, 1, 6), 0)
+        self.assertIn("up to date", out.getvalue())
+        
+        result = (self.ctx.output_dir / "output.html").read_text(encoding='utf-8')
+        self.assertEqual(result.count('id="table-of-contents"'), 1)
+        self.assertIn('<summary><a href="#two">Two</a></summary><ul>\n  <li><a href="#part">Part</a></li>', result)
+        self.assertIn('<h1 id="one-1">One</h1>', result)
+        
+        many = [{'level': 1 + n % 2, 'id': f"h{n}", 'text': str(n)} for n in range(COLLAPSE_THRESHOLD + 2)]
+        self.assertNotIn("<details open>", nested_toc(many))
+
+
+class TestSearchIndex(unittest.TestCase):
+    """Test the sharded full-text search index."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.temp_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.temp_dir)
+    
+    def lookup(self, shard_script, term):
+        """Decode a shard script like the widget does and return the page names holding term."""
+        import json
+        shard = json.loads(shard_script[shard_script.index(',') + 1:-3])
+        previous = ''
+        terms = {}
+        for coded, postings in zip(shard['terms'].split(' '), shard['postings'].split(';')):
+            previous = previous[:int(coded[0])] + coded[1:]
+            terms[previous] = postings
+        doc = 0
+        pages = []
+        for delta in terms[term].split(',') if term in terms else []:
+            doc += int(delta, 36)
+            pages.append(shard['docs'][doc][2])
+        return pages
+    
+    def test_cjk_bigrams_and_shards(self):
+        """Test CJK text is indexed as bigrams, words whole, and every shard's Bloom filter holds its terms."""
+        self.assertEqual(list(tokenize("Hello 中文搜索, x2!")), ["hello", "中文", "文搜", "搜索", "x2"])
+        
+        search = SearchIndex()
+        search.add_page("page0001.md", '<h1 id="one">一</h1>\n<p>全文搜索 alpha</p>')
+        search.add_page("page0002.md", '<p>搜索 beta</p>')
+        search.add_page("page0003.md", '<h1 id="two">二</h1>\n<p>alpha gamma</p>')
+        files, stats = search.files()
+        
+        self.assertEqual(sorted(files), ["index.js", "shard0001.js", "shard0002.js"])
+        self.assertEqual(self.lookup(files["shard0001.js"], "搜索"), ["page0001.md", "page0002.md"])
+        self.assertEqual(self.lookup(files["shard0002.js"], "alpha"), ["page0003.md"])
+        self.assertEqual(self.lookup(files["shard0002.js"], "beta"), [])
+        self.assertIn('"#one","page0002.md"', files["shard0001.js"])
+        
+        import base64
+        import json
+        manifest = json.loads(files["index.js"][len("window.bookSearch="):-2])
+        bloom = base64.b64decode(manifest['shards'][1]['bloom'])
+        for position in bloom_positions("gamma", manifest['shards'][1]['bits']):
+            self.assertTrue(bloom[position >> 3] & (1 << (position & 7)))
+        self.assertEqual(stats['shards'], 2)
+    
+    def test_render_writes_index_for_search_template(self):
+        """Test step 5 writes the index when the template has the search widget."""
+        output_dir = self.temp_dir / "output"
+        output_dir.mkdir()
+        (output_dir / "output.md").write_text("# 第一章\n\n翻译后的文本\n\n---\n\n# Two\n\nmore\n", encoding='utf-8')
+        metrics = {}
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertTrue(convert_to_html(self.temp_dir, metrics=metrics))
+        
+        self.assertIn("Search index:", out.getvalue())
+        self.assertTrue((output_dir / "search" / "index.js").is_file())
+        self.assertIn("var base = 'search/'", (output_dir / "output.html").read_text(encoding='utf-8'))
+        self.assertEqual(metrics['search_index_bytes'],
+                         sum(p.stat().st_size for p in (output_dir / "search").iterdir()))
+
+
+class TestWatchMode(unittest.TestCase):
+    """Test watching page files and rebuilding steps 4-6 in place."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.book = self.work_dir / "book.md"
+        self.book.write_text("# One\n\nfirst\n\n# Two\n\nsecond\n\n# Three\n\nthird\n", encoding='utf-8')
+        self.ctx = RunContext(temp_dir=self.work_dir / "book_temp", input_file=self.book,
+                              output_lang="zh", translator=UppercaseTranslator())
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(run_steps(self.ctx, 1, 6), 0)
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        shutil.rmtree(self.work_dir)
+    
+    def test_polling_watcher_reports_edited_pages(self):
+        """Test the polling watcher reports edited translations and ignores step outputs."""
+        watcher = PollingWatcher(watched_files(self.ctx))
+        edited = self.ctx.output_dir / "output_page0002.md"
+        edited.write_text("# Two\n\nedited\n", encoding='utf-8')
+        (self.ctx.output_dir / "output.md").write_text("changed", encoding='utf-8')
+        (self.ctx.pages_dir / "page0003.md").unlink()
+        
+        self.assertEqual(watcher.wait(), {edited, self.ctx.pages_dir / "page0003.md"})
+    
+    def test_rebuild_renders_only_the_edited_page(self):
+        """Test a rebuild keeps its render work in memory and renders only edited pages."""
+        self.ctx.render_memo = RenderMemo()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertTrue(rebuild(self.ctx))
+            edited = self.ctx.output_dir / "output_page0002.md"
+            edited.write_text("# Two\n\nedited\n", encoding='utf-8')
+            self.assertTrue(rebuild(self.ctx, {edited}))
+        
+        self.assertIn("Rendered 1 of 3 pages (2 from the render cache)", output.getvalue())
+        self.assertIn("Rebuilt after 1 changed files in", output.getvalue())
+        self.assertIn("<p>edited</p>", (self.ctx.output_dir / "output.html").read_text(encoding='utf-8'))
+        self.assertEqual(len(self.ctx.render_memo.fragments), 3)
+
+
+class TestProgress(unittest.TestCase):
+    """Test progress counters, their Prometheus exposition and the live status line."""
+    
+    def setUp(self):
+        """Set up test fixtures."""
+        self.work_dir = Path(tempfile.mkdtemp())
+    
+    def tearDown(self):
+        """Clean up test fixtures."""
+        stop_progress()
+        shutil.rmtree(self.work_dir)
+    
+    def test_metrics_are_served_and_written(self):
+        """Test counters, rates and the ETA reach the /metrics endpoint and the metrics file."""
+        import urllib.request
+        
+        metrics_file = self.work_dir / "run.prom"
+        with redirect_stdout(io.StringIO()):
+            progress = start_progress({'book': 'novel.pdf'}, metrics_file, metrics_port=0)
+        add_total("translate", 10)
+        for _ in range(4):
+            item_done("translate")
+        item_done("translate", skipped=True)
+        item_failed("translate")
+        with track_request() as request:
+            request.set(prompt_tokens=120, completion_tokens=80)
+        
+        text = urllib.request.urlopen(metrics_url()).read().decode('utf-8')
+        self.assertIn('ebook_pipeline_items_done_total{book="novel.pdf",stage="translate"} 5', text)
+        self.assertIn('ebook_pipeline_items_skipped_total{book="novel.pdf",stage="translate"} 1', text)
+        self.assertIn('ebook_pipeline_tokens_total{book="novel.pdf",kind="completion"} 80', text)
+        self.assertIn('ebook_pipeline_eta_seconds{book="novel.pdf",stage="translate"}', text)
+        self.assertIn("translate 5/10 (50%)", progress.status_line())
+        
+        with redirect_stdout(io.StringIO()):
+            stop_progress()
+        self.assertIn('ebook_pipeline_requests_total{book="novel.pdf"} 1', metrics_file.read_text(encoding='utf-8'))
+    
+    def test_live_view_keeps_status_below_output(self):
+        """Test the status line is cleared before other output and redrawn below complete lines."""
+        stream = io.StringIO()
+        view = LiveView(stream)
+        view.show("translate 1/2")
+        view.write("Created: page0001.md")
+        view.write("\n")
+        view.close()
+        
+        self.assertEqual(stream.getvalue(), "translate 1/2\r\x1b[KCreated: page0001.md\ntranslate 1/2\r\x1b[K")
+
+
 class TestProjectStructure(unittest.TestCase):
     """Test project structure and file existence."""
     
@@ -77,6 +1665,7 @@ class TestProjectStructure(unittest.TestCase):
             "step4_merge_md.py",
             "step5_convert_html.py",
             "step6_generate_toc.py",
+            "pipeline.py",
             "requirements.txt",
             "template.html",
             "README.md"
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Tracing and Profiling
+Records spans (per step, page and API call) as Chrome trace events that
+open in Perfetto (ui.perfetto.dev) or chrome://tracing, and optionally
+profiles steps with cProfile and tracemalloc.
+
+Tracing is process-wide and off by default; span() costs almost nothing
+until start_tracing() is called.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from atomic_io import atomic_write_text
+
+_tracer = None
+
+
+class Span:
+    """An open span; set() adds attributes that are only known at the end (e.g. tokens)."""
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = f"{exc_type.__name__}: {exc}"
+        self.tracer.add(self.name, self.cat, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class _NullSpan:
+    """Stand-in returned by span() while tracing is off."""
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Thread-safe collector of Chrome trace-event "complete" events."""
+
+    def __init__(self):
+        self.events = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': round((start - self.origin) * 1e6, 1),
+            'dur': round((end - start) * 1e6, 1),
+            'pid': self.pid,
+            'tid': thread.ident,
+            'args': args,
+        }
+        with self._lock:
+            self.events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def to_json(self):
+        """Return the trace as a Chrome trace-event JSON document."""
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                         'args': {'name': name}} for tid, name in self._threads.items()]
+            return {'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}
+
+    def save(self, trace_file):
+        atomic_write_text(trace_file, json.dumps(self.to_json(), ensure_ascii=False))
+
+
+def start_tracing():
+    """Start recording spans in this process; return the tracer."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing(trace_file=None):
+    """Stop recording and write the trace file if one is given; return the tracer."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and trace_file:
+        tracer.save(trace_file)
+        print(f"Trace written to {trace_file} ({len(tracer.events)} spans)")
+    return tracer
+
+
+def tracing_enabled():
+    return _tracer is not None
+
+
+def span(name, cat="pipeline", **args):
+    """Context manager recording one span with attributes, e.g. span("page", page="page0001.md")."""
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, cat, args)
+
+
+@contextlib.contextmanager
+def profiled(name, profile_dir, metrics=None):
+    """Profile a block with cProfile and tracemalloc.
+
+    Writes <profile_dir>/<name>.prof (view with `python -m pstats` or
+    snakeviz) and stores the peak traced memory in metrics[name + "_peak_mb"].
+    """
+    import cProfile
+    import tracemalloc
+
+    already_tracing = tracemalloc.is_tracing()
+    if already_tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        if not already_tracing:
+            tracemalloc.stop()
+        # Created only now: step 1 must not find its working directory already there
+        profile_dir = Path(profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        profile_file = profile_dir / f"{name}.prof"
+        profiler.dump_stats(str(profile_file))
+        if metrics is not None:
+            metrics[f"{name}_peak_mb"] = peak_mb
+        print(f"Profile: {profile_file} (peak traced memory {peak_mb:.1f} MB)")
+
+
+def add_trace_arguments(parser):
+    """Add the shared --trace and --profile options to a step script's parser."""
+    parser.add_argument("--trace", nargs="?", const="", metavar="FILE",
+                        help="Write a Chrome trace-event JSON file of steps, pages and API calls "
+                             "(default: <temp_dir>/trace.json; open in ui.perfetto.dev)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile with cProfile and tracemalloc, writing .prof files to <temp_dir>/profile")
+
+
+def trace_file_for(trace, temp_dir):
+    """Resolve a --trace value: None when tracing is off, <temp_dir>/trace.json when no FILE was given."""
+    if trace is None:
+        return None
+    return Path(trace) if trace else Path(temp_dir) / "trace.json"
+
+
+@contextlib.contextmanager
+def trace_session(name, trace_file=None, profile_dir=None):
+    """Trace and/or profile a whole script run as one top-level span."""
+    if trace_file:
+        start_tracing()
+    try:
+        with contextlib.ExitStack() as stack:
+            if profile_dir:
+                stack.enter_context(profiled(name, profile_dir))
+            stack.enter_context(span(name, "step"))
+            yield
+    finally:
+        if trace_file:
+            stop_tracing(trace_file)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Watch Mode
+Keeps the output up to date while editors correct translations. pages/ and
+output/ are watched (with inotify where the inotify_simple package is
+installed on Linux, by polling file stats otherwise) and every batch of
+changes runs steps 4-6 again in this process. Step 4 only rereads the
+changed pages, and step 5 keeps its fragments and search terms in memory
+between rebuilds, so an edit is merged, rendered and indexed on its own.
+"""
+
+import fnmatch
+import importlib
+import importlib.util
+import os
+import sys
+import time
+from pathlib import Path
+
+from build_graph import BuildGraph
+from pipeline import STEPS
+from step3_translate import create_translator, output_path_for, translate_tracked, translation_params
+from step5_convert_html import RenderMemo
+from tracing import span
+
+# Optional dependencies are only imported by the functions that need them
+INOTIFY_AVAILABLE = sys.platform.startswith("linux") and importlib.util.find_spec("inotify_simple") is not None
+
+# Seconds between scans when polling
+POLL_INTERVAL = 0.25
+
+# Changes less than this many seconds apart are rebuilt together (editors save in several writes)
+SETTLE_SECONDS = 0.1
+
+# Steps run again after every change
+REBUILD_STEPS = (4, 5, 6)
+
+
+def watched_files(ctx):
+    """Return (directory, filename pattern) pairs of the files that trigger a rebuild."""
+    return [(ctx.pages_dir, "page*.md"), (ctx.output_dir, "output_page*.md")]
+
+
+def snapshot(watched):
+    """Return {path: (size, mtime_ns)} of the watched files."""
+    state = {}
+    for directory, pattern in watched:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not fnmatch.fnmatch(entry.name, pattern):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                state[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+def changed_paths(old, new):
+    """Return the paths added, removed or modified between two snapshots."""
+    return {path for path in old.keys() | new.keys() if old.get(path) != new.get(path)}
+
+
+class PollingWatcher:
+    """Detect changes by comparing file stats every POLL_INTERVAL seconds."""
+
+    name = "polling"
+
+    def __init__(self, watched):
+        self.watched = watched
+        self.state = snapshot(watched)
+
+    def wait(self):
+        """Block until watched files change and settle; return the changed paths."""
+        while True:
+            time.sleep(POLL_INTERVAL)
+            current = snapshot(self.watched)
+            if current == self.state:
+                continue
+            while True:
+                time.sleep(SETTLE_SECONDS)
+                settled = snapshot(self.watched)
+                if settled == current:
+                    break
+                current = settled
+            changed = changed_paths(self.state, current)
+            self.state = current
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Receive changes from the kernel through inotify."""
+
+    name = "inotify"
+
+    def __init__(self, watched):
+        from inotify_simple import INotify, flags
+
+        self.inotify = INotify()
+        # Editors either rewrite a file in place or rename a new one over it
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE
+        self.watches = {self.inotify.add_watch(directory, mask): (Path(directory), pattern)
+                        for directory, pattern in watched}
+
+    def wait(self):
+        """Block until watched files change and settle; return the changed paths."""
+        while True:
+            events = self.inotify.read()
+            while True:
+                more = self.inotify.read(timeout=int(SETTLE_SECONDS * 1000))
+                if not more:
+                    break
+                events.extend(more)
+            changed = set()
+            for event in events:
+                directory, pattern = self.watches.get(event.wd, (None, None))
+                if directory and fnmatch.fnmatch(event.name, pattern):
+                    changed.add(directory / event.name)
+            if changed:
+                return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def create_watcher(watched):
+    """Return an inotify watcher where available, else a polling one."""
+    if INOTIFY_AVAILABLE:
+        try:
+            return InotifyWatcher(watched)
+        except OSError as e:
+            # e.g. the per-user limit on inotify watches is reached
+            print(f"inotify unavailable ({e}), polling instead")
+    return PollingWatcher(watched)
+
+
+def retranslate(ctx, sources):
+    """Translate changed source pages again with the API translator; return False if one fails.
+
+    Without a translator the existing translations are kept.
+    """
+    if not sources:
+        return True
+    if ctx.translator is None and ctx.use_api:
+        ctx.translator = create_translator(ctx.api_key)
+    if ctx.translator is None:
+        for md_path in sources:
+            print(f"{md_path.name} changed; keeping its translation (use --api to translate it again)")
+        return True
+
+    graph = BuildGraph(ctx.temp_dir)
+    params = translation_params(ctx.translator, ctx.output_lang)
+    try:
+        for md_path in sources:
+            output_path = output_path_for(md_path, ctx.output_dir)
+            # The source changed, so an unrecorded translation is out of date too
+            if translate_tracked(md_path, output_path, ctx.output_lang, ctx.translator, graph, None, params,
+                                 adopt_existing=False):
+                print(f"翻译完成: {output_path.name}")
+    except Exception as e:
+        print(f"翻译 {md_path.name} 时出错: {e}")
+        return False
+    finally:
+        graph.save()
+    return True
+
+
+def rebuild(ctx, changed=()):
+    """Run steps 4-6 after `changed` files changed, printing how long each took; return True on success."""
+    started = time.perf_counter()
+    timings = []
+    sources = sorted(path for path in changed if path.parent == ctx.pages_dir and path.exists())
+    with span("rebuild", "step", files=len(changed)) as rebuild_span:
+        if not retranslate(ctx, sources):
+            print("✗ Rebuild stopped: translation failed")
+            return False
+        for number, module_name, description in STEPS:
+            if number not in REBUILD_STEPS:
+                continue
+            step_started = time.perf_counter()
+            try:
+                ok = importlib.import_module(module_name).run(ctx)
+            except Exception as e:
+                print(f"✗ {description} raised {type(e).__name__}: {e}")
+                ok = False
+            timings.append(f"step {number} {time.perf_counter() - step_started:.2f}s")
+            if not ok:
+                print(f"✗ Rebuild stopped: {description} failed")
+                return False
+        seconds = time.perf_counter() - started
+        rebuild_span.set(seconds=seconds)
+
+    ctx.metrics["rebuild_seconds"] = seconds
+    print(f"Rebuilt after {len(changed)} changed files in {seconds:.2f}s ({', '.join(timings)})")
+    return True
+
+
+def watch(ctx, watcher=None):
+    """Rebuild steps 4-6 whenever pages or translations change, until interrupted; return 0."""
+    if ctx.render_memo is None:
+        ctx.render_memo = RenderMemo()
+    if ctx.renderer != "pandoc" and not ctx.render_memo.fragments:
+        # The in-memory caches are filled by a render, which an up-to-date output would skip
+        graph = BuildGraph(ctx.temp_dir)
+        graph.invalidate("render")
+        graph.save()
+        print("Warming up render caches...")
+        rebuild(ctx)
+
+    watcher = watcher or create_watcher(watched_files(ctx))
+    print(f"Watching {ctx.pages_dir} and {ctx.output_dir} ({watcher.name}); press Ctrl+C to stop")
+    try:
+        while True:
+            changed = watcher.wait()
+            names = sorted(path.name for path in changed)
+            print(f"\nChanged: {', '.join(names[:5])}{f' and {len(names) - 5} more' if len(names) > 5 else ''}")
+            rebuild(ctx, changed)
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+    finally:
+        watcher.close()
+    return 0
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Packed Workspace
+Keeps the pages, translations and images of a book, with their content
+hashes, in one SQLite file (workspace.sqlite) instead of thousands of small
+files, which is much faster on network filesystems where every open/stat is
+a round trip.
+
+Enabled with `main.py --packed` (recorded as WORKSPACE=packed in config.txt).
+`python3 workspace_store.py export <temp_dir>` materializes the usual
+pages/, images/ and output/output_pageNNNN.md layout for debugging.
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from atomic_io import atomic_write_bytes, atomic_write_text
+from build_graph import BuildGraph
+from pipeline import load_config
+
+PACK_FILENAME = "workspace.sqlite"
+
+PAGE = "page"
+TRANSLATION = "translation"
+IMAGE = "image"
+
+
+def is_packed(temp_dir):
+    """Return True if a working directory was initialized with a packed workspace."""
+    config_file = Path(temp_dir) / "config.txt"
+    return config_file.exists() and load_config(temp_dir).get('WORKSPACE') == 'packed'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class PackedWorkspace:
+    """Random-access store of (kind, name) -> content, with batched transactional writes."""
+
+    def __init__(self, temp_dir):
+        self.path = Path(temp_dir) / PACK_FILENAME
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        # Rollback journal rather than WAL: WAL needs shared memory, which network filesystems lack
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                source_hash TEXT,
+                params TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (kind, name)
+            )""")
+
+    def batch(self):
+        """Group writes into one transaction: `with store.batch(): ...`."""
+        return _Batch(self)
+
+    def _begin(self):
+        with self._lock:
+            if self._batch_depth == 0:
+                self._db.execute("BEGIN IMMEDIATE")
+            self._batch_depth += 1
+
+    def _end(self, commit):
+        with self._lock:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._db.execute("COMMIT" if commit else "ROLLBACK")
+
+    def put(self, kind, name, data, source_hash=None, params=None):
+        """Store one entry (text is stored as UTF-8); return its content hash."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = content_hash(data)
+        with self._lock, self.batch():
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, name, digest, len(data), data, source_hash,
+                 json.dumps(params, sort_keys=True) if params is not None else None, time.time()))
+        return digest
+
+    def get(self, kind, name):
+        """Return the bytes of an entry, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT data FROM entries WHERE kind = ? AND name = ?", (kind, name)).fetchone()
+        return row[0] if row else None
+
+    def get_text(self, kind, name):
+        data = self.get(kind, name)
+        return data.decode('utf-8') if data is not None else None
+
+    def info(self, kind, name):
+        """Return {'hash', 'size', 'source_hash', 'params'} of an entry without reading its data, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT hash, size, source_hash, params FROM entries WHERE kind = ? AND name = ?",
+                                   (kind, name)).fetchone()
+        if row is None:
+            return None
+        return {'hash': row[0], 'size': row[1], 'source_hash': row[2],
+                'params': json.loads(row[3]) if row[3] else None}
+
+    def names(self, kind):
+        """Names of all entries of a kind, sorted (page names are zero-padded, so this is page order)."""
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT name FROM entries WHERE kind = ? ORDER BY name", (kind,))]
+
+    def hashes(self, kind):
+        """Return {name: hash} for a kind."""
+        with self._lock:
+            return dict(self._db.execute("SELECT name, hash FROM entries WHERE kind = ? ORDER BY name", (kind,)))
+
+    def delete(self, kind, keep=()):
+        """Remove entries of a kind except the names in `keep`."""
+        keep = set(keep)
+        with self._lock, self.batch():
+            stale = [(kind, name) for name in self.names(kind) if name not in keep]
+            self._db.executemany("DELETE FROM entries WHERE kind = ? AND name = ?", stale)
+
+    def pack_directory(self, kind, directory, pattern="*", replace=False):
+        """Import the files of a directory as entries of one kind in a single transaction; return their names."""
+        paths = sorted(p for p in Path(directory).glob(pattern) if p.is_file())
+        with self.batch():
+            if replace:
+                self.delete(kind, keep=[p.name for p in paths])
+            for path in paths:
+                self.put(kind, path.name, path.read_bytes())
+        return [p.name for p in paths]
+
+    def materialize(self, kind, directory, prefix="", overwrite=False):
+        """Write the entries of a kind as files; existing files are kept unless overwrite. Return the count written."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        written = 0
+        for name in self.names(kind):
+            path = directory / f"{prefix}{name}"
+            if overwrite or not path.exists():
+                atomic_write_bytes(path, self.get(kind, name))
+                written += 1
+        return written
+
+    def export(self, dest_dir):
+        """Materialize the directory layout (pages/, images/, output/output_*.md) under dest_dir."""
+        dest_dir = Path(dest_dir)
+        counts = {
+            'pages': self.materialize(PAGE, dest_dir / "pages", overwrite=True),
+            'images': self.materialize(IMAGE, dest_dir / "images", overwrite=True),
+            'translations': self.materialize(TRANSLATION, dest_dir / "output", prefix="output_", overwrite=True),
+        }
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def pack_workspace(temp_dir):
+    """Pack a directory workspace and switch its config.txt to it; return the counts packed.
+
+    Translations keep the parameters build_state.json recorded for them, so
+    a translated book is not translated again after packing.
+    """
+    temp_dir = Path(temp_dir)
+    graph = BuildGraph(temp_dir)
+    store = PackedWorkspace(temp_dir)
+    try:
+        with store.batch():
+            pages = store.pack_directory(PAGE, temp_dir / "pages", "page*.md", replace=True)
+            images = store.pack_directory(IMAGE, temp_dir / "images", replace=True)
+            translations = []
+            for path in sorted((temp_dir / "output").glob("output_page*.md")):
+                name = path.name[len("output_"):]
+                page = store.info(PAGE, name)
+                record = graph.nodes.get(f"translate:{name}", {})
+                store.put(TRANSLATION, name, path.read_bytes(), source_hash=page and page['hash'],
+                          params=record.get('params'))
+                translations.append(name)
+    finally:
+        store.close()
+
+    config_file = temp_dir / "config.txt"
+    if not is_packed(temp_dir):
+        config = config_file.read_text(encoding='utf-8') if config_file.exists() else ""
+        if config and not config.endswith("\n"):
+            config += "\n"
+        atomic_write_text(config_file, config + "WORKSPACE=packed\n")
+    return {'pages': len(pages), 'translations': len(translations), 'images': len(images)}
+
+
+class _Batch:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._begin()
+        return self.store
+
+    def __exit__(self, exc_type, exc, tb):
+        self.store._end(commit=exc_type is None)
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or convert a packed workspace")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Materialize pages/, images/ and output/ files")
+    export_parser.add_argument("temp_dir", help="Working directory with workspace.sqlite")
+    export_parser.add_argument("--dest", help="Where to write the files (default: the working directory)")
+
+    pack_parser = subparsers.add_parser("pack", help="Pack an existing directory workspace")
+    pack_parser.add_argument("temp_dir", help="Working directory with pages/, images/ and output/")
+
+    stats_parser = subparsers.add_parser("stats", help="Show entry counts and sizes")
+    stats_parser.add_argument("temp_dir", help="Working directory with workspace.sqlite")
+
+    args = parser.parse_args()
+    temp_dir = Path(args.temp_dir)
+
+    if args.command != "pack" and not (temp_dir / PACK_FILENAME).exists():
+        print(f"Error: no {PACK_FILENAME} in {temp_dir}")
+        return 1
+
+    if args.command == "pack":
+        counts = pack_workspace(temp_dir)
+        print(f"Packed {counts['pages']} pages, {counts['translations']} translations and "
+              f"{counts['images']} images; {temp_dir / 'config.txt'} now uses WORKSPACE=packed")
+        return 0
+
+    store = PackedWorkspace(temp_dir)
+    if args.command == "export":
+        counts = store.export(args.dest or temp_dir)
+        print(f"Exported {counts['pages']} pages, {counts['translations']} translations and "
+              f"{counts['images']} images to {args.dest or temp_dir}")
+    else:
+        for kind in (PAGE, TRANSLATION, IMAGE):
+            names = store.names(kind)
+            size = sum(store.info(kind, name)['size'] for name in names)
+            print(f"{kind:>12}: {len(names)} entries, {size / 1e6:.2f} MB")
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())